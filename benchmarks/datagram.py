@@ -0,0 +1,48 @@
+'''
+Per-packet cost of encoding and decoding DATA and ACK datagrams: the datagram
+objects versus the codec helpers, that the sessions use.
+
+Run as C{python benchmarks/datagram.py} from the top of the source tree.
+'''
+from tftp.datagram import (DATADatagram, ACKDatagram, TFTPDatagramFactory,
+    split_opcode, encode_data, encode_ack, decode_data, decode_ack)
+import os
+import struct
+import timeit
+
+NUMBER = 200000
+BLOCK_SIZE = 1428
+
+payload = os.urandom(BLOCK_SIZE)
+data_wire = encode_data(1234, payload)
+ack_wire = encode_ack(1234)
+
+
+cases = [
+    # What the codec used to do: format strings and copies of the payload
+    ("DATA encode, format strings", "b''.join((struct.pack(b'!HH', 3, 1234), payload))"),
+    ("DATA encode, DATADatagram.to_wire", "DATADatagram(1234, payload).to_wire()"),
+    ("DATA encode, encode_data", "encode_data(1234, payload)"),
+    ("DATA decode, format strings", "struct.unpack(b'!H', data_wire[:2])[0], "
+                                    "struct.unpack(b'!H', data_wire[2:4])[0], data_wire[4:]"),
+    ("DATA decode, TFTPDatagramFactory", "TFTPDatagramFactory(*split_opcode(data_wire))"),
+    ("DATA decode, decode_data", "decode_data(data_wire)"),
+    ("ACK encode, format strings", "struct.pack(b'!HH', 4, 1234)"),
+    ("ACK encode, ACKDatagram.to_wire", "ACKDatagram(1234).to_wire()"),
+    ("ACK encode, encode_ack", "encode_ack(1234)"),
+    ("ACK decode, format strings", "struct.unpack(b'!H', ack_wire[:2])[0], "
+                                   "struct.unpack(b'!H', ack_wire[2:])[0]"),
+    ("ACK decode, TFTPDatagramFactory", "TFTPDatagramFactory(*split_opcode(ack_wire))"),
+    ("ACK decode, decode_ack", "decode_ack(ack_wire)"),
+]
+
+
+def main():
+    print("%d calls each, %d byte blocks" % (NUMBER, BLOCK_SIZE))
+    for name, stmt in cases:
+        best = min(timeit.repeat(stmt, number=NUMBER, repeat=3, globals=globals()))
+        print("%-36s %8.1f ns/packet" % (name, best / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+'''
+Cost of the netascii conversion of text-like blocks: the regular expressions
+with a Python callback per match versus splitting and joining in bulk.
+
+Run as C{python benchmarks/netascii.py} from the top of the source tree.
+'''
+from tftp.netascii import (to_netascii, from_netascii, _to_netascii_re,
+    _from_netascii_re)
+import timeit
+
+NUMBER = 20000
+BLOCK_SIZE = 512
+
+# Something like a kickstart or a preseed file: short lines, a lot of newlines
+_line = b"d-i partman-auto/method string lvm\n"
+text = (_line * (BLOCK_SIZE // len(_line) + 1))[:BLOCK_SIZE]
+text_wire = to_netascii(text)
+# Long lines, few newlines
+sparse = (b'x' * 200 + b'\n') * 3
+sparse = sparse[:BLOCK_SIZE].ljust(BLOCK_SIZE, b'x')
+sparse_wire = to_netascii(sparse)
+
+
+cases = [
+    ("to_netascii text, regex", "_to_netascii_re(text)"),
+    ("to_netascii text, bulk", "to_netascii(text)"),
+    ("from_netascii text, regex", "_from_netascii_re(text_wire)"),
+    ("from_netascii text, bulk", "from_netascii(text_wire)"),
+    ("to_netascii sparse, regex", "_to_netascii_re(sparse)"),
+    ("to_netascii sparse, bulk", "to_netascii(sparse)"),
+    ("from_netascii sparse, regex", "_from_netascii_re(sparse_wire)"),
+    ("from_netascii sparse, bulk", "from_netascii(sparse_wire)"),
+]
+
+
+def main():
+    print("%d calls each, %d byte blocks" % (NUMBER, BLOCK_SIZE))
+    for name, stmt in cases:
+        best = min(timeit.repeat(stmt, number=NUMBER, repeat=3, globals=globals()))
+        print("%-32s %8.1f ns/block" % (name, best / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,31 @@
 '''
 @author: shylent
 '''
-from os import fstat
-from tftp.errors import Unsupported, FileExists, AccessViolation, FileNotFound
+from collections import OrderedDict
+from os import fstat, stat
+from stat import S_ISDIR
+import binascii
+import errno
+import os
+from tftp.errors import (Unsupported, FileExists, AccessViolation, FileNotFound,
+    BackendError, DiskFull)
+from tftp.netascii import NetasciiSenderProxy
 from tftp.util import deferred
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredLock, maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
 from twisted.python.filepath import FilePath, InsecurePath
+from twisted.python.threadpool import ThreadPool
+import mmap
 import shutil
 import tempfile
 from zope import interface
 
+FSYNC_NONE = 'none'
+FSYNC_DATA = 'data'
+FSYNC_FULL = 'full'
+
 class IBackend(interface.Interface):
     """An object, that manages interaction between the TFTP network protocol and
     anything, where you can get files from or put files to (a filesystem).
@@ -171,6 +188,630 @@ class FilesystemReader(object):
         self.state = 'finished'
 
 
+@interface.implementer(IReader)
+class CachedReader(object):
+    """A reader, that serves the contents of a file, that is held in memory by
+    a L{ContentCache}. The blocks are C{memoryview} slices of the contents, so
+    reading does not copy them.
+
+    @see: L{IReader}
+
+    @param data: the contents of the file
+    @type data: C{bytes}
+
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.state = 'active'
+
+    @property
+    def size(self):
+        """
+        @see: L{IReader.size}
+
+        """
+        if self.state == 'finished':
+            return None
+        return len(self.data)
+
+    def read(self, size):
+        """
+        @see: L{IReader.read}
+
+        @return: data, that was read
+        @rtype: C{memoryview}
+
+        """
+        if self.state == 'finished':
+            return b''
+        start = self.offset
+        self.offset = min(start + size, len(self.data))
+        return self.data[start:self.offset]
+
+    def finish(self):
+        """
+        @see: L{IReader.finish}
+
+        """
+        self.state = 'finished'
+        self.data = memoryview(b'')
+
+
+class NegativeCache(object):
+    """Remembers the files, that were not found, for L{ttl} seconds, so that
+    the clients, that probe for many files, that do not exist (the network
+    boot loaders do), do not cost an attempt to open each of them. An entry is
+    dropped before it expires, if the modification time of the directory, that
+    would contain the file, changes (a file was created or renamed there).
+
+    @ivar ttl: for how long a missing file is remembered, in seconds
+    @type ttl: C{float}
+
+    @ivar max_entries: the maximum number of remembered files. The oldest ones
+    are forgotten first.
+    @type max_entries: C{int}
+
+    @ivar hits: the number of lookups of the files, that were known to be
+    missing
+    @type hits: C{int}
+
+    """
+
+    def __init__(self, ttl=5, max_entries=4096, _clock=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        if _clock is None:
+            self._clock = reactor
+        else:
+            self._clock = _clock
+        # path -> (expiry time, modification time of the directory)
+        self._entries = OrderedDict()
+
+    def _directoryTime(self, file_path):
+        try:
+            return stat(file_path.dirname()).st_mtime
+        except OSError:
+            return None
+
+    def isMissing(self, file_path):
+        """Whether or not the file is known to be missing
+
+        @type file_path: L{FilePath<twisted.python.filepath.FilePath>}
+
+        @rtype: C{bool}
+
+        """
+        entry = self._entries.get(file_path.path)
+        if entry is None:
+            return False
+        expires, dir_time = entry
+        if (expires <= self._clock.seconds() or
+                dir_time != self._directoryTime(file_path)):
+            del self._entries[file_path.path]
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, file_path):
+        """Remember, that the file is missing
+
+        @type file_path: L{FilePath<twisted.python.filepath.FilePath>}
+
+        """
+        self._entries.pop(file_path.path, None)
+        while len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+        self._entries[file_path.path] = (self._clock.seconds() + self.ttl,
+                                         self._directoryTime(file_path))
+
+    def clear(self):
+        """Forget all the missing files"""
+        self._entries.clear()
+
+
+class MmapFilesystemReader(CachedReader):
+    """A reader, that maps the file into memory once and serves C{memoryview}
+    slices of the mapping, so that the blocks are not copied, until they are
+    put into the outgoing datagrams.
+
+    @note: Touching a mapped page past the end of a file, that was truncated
+    (e.g. overwritten in place, which truncates it first), kills the whole
+    process with C{SIGBUS}. To guard against this, the size of the file is
+    checked with C{fstat} before every block, and the transfer fails with
+    L{BackendError}, if the file has become shorter, than the block. The file
+    may still be truncated between the check and the copy of the block, so
+    the files, that are served this way, should only ever be replaced (renamed
+    over), never overwritten in place.
+
+    @see: L{IReader}
+
+    @param file_path: a path to file, that we will read from
+    @type file_path: L{FilePath<twisted.python.filepath.FilePath>}
+
+    @raise FileNotFound: if the file does not exist
+
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        try:
+            self.file_obj = self.file_path.open('r')
+        except IOError:
+            raise FileNotFound(self.file_path)
+        size = fstat(self.file_obj.fileno()).st_size
+        if size:
+            self.map = mmap.mmap(self.file_obj.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+        else:
+            # Empty files can not be mapped
+            self.map = b''
+        CachedReader.__init__(self, self.map)
+
+    def read(self, size):
+        """
+        @see: L{IReader.read}
+
+        @raise BackendError: if the file was truncated and the block is no
+        longer there
+
+        """
+        if self.state != 'finished':
+            end = min(self.offset + size, len(self.data))
+            if (end > self.offset and
+                    fstat(self.file_obj.fileno()).st_size < end):
+                raise BackendError("%s was truncated, while it was being read"
+                                   % (self.file_path.path,))
+        return CachedReader.read(self, size)
+
+    def finish(self):
+        """
+        @see: L{IReader.finish}
+
+        """
+        if self.state == 'finished':
+            return
+        self.data.release()
+        CachedReader.finish(self)
+        self.file_obj.close()
+        if not isinstance(self.map, bytes):
+            try:
+                self.map.close()
+            except BufferError:
+                # Some of the blocks are still referenced, the mapping is
+                # closed, when they are gone
+                pass
+        self.map = None
+
+
+class ContentCache(object):
+    """Keeps the contents of the recently read files in memory, so that the
+    files, that are read by many clients at once (the kernels and the initial
+    ramdisks of machines, that boot over the network), are read from the disk
+    once. The least recently used files are evicted, when the contents of all
+    files add up to more, than L{max_bytes}.
+
+    A cached file is used, as long as its modification time and size have not
+    changed.
+
+    @ivar max_bytes: the maximum total size of the cached files, in bytes
+    @type max_bytes: C{int}
+
+    @ivar max_file_size: files, that are larger, than this, are never cached.
+    Defaults to L{max_bytes}.
+    @type max_file_size: C{int}
+
+    @ivar transform: if not C{None}, the contents are passed through this
+    function, before they are cached, and the result is what L{get} returns
+    and what counts towards L{max_bytes}. E.g. with
+    L{to_netascii<tftp.netascii.to_netascii>} the files are converted once,
+    and not every time they are sent in netascii mode.
+    @type transform: C{callable}
+
+    @ivar size: the total size of the cached files, in bytes
+    @type size: C{int}
+
+    @ivar hits: the number of lookups, that were served from the cache
+    @type hits: C{int}
+
+    @ivar misses: the number of lookups, that were not
+    @type misses: C{int}
+
+    @ivar evictions: the number of files, that were evicted to make room for
+    others
+    @type evictions: C{int}
+
+    """
+
+    def __init__(self, max_bytes, max_file_size=None, transform=None):
+        self.max_bytes = max_bytes
+        if max_file_size is None:
+            self.max_file_size = max_bytes
+        else:
+            self.max_file_size = max_file_size
+        self.transform = transform
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        # path -> ((mtime, size), contents), least recently used first
+        self._entries = OrderedDict()
+
+    def get(self, file_path):
+        """Return the contents of the file, reading it, if it is not cached or
+        has changed since it was cached.
+
+        @param file_path: the file
+        @type file_path: L{FilePath<twisted.python.filepath.FilePath>}
+
+        @return: the contents of the file or C{None}, if it can not be
+        cached (it is too large, it can not be read or it is being changed)
+        @rtype: C{bytes} or C{NoneType}
+
+        """
+        path = file_path.path
+        try:
+            st = stat(path)
+        except OSError:
+            self._discard(path)
+            return None
+        key = (st.st_mtime, st.st_size)
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            if entry[0] == key:
+                self.hits += 1
+                self._entries[path] = entry
+                return entry[1]
+            self.size -= len(entry[1])
+        self.misses += 1
+        if st.st_size > self.max_file_size:
+            return None
+        try:
+            with open(path, 'rb') as file_obj:
+                data = file_obj.read()
+                st = fstat(file_obj.fileno())
+        except (IOError, OSError):
+            return None
+        if len(data) != st.st_size or len(data) > self.max_file_size:
+            # Changed, while it was being read
+            return None
+        if self.transform is not None:
+            data = self.transform(data)
+        key = (st.st_mtime, st.st_size)
+        self._entries[path] = (key, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            evicted_path, (evicted_key, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+        return data
+
+    def _discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class SharedFile(object):
+    """A file, that is open once for all the L{SharedFileReader}s, that read
+    it at the same time.
+
+    @ivar path: the path of the file
+    @type path: C{bytes}
+
+    @ivar inode: the inode of the file, when it was opened
+    @type inode: C{int}
+
+    @ivar size: the size of the file, when it was opened
+    @type size: C{int}
+
+    @ivar readers: the number of readers, that use this file
+    @type readers: C{int}
+
+    """
+
+    def __init__(self, path, fd, st):
+        self.path = path
+        self.fd = fd
+        self.inode = st.st_ino
+        self.size = st.st_size
+        self.version = (st.st_mtime, st.st_size)
+        self.readers = 0
+        # The indices of the chunks of this file, that are cached
+        self.chunks = set()
+
+
+class SharedFiles(object):
+    """Shares the open files and the data, that was read from them, between
+    the transfers of the same file, so that, when many clients fetch the same
+    file at once (the initial ramdisk of machines, that boot over the network),
+    it is read from the disk once, and not once per client.
+
+    A file is open once per path and inode, for as long as any reader uses it.
+    The files are read with C{pread} in chunks of L{chunk_size} bytes at
+    explicit offsets, and the chunks are kept in memory, so that the readers,
+    that are at about the same offset, take their blocks from the same chunk.
+    Up to L{max_chunks} chunks of all files are kept, the least recently used
+    ones are dropped first. With L{max_chunks} of 0 nothing is kept and every
+    read is a C{pread} of exactly what the reader asked for.
+
+    Up to L{max_open} files, that no reader uses, are kept open, so that the
+    next reader of a hot file does not have to open it again. The least
+    recently used ones are closed first.
+
+    A file, that is replaced (has a new inode) or is changed (has a new
+    modification time or size), is opened again for the new readers, the
+    readers, that were reading it, finish reading the old version. This is
+    checked with a C{stat} of the path, whenever a reader opens the file.
+
+    @ivar chunk_size: the size of a read from the disk, in bytes
+    @type chunk_size: C{int}
+
+    @ivar max_chunks: how many chunks to keep in memory
+    @type max_chunks: C{int}
+
+    @ivar max_open: how many files, that no reader uses, to keep open
+    @type max_open: C{int}
+
+    @ivar reads: the number of reads from the disk
+    @type reads: C{int}
+
+    @ivar hits: the number of chunks, that were found in memory
+    @type hits: C{int}
+
+    @ivar opens: the number of times a file was opened
+    @type opens: C{int}
+
+    """
+
+    def __init__(self, chunk_size=65536, max_chunks=256, max_open=0):
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.max_open = max_open
+        self.reads = self.hits = self.opens = 0
+        # path -> SharedFile, the current version of every open file
+        self._files = {}
+        # path -> SharedFile, that no reader uses, least recently used first
+        self._idle = OrderedDict()
+        # (SharedFile, chunk index) -> data, least recently used first
+        self._chunks = OrderedDict()
+
+    def open(self, file_path):
+        """Get the shared file for a new reader. L{release} must be called,
+        when the reader is done with it.
+
+        @param file_path: the file
+        @type file_path: L{FilePath<twisted.python.filepath.FilePath>}
+
+        @raise FileNotFound: if the file does not exist
+
+        @rtype: L{SharedFile}
+
+        """
+        path = file_path.path
+        shared = self._files.get(path)
+        try:
+            st = stat(path)
+        except OSError:
+            if shared is not None:
+                self._detach(shared)
+            raise FileNotFound(file_path)
+        if shared is not None and (shared.inode != st.st_ino or
+                                   shared.version != (st.st_mtime, st.st_size)):
+            self._detach(shared)
+            shared = None
+        if shared is None:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                raise FileNotFound(file_path)
+            st = fstat(fd)
+            if S_ISDIR(st.st_mode):
+                os.close(fd)
+                raise FileNotFound(file_path)
+            self.opens += 1
+            shared = self._files[path] = SharedFile(path, fd, st)
+        else:
+            self._idle.pop(path, None)
+        shared.readers += 1
+        return shared
+
+    def release(self, shared):
+        """Tell, that a reader is done with a shared file. When no reader uses
+        it, it is kept open, if it is the current version of the file and
+        L{max_open} allows, or closed and its chunks are dropped.
+
+        @type shared: L{SharedFile}
+
+        """
+        shared.readers -= 1
+        if shared.readers:
+            return
+        if self._files.get(shared.path) is not shared:
+            self._close(shared)
+            return
+        self._idle[shared.path] = shared
+        while len(self._idle) > self.max_open:
+            path, evicted = self._idle.popitem(last=False)
+            del self._files[path]
+            self._close(evicted)
+
+    def clear(self):
+        """Close the files, that no reader uses"""
+        while self._idle:
+            path, shared = self._idle.popitem()
+            del self._files[path]
+            self._close(shared)
+
+    def _detach(self, shared):
+        # The file was replaced, changed or removed. Close it, if no reader uses
+        # it, or when the last one is done.
+        del self._files[shared.path]
+        if self._idle.pop(shared.path, None) is not None:
+            self._close(shared)
+
+    def _close(self, shared):
+        for index in shared.chunks:
+            del self._chunks[(shared, index)]
+        shared.chunks.clear()
+        os.close(shared.fd)
+
+    def read(self, shared, offset, size):
+        """Read up to C{size} bytes of a shared file, starting at C{offset}.
+
+        @rtype: C{memoryview} or C{bytes}
+
+        """
+        end = min(offset + size, shared.size)
+        if end <= offset:
+            return b''
+        if not self.max_chunks:
+            self.reads += 1
+            return os.pread(shared.fd, end - offset, offset)
+        first = offset // self.chunk_size
+        last = (end - 1) // self.chunk_size
+        start = offset - first * self.chunk_size
+        if first == last:
+            return memoryview(self._chunk(shared, first))[start:start + end - offset]
+        data = b''.join([self._chunk(shared, index)
+                         for index in range(first, last + 1)])
+        return data[start:start + end - offset]
+
+    def _chunk(self, shared, index):
+        key = (shared, index)
+        chunk = self._chunks.pop(key, None)
+        if chunk is not None:
+            self.hits += 1
+        else:
+            self.reads += 1
+            chunk = os.pread(shared.fd, self.chunk_size, index * self.chunk_size)
+            shared.chunks.add(index)
+            while len(self._chunks) >= self.max_chunks:
+                (evicted, evicted_index), ign = self._chunks.popitem(last=False)
+                evicted.chunks.discard(evicted_index)
+        self._chunks[key] = chunk
+        return chunk
+
+
+@interface.implementer(IReader)
+class SharedFileReader(object):
+    """A reader, that reads a file through L{SharedFiles}, so that the
+    transfers of the same file share the reads from the disk.
+
+    @see: L{IReader}
+
+    @param shared: the file to read
+    @type shared: L{SharedFile}
+
+    @param files: the L{SharedFiles}, that opened it
+    @type files: L{SharedFiles}
+
+    """
+
+    def __init__(self, shared, files):
+        self.shared = shared
+        self.files = files
+        self.offset = 0
+        self.state = 'active'
+
+    @property
+    def size(self):
+        """
+        @see: L{IReader.size}
+
+        """
+        if self.state == 'finished':
+            return None
+        return self.shared.size
+
+    def read(self, size):
+        """
+        @see: L{IReader.read}
+
+        @return: data, that was read
+        @rtype: C{memoryview} or C{bytes}
+
+        """
+        if self.state == 'finished':
+            return b''
+        data = self.files.read(self.shared, self.offset, size)
+        self.offset += len(data)
+        return data
+
+    def finish(self):
+        """
+        @see: L{IReader.finish}
+
+        """
+        if self.state != 'finished':
+            self.state = 'finished'
+            self.files.release(self.shared)
+
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+
+
+def _writev(file_obj, buffers):
+    """Write the buffers to the file with as few system calls as possible"""
+    if not hasattr(os, 'writev'):
+        file_obj.write(b''.join(buffers))
+        return
+    file_obj.flush()
+    fd = file_obj.fileno()
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    while buffers:
+        written = os.writev(fd, buffers[:_IOV_MAX])
+        while written:
+            if written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][written:]
+                written = 0
+
+
+def _allocate(file_obj, size, max_size, directory):
+    """Make sure, that there is room for C{size} bytes in the file and reserve
+    it on the disk, if the platform and the filesystem allow it.
+
+    @raise DiskFull: if the file would be larger, than C{max_size} or there
+    is not enough free space in C{directory}
+
+    """
+    if max_size is not None and size > max_size:
+        raise DiskFull("The file is larger, than allowed (%d > %d bytes)" %
+                       (size, max_size))
+    if hasattr(os, 'statvfs'):
+        st = os.statvfs(directory)
+        available = st.f_bavail * st.f_frsize
+        if size > available:
+            raise DiskFull("Not enough free space (%d > %d bytes)" %
+                           (size, available))
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    file_obj.flush()
+    try:
+        os.posix_fallocate(file_obj.fileno(), 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise DiskFull("Not enough free space")
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise
+
+
+def _sync(file_obj, policy):
+    """Flush the file to disk according to the policy"""
+    if policy == FSYNC_NONE:
+        return
+    file_obj.flush()
+    if policy == FSYNC_DATA and hasattr(os, 'fdatasync'):
+        os.fdatasync(file_obj.fileno())
+    else:
+        os.fsync(file_obj.fileno())
+
+
 @interface.implementer(IWriter)
 class FilesystemWriter(object):
     """A writer to go with L{FilesystemSynchronousBackend}.
@@ -185,28 +826,77 @@ class FilesystemWriter(object):
     @param file_path: a path to file, that will be created and written to
     @type file_path: L{FilePath<twisted.python.filepath.FilePath>}
 
+    @param max_size: if not C{None}, writing more, than this many bytes,
+    fails with L{DiskFull}
+    @type max_size: C{int}
+
     @raise FileExists: if the file already exists
 
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, max_size=None):
         if file_path.exists():
             raise FileExists(file_path)
         file_dir = file_path.parent()
         if not file_dir.exists():
             file_dir.makedirs()
         self.file_path = file_path
+        self.max_size = max_size
+        self.written = self.allocated = 0
         self.destination_file = self.file_path.open('w')
         self.temp_destination = tempfile.TemporaryFile()
+        self.fsync = FSYNC_NONE
         self.state = 'active'
 
+    def _count(self, size):
+        self.written += size
+        if self.max_size is not None and self.written > self.max_size:
+            raise DiskFull("The file is larger, than allowed (%d bytes)" %
+                           (self.max_size,))
+
     def write(self, data):
         """
         @see: L{IWriter.write}
 
         """
+        self._count(len(data))
         self.temp_destination.write(data)
 
+    def writev(self, buffers):
+        """Write several chunks of data at once (with C{writev}, if it is
+        available).
+
+        @type buffers: C{list} of C{bytes} or C{memoryview}
+
+        """
+        self._count(sum(len(b) for b in buffers))
+        _writev(self.temp_destination, buffers)
+
+    def allocate(self, size):
+        """Reserve the room for the file, when its size is known in advance
+        (from the tsize option). If less is written, the file is truncated to
+        the actual size on L{finish}.
+
+        @param size: the expected size of the file
+        @type size: C{int}
+
+        @raise DiskFull: if the file is larger, than L{max_size}, or there is
+        not enough free space
+
+        """
+        _allocate(self.destination_file, size, self.max_size,
+                  self.file_path.parent().path)
+        self.allocated = size
+
+    def syncOnFinish(self, policy):
+        """Make L{finish} flush the file to disk, before it returns.
+
+        @param policy: L{FSYNC_DATA} (C{fdatasync}), L{FSYNC_FULL} (C{fsync})
+        or L{FSYNC_NONE}
+
+        """
+        self.fsync = policy
+
     def finish(self):
         """
         @see: L{IWriter.finish}
@@ -215,6 +905,9 @@ class FilesystemWriter(object):
         if self.state not in ('finished', 'cancelled'):
             self.temp_destination.seek(0)
             shutil.copyfileobj(self.temp_destination, self.destination_file)
+            if self.allocated > self.written:
+                self.destination_file.truncate(self.written)
+            _sync(self.destination_file, self.fsync)
             self.temp_destination.close()
             self.destination_file.close()
             self.state = 'finished'
@@ -231,6 +924,266 @@ class FilesystemWriter(object):
             self.state = 'cancelled'
 
 
+@interface.implementer(IWriter)
+class AtomicFilesystemWriter(object):
+    """A writer to go with L{FilesystemSynchronousBackend}, that writes to a
+    temporary file in the directory of the target file. If the transfer is
+    completed successfully, the temporary file is linked to the name of the
+    target file and then removed, so the data is written once and the target
+    file never appears partially written. If L{cancel} is called, the
+    temporary file is removed.
+
+    Like with L{FilesystemWriter}, an existing file is never replaced: if
+    another transfer has created the target file in the meantime, L{finish}
+    fails with L{FileExists}.
+
+    @see: L{IWriter}
+
+    @param file_path: a path to file, that will be created and written to
+    @type file_path: L{FilePath<twisted.python.filepath.FilePath>}
+
+    @param max_size: if not C{None}, writing more, than this many bytes,
+    fails with L{DiskFull}
+    @type max_size: C{int}
+
+    @raise FileExists: if the file already exists
+
+    """
+
+    def __init__(self, file_path, max_size=None):
+        if file_path.exists():
+            raise FileExists(file_path)
+        file_dir = file_path.parent()
+        if not file_dir.exists():
+            file_dir.makedirs()
+        self.file_path = file_path
+        self.max_size = max_size
+        self.written = self.allocated = 0
+        fd, self.temp_path = self._createTemp(file_path)
+        self.temp_destination = os.fdopen(fd, 'wb')
+        self.fsync = FSYNC_NONE
+        self.state = 'active'
+
+    def _createTemp(self, file_path):
+        """Create a temporary file with a random name next to C{file_path}.
+        The file gets the usual permissions, as set by the umask of the
+        process at that time.
+
+        @return: the file descriptor and the path of the file
+        @rtype: C{(int, str)} or C{(int, bytes)}
+
+        """
+        name = file_path.basename()
+        while True:
+            suffix = binascii.hexlify(os.urandom(6))
+            if isinstance(name, bytes):
+                temp_name = b'.' + name + b'.' + suffix
+            else:
+                temp_name = '.' + name + '.' + suffix.decode('ascii')
+            temp_path = file_path.sibling(temp_name).path
+            try:
+                fd = os.open(temp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                             0o666)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            return fd, temp_path
+
+    def _count(self, size):
+        self.written += size
+        if self.max_size is not None and self.written > self.max_size:
+            raise DiskFull("The file is larger, than allowed (%d bytes)" %
+                           (self.max_size,))
+
+    def write(self, data):
+        """
+        @see: L{IWriter.write}
+
+        """
+        self._count(len(data))
+        self.temp_destination.write(data)
+
+    def writev(self, buffers):
+        """
+        @see: L{FilesystemWriter.writev}
+
+        """
+        self._count(sum(len(b) for b in buffers))
+        _writev(self.temp_destination, buffers)
+
+    def allocate(self, size):
+        """
+        @see: L{FilesystemWriter.allocate}
+
+        """
+        _allocate(self.temp_destination, size, self.max_size,
+                  self.file_path.parent().path)
+        self.allocated = size
+
+    def syncOnFinish(self, policy):
+        """Make L{finish} flush the file to disk, before it is published under
+        the target name. With L{FSYNC_FULL} the new name is flushed to disk as
+        well.
+
+        @see: L{FilesystemWriter.syncOnFinish}
+
+        """
+        self.fsync = policy
+
+    def finish(self):
+        """
+        @see: L{IWriter.finish}
+
+        """
+        if self.state not in ('finished', 'cancelled'):
+            if self.allocated > self.written:
+                self.temp_destination.truncate(self.written)
+            _sync(self.temp_destination, self.fsync)
+            self.temp_destination.close()
+            try:
+                # Unlike a rename, a link does not replace an existing file
+                os.link(self.temp_path, self.file_path.path)
+            except OSError as e:
+                os.unlink(self.temp_path)
+                self.state = 'cancelled'
+                if e.errno == errno.EEXIST:
+                    raise FileExists(self.file_path)
+                raise
+            os.unlink(self.temp_path)
+            if self.fsync == FSYNC_FULL:
+                dir_fd = os.open(self.file_path.parent().path, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            self.state = 'finished'
+
+    def cancel(self):
+        """
+        @see: L{IWriter.cancel}
+
+        """
+        if self.state not in ('finished', 'cancelled'):
+            self.temp_destination.close()
+            os.unlink(self.temp_path)
+            self.state = 'cancelled'
+
+
+@interface.implementer(IWriter)
+class BufferingWriter(object):
+    """Proxies an object, that provides L{IWriter}. The written blocks are
+    collected, until there are at least L{flush_size} bytes of them, and then
+    written at once: the multiple of L{flush_size}, the rest is kept for the
+    next write. The blocks are passed to C{writev} of the writer, if it has
+    one, or joined and passed to C{write} otherwise. Writes, that are only
+    buffered, complete immediately.
+
+    @param writer: an L{IWriter} provider
+    @type writer: L{IWriter} provider
+
+    @ivar flush_size: the number of bytes to collect before writing them
+    (0 - write every block at once)
+    @type flush_size: C{int}
+
+    @ivar fsync: how to flush the file to disk on L{finish}, one of
+    L{FSYNC_NONE}, L{FSYNC_DATA} and L{FSYNC_FULL}. Used, if the writer has
+    C{syncOnFinish}, like L{FilesystemWriter}.
+    @type fsync: C{str}
+
+    """
+
+    def __init__(self, writer, flush_size=65536, fsync=FSYNC_NONE):
+        self.writer = writer
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self._buffers = []
+        self._buffered = 0
+        # Look at the class: the proxies, like NetasciiReceiverProxy, pass on
+        # the attributes of the objects, that they wrap, and the data would
+        # not go through them
+        self._has_writev = getattr(type(writer), 'writev', None) is not None
+
+    def write(self, data):
+        """
+        @see: L{IWriter.write}
+
+        @return: C{None}, if the data was buffered, or the result of the
+        write of the buffered data
+        @rtype: C{NoneType} or L{Deferred}
+
+        """
+        self._buffers.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.flush_size:
+            return self._flush(aligned=True)
+
+    def _flush(self, aligned=False):
+        buffers, self._buffers = self._buffers, []
+        keep = self._buffered % self.flush_size if aligned and self.flush_size else 0
+        self._buffered = keep
+        while keep:
+            last = buffers.pop()
+            if len(last) <= keep:
+                self._buffers.insert(0, last)
+                keep -= len(last)
+            else:
+                last = memoryview(last)
+                buffers.append(last[:len(last) - keep])
+                self._buffers.insert(0, last[len(last) - keep:])
+                keep = 0
+        if not buffers:
+            return None
+        if self._has_writev:
+            return self.writer.writev(buffers)
+        if len(buffers) == 1:
+            return self.writer.write(buffers[0])
+        return self.writer.write(b''.join(buffers))
+
+    def finish(self):
+        """Write the rest of the buffered data and finish the writer. If the
+        data can not be written, the writer is cancelled instead and the
+        returned L{Deferred} fails.
+
+        @see: L{IWriter.finish}
+
+        @rtype: L{Deferred}
+
+        """
+        d = maybeDeferred(self._flush)
+        if self.fsync != FSYNC_NONE:
+            sync = getattr(self.writer, 'syncOnFinish', None)
+            if sync is not None:
+                sync(self.fsync)
+        d.addCallback(lambda ign: self.writer.finish())
+        d.addErrback(self._flushFailed)
+        return d
+
+    def allocate(self, size):
+        """Reserve the room for the file, if the writer supports it.
+
+        @see: L{FilesystemWriter.allocate}
+
+        """
+        allocate = getattr(self.writer, 'allocate', None)
+        if allocate is not None:
+            return allocate(size)
+
+    def _flushFailed(self, failure):
+        self.writer.cancel()
+        return failure
+
+    def cancel(self):
+        """Discard the buffered data and cancel the writer.
+
+        @see: L{IWriter.cancel}
+
+        """
+        self._buffers = []
+        self._buffered = 0
+        return self.writer.cancel()
+
+
 @interface.implementer(IBackend)
 class FilesystemSynchronousBackend(object):
     """A synchronous filesystem backend.
@@ -247,43 +1200,460 @@ class FilesystemSynchronousBackend(object):
     @param can_write: whether or not this backend should support writes
     @type can_write: C{bool}
 
+    @param cache: if not C{None}, the files are read through this cache and
+    served by L{CachedReader}s
+    @type cache: L{ContentCache}
+
+    @param use_mmap: whether or not to serve the files, that are not cached,
+    with L{MmapFilesystemReader}s
+    @type use_mmap: C{bool}
+
+    @param atomic_writes: whether or not to write the files with
+    L{AtomicFilesystemWriter}s
+    @type atomic_writes: C{bool}
+
+    @param write_buffer: if not 0, the uploads are written in chunks of this
+    many bytes, see L{BufferingWriter}
+    @type write_buffer: C{int}
+
+    @param fsync: how to flush the uploaded files to disk, one of
+    L{FSYNC_NONE}, L{FSYNC_DATA} and L{FSYNC_FULL}
+    @type fsync: C{str}
+
+    @param max_upload_size: if not C{None}, the uploads, that are larger, than
+    this many bytes, fail with L{DiskFull}
+    @type max_upload_size: C{int}
+
+    @param negative_cache: if not C{None}, the files, that were not found, are
+    remembered in it. It is cleared, when a file is written.
+    @type negative_cache: L{NegativeCache}
+
+    @param netascii_cache: if not C{None}, the files, that are read in netascii
+    mode, are converted through this cache, see L{get_netascii_reader}. It
+    must convert the contents with L{to_netascii<tftp.netascii.to_netascii>}.
+    @type netascii_cache: L{ContentCache}
+
+    @param shared_files: if not C{None}, the files, that are not cached, are
+    read through it by L{SharedFileReader}s, instead of L{FilesystemReader}s
+    or L{MmapFilesystemReader}s. It also keeps the hot files open between
+    their transfers, if its C{max_open} is not 0.
+    @type shared_files: L{SharedFiles}
+
     """
 
-    def __init__(self, base_path, can_read=True, can_write=True):
+    def __init__(self, base_path, can_read=True, can_write=True, cache=None,
+                 use_mmap=False, atomic_writes=False, write_buffer=0,
+                 fsync=FSYNC_NONE, max_upload_size=None, negative_cache=None,
+                 netascii_cache=None, shared_files=None):
         try:
             self.base = FilePath(base_path.path)
         except AttributeError:
             self.base = FilePath(base_path)
         self.can_read, self.can_write = can_read, can_write
+        self.cache = cache
+        self.use_mmap = use_mmap
+        self.atomic_writes = atomic_writes
+        self.write_buffer = write_buffer
+        self.fsync = fsync
+        self.max_upload_size = max_upload_size
+        self.negative_cache = negative_cache
+        self.netascii_cache = netascii_cache
+        self.shared_files = shared_files
 
     @deferred
     def get_reader(self, file_name):
         """
         @see: L{IBackend.get_reader}
 
-        @rtype: L{Deferred}, yielding a L{FilesystemReader}
+        @rtype: L{Deferred}, yielding a L{FilesystemReader}, a L{CachedReader},
+        a L{MmapFilesystemReader} or a L{SharedFileReader}
+
+        """
+        return self._getReader(file_name, self._openReader)
+
+    @deferred
+    def get_netascii_reader(self, file_name):
+        """Like L{get_reader}, but the reader returns the contents of the file
+        already converted to netascii. The protocol uses this method instead of
+        wrapping the reader in a L{NetasciiSenderProxy}, if the backend has it.
+
+        The files, that are in the L{netascii_cache}, are served as they were
+        converted, with no conversion per read, and the size of the reader is
+        the exact length of the converted contents (this is what is sent in
+        the I{tsize} option). The other files are converted, while they are
+        read, and their size is unknown.
+
+        @rtype: L{Deferred}, yielding a L{CachedReader} or a
+        L{NetasciiSenderProxy}
 
         """
+        return self._getReader(file_name, self._openNetasciiReader)
+
+    def _getReader(self, file_name, open_reader):
         if not self.can_read:
             raise Unsupported("Reading not supported")
+        target_path = self._targetPath(file_name)
+        if self.negative_cache is None:
+            return open_reader(target_path)
+        if self.negative_cache.isMissing(target_path):
+            raise FileNotFound(target_path)
         try:
-            target_path = self.base.descendant(file_name.split(b"/"))
-        except InsecurePath as e:
-            raise AccessViolation("Insecure path: %s" % e)
+            return open_reader(target_path)
+        except FileNotFound:
+            self.negative_cache.add(target_path)
+            raise
+
+    def _openReader(self, target_path):
+        if self.cache is not None:
+            data = self.cache.get(target_path)
+            if data is not None:
+                return CachedReader(data)
+        if self.shared_files is not None:
+            return SharedFileReader(self.shared_files.open(target_path),
+                                    self.shared_files)
+        if self.use_mmap:
+            return MmapFilesystemReader(target_path)
         return FilesystemReader(target_path)
 
+    def _openNetasciiReader(self, target_path):
+        if self.netascii_cache is not None:
+            data = self.netascii_cache.get(target_path)
+            if data is not None:
+                return CachedReader(data)
+        return NetasciiSenderProxy(self._openReader(target_path))
+
     @deferred
     def get_writer(self, file_name):
         """
         @see: L{IBackend.get_writer}
 
-        @rtype: L{Deferred}, yielding a L{FilesystemWriter}
+        @rtype: L{Deferred}, yielding a L{FilesystemWriter} or an
+        L{AtomicFilesystemWriter}, possibly wrapped in a L{BufferingWriter}
 
         """
         if not self.can_write:
             raise Unsupported("Writing not supported")
+        target_path = self._targetPath(file_name)
+        if self.negative_cache is not None:
+            self.negative_cache.clear()
+        return self._bufferWriter(self._openWriter(target_path))
+
+    def _openWriter(self, target_path):
+        if self.atomic_writes:
+            return AtomicFilesystemWriter(target_path, self.max_upload_size)
+        return FilesystemWriter(target_path, self.max_upload_size)
+
+    def _bufferWriter(self, writer):
+        if self.write_buffer or self.fsync != FSYNC_NONE:
+            return BufferingWriter(writer, self.write_buffer, self.fsync)
+        return writer
+
+    def _targetPath(self, file_name):
         try:
-            target_path = self.base.descendant(file_name.split(b"/"))
+            return self.base.descendant(file_name.split(b"/"))
         except InsecurePath as e:
             raise AccessViolation("Insecure path: %s" % e)
-        return FilesystemWriter(target_path)
+
+
+@interface.implementer(IReader)
+class ThreadedReader(object):
+    """Proxies a synchronous L{IReader} provider, whose methods are called in
+    the thread pool of a L{FilesystemAsyncBackend}. The data is read
+    L{read_batch} blocks at a time, so that only every L{read_batch}-th block
+    takes a trip to a thread and back. The data, that was read ahead, is kept
+    in a buffer, that the blocks are sliced from, so every read returns exactly
+    as many bytes, as were asked for, whatever the size of the previous reads.
+
+    @param reader: the synchronous reader
+    @type reader: L{IReader} provider
+
+    @param size: the size of the file, that was determined in the thread
+    @type size: C{int} or C{NoneType}
+
+    @param backend: the backend, that runs the calls
+    @type backend: L{FilesystemAsyncBackend}
+
+    @ivar read_batch: the number of blocks to read at once
+    @type read_batch: C{int}
+
+    """
+
+    def __init__(self, reader, size, backend):
+        self.reader = reader
+        self.size = size
+        self.backend = backend
+        self.read_batch = backend.read_batch
+        self._buffer = memoryview(b'')
+        self._offset = 0
+        self._eof = self._finished = False
+        # The calls of the reader are made one at a time
+        self._lock = DeferredLock()
+
+    def read(self, size):
+        """
+        @see: L{IReader.read}
+
+        @return: a block, that was read with one of the previous blocks, or a
+        L{Deferred}, that will fire with the block, when it is read
+        @rtype: C{memoryview}, C{bytes} or L{Deferred}
+
+        """
+        if not self._lock.locked:
+            if self._finished:
+                return b''
+            if self._eof or len(self._buffer) - self._offset >= size:
+                return self._take(size)
+        return self._lock.run(self._readBlock, size)
+
+    def _readBlock(self, size):
+        if self._finished:
+            return b''
+        if self._eof or len(self._buffer) - self._offset >= size:
+            return self._take(size)
+        batch = size * self.read_batch
+        d = self.backend.deferToThread(self.reader.read, batch)
+        d.addCallback(self._gotBatch, batch, size)
+        return d
+
+    def _gotBatch(self, data, batch, size):
+        if self._finished:
+            return b''
+        # A short read means, that there is no more data
+        self._eof = len(data) < batch
+        leftover = self._buffer[self._offset:]
+        if len(leftover):
+            data = leftover.tobytes() + data
+        self._buffer = memoryview(data)
+        self._offset = 0
+        return self._take(size)
+
+    def _take(self, size):
+        start = self._offset
+        self._offset = min(start + size, len(self._buffer))
+        return self._buffer[start:self._offset]
+
+    def finish(self):
+        """
+        @see: L{IReader.finish}
+
+        """
+        if not self._finished:
+            self._finished = True
+            self._buffer = memoryview(b'')
+            self._offset = 0
+            self._lock.run(self.backend.deferToThread, self.reader.finish
+                           ).addErrback(log.err)
+
+
+@interface.implementer(IWriter)
+class ThreadedWriter(object):
+    """Proxies a synchronous L{IWriter} provider, whose methods are called in
+    the thread pool of a L{FilesystemAsyncBackend}, one at a time.
+
+    @param writer: the synchronous writer
+    @type writer: L{IWriter} provider
+
+    @param backend: the backend, that runs the calls
+    @type backend: L{FilesystemAsyncBackend}
+
+    """
+
+    def __init__(self, writer, backend):
+        self.writer = writer
+        self.backend = backend
+        self._lock = DeferredLock()
+
+    def _call(self, method, *args):
+        return self._lock.run(self.backend.deferToThread, method, *args)
+
+    def write(self, data):
+        """
+        @see: L{IWriter.write}
+
+        @rtype: L{Deferred}
+
+        """
+        return self._call(self.writer.write, data)
+
+    def writev(self, buffers):
+        """
+        @see: L{FilesystemWriter.writev}
+
+        @rtype: L{Deferred}
+
+        """
+        if getattr(type(self.writer), 'writev', None) is None:
+            return self._call(self.writer.write, b''.join(buffers))
+        return self._call(self.writer.writev, buffers)
+
+    def syncOnFinish(self, policy):
+        """
+        @see: L{FilesystemWriter.syncOnFinish}
+
+        """
+        sync = getattr(self.writer, 'syncOnFinish', None)
+        if sync is not None:
+            sync(policy)
+
+    def allocate(self, size):
+        """
+        @see: L{FilesystemWriter.allocate}
+
+        @rtype: L{Deferred}
+
+        """
+        allocate = getattr(self.writer, 'allocate', None)
+        if allocate is None:
+            return None
+        return self._call(allocate, size)
+
+    def finish(self):
+        """
+        @see: L{IWriter.finish}
+
+        @rtype: L{Deferred}
+
+        """
+        return self._call(self.writer.finish)
+
+    def cancel(self):
+        """
+        @see: L{IWriter.cancel}
+
+        @rtype: L{Deferred}
+
+        """
+        return self._call(self.writer.cancel)
+
+
+class FilesystemAsyncBackend(FilesystemSynchronousBackend):
+    """A filesystem backend, that makes all the blocking filesystem calls
+    (opening, reading, writing and closing the files, creating the directories)
+    in a thread pool, so that a slow filesystem (e.g. a network one) does not
+    hold up the transfers, that are in progress.
+
+    @see: L{IBackend}
+
+    @param threads: the maximum number of threads
+    @type threads: C{int}
+
+    @param queue_size: the maximum number of calls, that may be queued or in
+    progress. New transfers are refused with L{BackendError}, while there are
+    this many. The calls of the transfers, that are in progress, are always
+    queued.
+    @type queue_size: C{int}
+
+    @param read_batch: the number of blocks to read per call, see
+    L{ThreadedReader}
+    @type read_batch: C{int}
+
+    @ivar pending: the number of calls, that are queued or in progress
+    @type pending: C{int}
+
+    """
+
+    def __init__(self, base_path, can_read=True, can_write=True, threads=4,
+                 queue_size=64, read_batch=16, atomic_writes=False,
+                 write_buffer=0, fsync=FSYNC_NONE, max_upload_size=None,
+                 _reactor=None):
+        FilesystemSynchronousBackend.__init__(self, base_path, can_read, can_write,
+                                              atomic_writes=atomic_writes,
+                                              write_buffer=write_buffer,
+                                              fsync=fsync,
+                                              max_upload_size=max_upload_size)
+        self.queue_size = queue_size
+        self.read_batch = read_batch
+        self.pending = 0
+        if _reactor is None:
+            self._reactor = reactor
+        else:
+            self._reactor = _reactor
+        self.pool = ThreadPool(minthreads=0, maxthreads=threads,
+                               name='tftp-backend')
+        self._shutdown_trigger = None
+
+    def deferToThread(self, func, *args, **kwargs):
+        """Call C{func} in the thread pool, starting the pool, if it is not
+        running yet.
+
+        @rtype: L{Deferred}
+
+        """
+        if not self.pool.started:
+            self.pool.start()
+            self._shutdown_trigger = self._reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._shutdown)
+        self.pending += 1
+        d = deferToThreadPool(self._reactor, self.pool, func, *args, **kwargs)
+        d.addBoth(self._done)
+        return d
+
+    def _done(self, result):
+        self.pending -= 1
+        return result
+
+    def stop(self):
+        """Stop the thread pool, waiting for the calls in progress"""
+        if self._shutdown_trigger is not None:
+            self._reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+        if self.pool.started:
+            self.pool.stop()
+
+    def _shutdown(self):
+        # The reactor is running the trigger, which is no longer registered by
+        # now, so there is nothing to remove
+        self._shutdown_trigger = None
+        self.stop()
+
+    def _checkQueue(self):
+        if self.pending >= self.queue_size:
+            raise BackendError("Too many pending filesystem operations")
+
+    @deferred
+    def get_reader(self, file_name):
+        """
+        @see: L{IBackend.get_reader}
+
+        @rtype: L{Deferred}, yielding a L{ThreadedReader}
+
+        """
+        if not self.can_read:
+            raise Unsupported("Reading not supported")
+        target_path = self._targetPath(file_name)
+        self._checkQueue()
+        d = self.deferToThread(self._openReaderInThread, target_path)
+        d.addCallback(lambda result: ThreadedReader(result[0], result[1], self))
+        return d
+
+    def _openReaderInThread(self, target_path):
+        reader = FilesystemReader(target_path)
+        return reader, reader.size
+
+    def get_netascii_reader(self, file_name):
+        """
+        @see: L{FilesystemSynchronousBackend.get_netascii_reader}
+
+        @rtype: L{Deferred}, yielding a L{NetasciiSenderProxy}
+
+        """
+        d = self.get_reader(file_name)
+        d.addCallback(NetasciiSenderProxy)
+        return d
+
+    @deferred
+    def get_writer(self, file_name):
+        """
+        @see: L{IBackend.get_writer}
+
+        @rtype: L{Deferred}, yielding a L{ThreadedWriter}
+
+        """
+        if not self.can_write:
+            raise Unsupported("Writing not supported")
+        target_path = self._targetPath(file_name)
+        self._checkQueue()
+        d = self.deferToThread(self._openWriter, target_path)
+        d.addCallback(ThreadedWriter, self)
+        d.addCallback(self._bufferWriter)
+        return d
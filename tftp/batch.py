@@ -0,0 +1,303 @@
+'''
+Batched UDP I/O with recvmmsg(2)/sendmmsg(2) (Linux only).
+'''
+from twisted.internet import reactor, udp
+from twisted.internet.error import InvalidAddressError
+from twisted.python import log
+import ctypes
+import errno
+import socket
+import struct
+import sys
+
+BATCH_SIZE = 64
+# A socket of a single transfer only hears from one peer, which waits for
+# the server after every window, so it never has much to read at once
+SESSION_BATCH_SIZE = 8
+
+_SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+MSG_DONTWAIT = 0x40
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+_recvmmsg = _sendmmsg = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _recvmmsg, _sendmmsg = _libc.recvmmsg, _libc.sendmmsg
+    except (OSError, AttributeError):
+        pass
+    else:
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                              ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                              ctypes.c_uint, ctypes.c_int]
+
+supported = _sendmmsg is not None
+
+
+def encode_address(family, addr):
+    """Pack a C{(host, port)} address into a C{struct sockaddr}
+
+    @raise InvalidAddressError: if C{host} is not an address of this family
+
+    """
+    host, port = addr[:2]
+    try:
+        packed = socket.inet_pton(family, host)
+    except (OSError, ValueError):
+        raise InvalidAddressError(host, "not an address of the socket's family")
+    if family == socket.AF_INET6:
+        return (struct.pack('=H', family) + struct.pack('!HI', port, 0) +
+                packed + b'\x00' * 4)
+    return struct.pack('=H', family) + struct.pack('!H', port) + packed + b'\x00' * 8
+
+
+def decode_address(sockaddr):
+    """Unpack a C{struct sockaddr} into a C{(host, port)} address"""
+    family, = struct.unpack_from('=H', sockaddr)
+    port, = struct.unpack_from('!H', sockaddr, 2)
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(family, sockaddr[8:24]), port
+    return socket.inet_ntop(family, sockaddr[4:8]), port
+
+
+class _ReceiveBuffers(object):
+    """The C{recvmmsg} buffers for up to L{size} datagrams of up to
+    L{packet_size} bytes each.
+
+    @ivar size: the number of datagrams, that fit in
+    @type size: C{int}
+
+    @ivar packet_size: the size of every datagram buffer
+    @type packet_size: C{int}
+
+    """
+
+    def __init__(self, size, packet_size):
+        self.size = size
+        self.packet_size = packet_size
+        self.buffers = [ctypes.create_string_buffer(packet_size)
+                        for i in range(size)]
+        self.names = [ctypes.create_string_buffer(_SOCKADDR_SIZE)
+                      for i in range(size)]
+        self.iovecs = (_iovec * size)()
+        self.messages = (_mmsghdr * size)()
+        for i in range(size):
+            self.iovecs[i].iov_base = ctypes.addressof(self.buffers[i])
+            self.iovecs[i].iov_len = packet_size
+            hdr = self.messages[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+
+# packet_size -> _ReceiveBuffers, shared by all ports
+_receive_buffers = {}
+
+
+def _receiveBuffers(size, packet_size):
+    """Get the receive buffers for C{size} datagrams of up to C{packet_size}
+    bytes.
+
+    The buffers are only used inside of L{BatchedPort.doRead}, which runs to
+    completion before the reactor reads from another socket, so all ports
+    share them, instead of each of them holding on to C{size} *
+    C{packet_size} bytes of its own. They grow to the largest batch, that
+    has been asked for.
+
+    @rtype: L{_ReceiveBuffers}
+
+    """
+    buffers = _receive_buffers.get(packet_size)
+    if buffers is None or buffers.size < size:
+        buffers = _receive_buffers[packet_size] = _ReceiveBuffers(size, packet_size)
+    return buffers
+
+
+class BatchedPort(udp.Port):
+    """A UDP port, that receives up to L{batch_size} datagrams per system call
+    with C{recvmmsg} and sends the datagrams, that are written while the
+    received ones are being handled (the replies to them, for the most part),
+    with a single C{sendmmsg} at the end. L{writeDatagrams} sends several
+    datagrams at once at any time.
+
+    The receive buffers are shared with the other ports (see
+    L{_receiveBuffers}), so an idle port costs no more memory, than a
+    regular one.
+
+    @ivar batch_size: the maximum number of datagrams per system call
+    @type batch_size: C{int}
+
+    """
+
+    def __init__(self, port, proto, interface='', maxPacketSize=8192,
+                 reactor=None, batch_size=BATCH_SIZE):
+        udp.Port.__init__(self, port, proto, interface, maxPacketSize, reactor)
+        self.batch_size = batch_size
+        self._queue = None
+
+    def doRead(self):
+        """Called when my socket is ready for reading. Hands the received
+        datagrams to the protocol and then sends everything, that it wrote
+        in the meantime.
+
+        """
+        self._queue = []
+        try:
+            self._readBatches()
+        finally:
+            queue, self._queue = self._queue, None
+            if queue:
+                try:
+                    self._sendBatches(queue)
+                except Exception:
+                    log.err()
+
+    def _readBatches(self):
+        read = 0
+        while read < self.maxThroughput:
+            received = self._receiveBatch()
+            if received is None:
+                return
+            # The buffers have been copied out of, before the protocol gets
+            # to run any code, that might reuse them
+            for data, addr in received:
+                read += len(data)
+                try:
+                    self.protocol.datagramReceived(data, addr)
+                except BaseException:
+                    log.err()
+            if len(received) < self.batch_size:
+                # Drained the socket
+                return
+
+    def _receiveBatch(self):
+        """Receive up to L{batch_size} datagrams.
+
+        @return: the C{(datagram, addr)} pairs, that were received, or C{None},
+        if there was nothing to read
+        @rtype: C{list} of C{(bytes, (str, int))}
+
+        """
+        buffers = _receiveBuffers(self.batch_size, self.maxPacketSize)
+        messages = buffers.messages
+        for i in range(self.batch_size):
+            messages[i].msg_hdr.msg_namelen = _SOCKADDR_SIZE
+        count = _recvmmsg(self.fileno(), messages, self.batch_size,
+                          MSG_DONTWAIT, None)
+        if count < 0:
+            no = ctypes.get_errno()
+            if no in udp._sockErrReadIgnore:
+                return None
+            if no in udp._sockErrReadRefuse:
+                if self._connectedAddr:
+                    self.protocol.connectionRefused()
+                return None
+            raise OSError(no, errno.errorcode.get(no, ''))
+        received = []
+        for i in range(count):
+            message = messages[i]
+            data = ctypes.string_at(buffers.buffers[i], message.msg_len)
+            name = buffers.names[i].raw[:message.msg_hdr.msg_namelen]
+            received.append((data, decode_address(name)))
+        return received
+
+    def write(self, datagram, addr=None):
+        if self._queue is not None:
+            self._queue.append((datagram, addr))
+            return len(datagram)
+        return udp.Port.write(self, datagram, addr)
+
+    def writeDatagrams(self, datagrams, addr=None):
+        """Send several datagrams with as few system calls as possible.
+
+        @param datagrams: the datagrams to send
+        @type datagrams: C{list} of C{bytes}
+
+        @param addr: the destination address, may be C{None} in connected mode
+        @type addr: C{(str, int)}
+
+        """
+        pairs = [(datagram, addr) for datagram in datagrams]
+        if self._queue is not None:
+            self._queue.extend(pairs)
+        else:
+            self._sendBatches(pairs)
+
+    def _sendBatches(self, pairs):
+        while pairs:
+            sent = self._sendBatch(pairs[:self.batch_size])
+            if sent <= 0:
+                # Let the regular path deal with (or report) the error
+                udp.Port.write(self, *pairs[0])
+                sent = 1
+            pairs = pairs[sent:]
+
+    def _sendBatch(self, pairs):
+        count = len(pairs)
+        messages = (_mmsghdr * count)()
+        iovecs = (_iovec * count)()
+        keep = [] # the buffers must outlive the system call
+        names = {}
+        for i, (datagram, addr) in enumerate(pairs):
+            data = ctypes.c_char_p(datagram)
+            keep.append(data)
+            iovecs[i].iov_base = ctypes.cast(data, ctypes.c_void_p).value
+            iovecs[i].iov_len = len(datagram)
+            hdr = messages[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(iovecs[i])
+            hdr.msg_iovlen = 1
+            if self._connectedAddr:
+                assert addr in (None, self._connectedAddr)
+                continue
+            if addr not in names:
+                sockaddr = encode_address(self.addressFamily, addr)
+                names[addr] = ctypes.create_string_buffer(sockaddr, len(sockaddr))
+            hdr.msg_name = ctypes.addressof(names[addr])
+            hdr.msg_namelen = ctypes.sizeof(names[addr])
+        while True:
+            sent = _sendmmsg(self.fileno(), messages, count, 0)
+            if sent < 0 and ctypes.get_errno() == errno.EINTR:
+                continue
+            return sent
+
+
+def listenBatchedUDP(port, protocol, interface='', maxPacketSize=8192,
+                     batch_size=BATCH_SIZE, _reactor=None):
+    """Like L{listenUDP<twisted.internet.interfaces.IReactorUDP.listenUDP>},
+    but listens with a L{BatchedPort}.
+
+    @raise NotImplementedError: if the platform does not support
+    C{recvmmsg}/C{sendmmsg}
+
+    @return: the listening port
+    @rtype: L{BatchedPort}
+
+    """
+    if not supported:
+        raise NotImplementedError("recvmmsg/sendmmsg are not supported on this platform")
+    if _reactor is None:
+        _reactor = reactor
+    p = BatchedPort(port, protocol, interface, maxPacketSize, _reactor, batch_size)
+    p.startListening()
+    return p
@@ -3,10 +3,14 @@
 '''
 from tftp.datagram import (ACKDatagram, ERRORDatagram, ERR_TID_UNKNOWN,
     TFTPDatagramFactory, split_opcode, OP_OACK, OP_ERROR, OACKDatagram, OP_ACK,
-    OP_DATA)
-from tftp.session import WriteSession, MAX_BLOCK_SIZE, ReadSession
+    OP_DATA, ERR_DISK_FULL, ERR_NOT_DEFINED, decode_data, decode_ack)
+from tftp.errors import DiskFull, PayloadDecodeError
+from tftp.logger import logger
+from tftp.session import (WriteSession, MAX_BLOCK_SIZE, ReadSession,
+    MAX_WINDOW_SIZE)
 from tftp.util import SequentialCall
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.internet.protocol import DatagramProtocol
 from twisted.python import log
 from twisted.python.compat import intToBytes
@@ -23,6 +27,11 @@ class TFTPBootstrap(DatagramProtocol):
 
     @cvar supported_options: lists options, that we know how to handle
 
+    @cvar transfer_opcode: the opcode of the datagrams, that the session
+    receives during the transfer (DATA or ACK). Once the session has started,
+    these are handed to it directly, bypassing L{TFTPDatagramFactory}.
+    @type transfer_opcode: C{int}
+
     @ivar session: A L{WriteSession} or L{ReadSession} object, that will handle
     the actual tranfer, after the initial handshake and option negotiation is
     complete
@@ -47,8 +56,13 @@ class TFTPBootstrap(DatagramProtocol):
     @ivar backend: L{IReader} or L{IWriter} provider, that is used for this transfer
     @type backend: L{IReader} or L{IWriter} provider
 
+    @ivar stopped: fires, when this protocol instance stops listening, i.e.
+    when the transfer has ended in any way
+    @type stopped: L{Deferred}
+
     """
-    supported_options = (b'blksize', b'timeout', b'tsize')
+    supported_options = (b'blksize', b'timeout', b'tsize', b'windowsize')
+    transfer_opcode = None
 
     def __init__(self, remote, backend, options=None, _clock=None):
         if options is None:
@@ -59,11 +73,16 @@ class TFTPBootstrap(DatagramProtocol):
         self.remote = remote
         self.timeout_watchdog = None
         self.backend = backend
+        self.stopped = Deferred()
         if _clock is not None:
             self._clock = _clock
         else:
             self._clock = reactor
 
+    def stopProtocol(self):
+        if not self.stopped.called:
+            self.stopped.callback(None)
+
     def processOptions(self, options):
         """Process options mapping, discarding malformed or unknown options.
 
@@ -146,6 +165,28 @@ class TFTPBootstrap(DatagramProtocol):
             return None
         return intToBytes(int_tsize)
 
+    def option_windowsize(self, val):
+        """Process the window size option
+        (U{RFC7440<http://tools.ietf.org/html/rfc7440>}). Valid range is between 1
+        and 65535, inclusive. If the value is more, than L{MAX_WINDOW_SIZE},
+        L{MAX_WINDOW_SIZE} is returned instead.
+
+        @param val: value of the option
+        @type val: C{bytes}
+
+        @return: accepted option value or C{None}, if it is invalid
+        @rtype: C{bytes} or C{None}
+
+        """
+        try:
+            int_windowsize = int(val)
+        except ValueError:
+            return None
+        if int_windowsize < 1 or int_windowsize > 65535:
+            return None
+        int_windowsize = min((int_windowsize, MAX_WINDOW_SIZE))
+        return intToBytes(int_windowsize)
+
     def applyOptions(self, session, options):
         """Apply given options mapping to the given L{WriteSession} or
         L{ReadSession} object.
@@ -166,19 +207,51 @@ class TFTPBootstrap(DatagramProtocol):
             elif opt_name == b'tsize':
                 tsize = int(opt_val)
                 session.tsize = tsize
+            elif opt_name == b'windowsize':
+                session.window_size = int(opt_val)
 
     def datagramReceived(self, datagram, addr):
         if self.remote[1] != addr[1]:
             self.transport.write(ERRORDatagram.from_code(ERR_TID_UNKNOWN).to_wire())
             return# Does not belong to this transfer
+        if self.session.started:
+            # The bulk of the transfer. Decode the header right here and hand
+            # the block to the session, without creating a datagram object.
+            try:
+                if self.transfer_opcode == OP_DATA:
+                    blocknum, data = decode_data(datagram)
+                else:
+                    blocknum = decode_ack(datagram)
+            except PayloadDecodeError:
+                # Anything else (e.g. an ERROR) is decoded in full below
+                pass
+            else:
+                if self.transfer_opcode == OP_DATA:
+                    # IWriter.write takes bytes (NetasciiReceiverProxy
+                    # converts them, other writers may keep them), so the
+                    # block is copied out of the datagram once, right here
+                    return self.session.blockReceived(blocknum, data.tobytes())
+                return self.session.ackReceived(blocknum)
         datagram = TFTPDatagramFactory(*split_opcode(datagram))
-        # TODO: Disabled for the time being. Performance degradation
-        # and log file swamping was reported.
-        # log.msg("Datagram received from %s: %s" % (addr, datagram))
+        logger.debug("Datagram received from %s: %s", addr, datagram,
+                     client=addr[0], sampled=True)
         if datagram.opcode == OP_ERROR:
             return self.tftp_ERROR(datagram)
         return self._datagramReceived(datagram)
 
+    def sendHandshake(self, bytes):
+        """Send the datagram, that the remote peer has to respond to before the
+        transfer starts (OACK or initial ACK). The round trip is measured by the
+        L{RetransmissionPolicy<tftp.util.RetransmissionPolicy>} of the session, so
+        that the transfer starts with an estimate.
+
+        @param bytes: bytes to send
+        @type bytes: C{bytes}
+
+        """
+        self.session.retransmission.transmitted()
+        self.transport.write(bytes)
+
     def tftp_ERROR(self, datagram):
         """Handle the L{ERRORDatagram}.
 
@@ -186,7 +259,7 @@ class TFTPBootstrap(DatagramProtocol):
         @type datagram: L{ERRORDatagram}
 
         """
-        log.msg("Got error: %s" % datagram)
+        logger.warning("Got error: %s", datagram, client=self.remote[0])
         return self.cancel()
 
     def cancel(self):
@@ -204,7 +277,8 @@ class TFTPBootstrap(DatagramProtocol):
 
     def timedOut(self):
         """This protocol instance has timed out during the initial handshake."""
-        log.msg("Timed during option negotiation process")
+        logger.warning("Timed out during option negotiation process",
+                       client=self.remote[0])
         self.cancel()
 
 
@@ -213,9 +287,11 @@ class LocalOriginWriteSession(TFTPBootstrap):
     a read from a remote server
 
     """
+    transfer_opcode = OP_DATA
     def __init__(self, remote, writer, options=None, _clock=None):
         TFTPBootstrap.__init__(self, remote, writer, options, _clock)
         self.session = WriteSession(writer, self._clock)
+        self.session.client = remote[0]
 
     def startProtocol(self):
         """Connect the transport and start the L{timeout_watchdog}"""
@@ -236,7 +312,8 @@ class LocalOriginWriteSession(TFTPBootstrap):
                 self.timeout_watchdog.cancel()
             return self.transport.write(ACKDatagram(0).to_wire())
         else:
-            log.msg("Duplicate OACK received, send back ACK and ignore")
+            logger.debug("Duplicate OACK received, send back ACK and ignore",
+                         client=self.remote[0])
             self.transport.write(ACKDatagram(0).to_wire())
 
     def _datagramReceived(self, datagram):
@@ -259,33 +336,81 @@ class RemoteOriginWriteSession(TFTPBootstrap):
     received a WRQ from a client.
 
     """
+    transfer_opcode = OP_DATA
     timeout = (1, 3, 7)
 
     def __init__(self, remote, writer, options=None, _clock=None):
         TFTPBootstrap.__init__(self, remote, writer, options, _clock)
         self.session = WriteSession(writer, self._clock)
+        self.session.client = remote[0]
 
     def startProtocol(self):
         """Connect the transport, respond with an initial ACK or OACK (depending on
         if we were initialized with options or not).
 
+        If the client announced the size of the file (the I{tsize} option) and
+        the writer can reserve the room for it in advance (has C{allocate},
+        like L{FilesystemWriter<tftp.backend.FilesystemWriter>}), this is done
+        first, so that a file, that does not fit, is refused before the
+        transfer starts.
+
         """
         self.transport.connect(*self.remote)
         if self.options:
             self.resultant_options = self.processOptions(self.options)
+        if self.resultant_options:
             bytes = OACKDatagram(self.resultant_options).to_wire()
         else:
+            # None of the options were accepted, so no OACK (RFC 2347)
             bytes = ACKDatagram(0).to_wire()
+        tsize = self.resultant_options.get(b'tsize')
+        allocate = getattr(self.backend, 'allocate', None)
+        if tsize and allocate is not None:
+            d = maybeDeferred(allocate, int(tsize))
+            d.addCallbacks(lambda ign: self.startHandshake(bytes),
+                           self.allocationFailed)
+        else:
+            self.startHandshake(bytes)
+
+    def startHandshake(self, bytes):
+        """Send the OACK or the initial ACK, until the first DATA arrives.
+
+        @type bytes: C{bytes}
+
+        """
+        if self.transport is None:
+            # Cancelled in the meantime
+            return
         self.timeout_watchdog = SequentialCall.run(
             self.timeout[:-1],
-            callable=self.transport.write, callable_args=[bytes, ],
+            callable=self.sendHandshake, callable_args=[bytes, ],
             on_timeout=lambda: self._clock.callLater(self.timeout[-1], self.timedOut),
             run_now=True,
             _clock=self._clock
         )
 
+    def allocationFailed(self, failure):
+        """The room for the file could not be reserved. Refuse the transfer.
+
+        @type failure: L{Failure<twisted.python.failure.Failure>}
+
+        """
+        if failure.check(DiskFull):
+            logger.warning("Refused the upload from %s: %s", self.remote,
+                           failure.getErrorMessage(), client=self.remote[0])
+            error = ERRORDatagram.from_code(ERR_DISK_FULL)
+        else:
+            log.err(failure)
+            error = ERRORDatagram.from_code(ERR_NOT_DEFINED, b"Allocation failed")
+        self.transport.write(error.to_wire())
+        self.backend.cancel()
+        self.transport.stopListening()
+
     def _datagramReceived(self, datagram):
         if datagram.opcode == OP_DATA and datagram.blocknum == 1:
+            if self.timeout_watchdog is None:
+                # Still waiting for the allocation
+                return
             if self.timeout_watchdog.active():
                 self.timeout_watchdog.cancel()
             if not self.session.started:
@@ -302,9 +427,11 @@ class LocalOriginReadSession(TFTPBootstrap):
     a write to a remote server.
 
     """
+    transfer_opcode = OP_ACK
     def __init__(self, remote, reader, options=None, _clock=None):
         TFTPBootstrap.__init__(self, remote, reader, options, _clock)
         self.session = ReadSession(reader, self._clock)
+        self.session.client = remote[0]
 
     def startProtocol(self):
         """Connect the transport and start the L{timeout_watchdog}"""
@@ -342,18 +469,21 @@ class LocalOriginReadSession(TFTPBootstrap):
             self.session.startProtocol()
             return self.session.nextBlock()
         else:
-            log.msg("Duplicate OACK received, ignored")
+            logger.debug("Duplicate OACK received, ignored",
+                         client=self.remote[0])
 
 class RemoteOriginReadSession(TFTPBootstrap):
     """Bootstraps a L{ReadSession}, that was started remotely, - we've received
     a RRQ.
 
     """
+    transfer_opcode = OP_ACK
     timeout = (1, 3, 7)
 
     def __init__(self, remote, reader, options=None, _clock=None):
         TFTPBootstrap.__init__(self, remote, reader, options, _clock)
         self.session = ReadSession(reader, self._clock)
+        self.session.client = remote[0]
 
     def option_tsize(self, val):
         """Process tsize option.
@@ -373,16 +503,19 @@ class RemoteOriginReadSession(TFTPBootstrap):
 
     def startProtocol(self):
         """Start sending an OACK datagram if we were initialized with options
-        or start the L{ReadSession} immediately.
+        and any of them were accepted, or start the L{ReadSession} immediately
+        (an OACK with no options is not expected by the clients,
+        U{RFC2347<http://tools.ietf.org/html/rfc2347>}).
 
         """
         self.transport.connect(*self.remote)
         if self.options:
             self.resultant_options = self.processOptions(self.options)
+        if self.resultant_options:
             bytes = OACKDatagram(self.resultant_options).to_wire()
             self.timeout_watchdog = SequentialCall.run(
                 self.timeout[:-1],
-                callable=self.transport.write, callable_args=[bytes, ],
+                callable=self.sendHandshake, callable_args=[bytes, ],
                 on_timeout=lambda: self._clock.callLater(self.timeout[-1], self.timedOut),
                 run_now=True,
                 _clock=self._clock
@@ -409,6 +542,7 @@ class RemoteOriginReadSession(TFTPBootstrap):
         if self.timeout_watchdog is not None:
             self.timeout_watchdog.cancel()
         if not self.session.started:
+            self.session.retransmission.acknowledged()
             self.applyOptions(self.session, self.resultant_options)
             self.session.transport = self.transport
             self.session.startProtocol()
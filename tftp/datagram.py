@@ -24,6 +24,11 @@ ERR_FILE_EXISTS = 6
 ERR_NO_SUCH_USER = 7
 ERR_TERM_OPTION = 8
 
+# Precompiled formats of the opcode and of the opcode, followed by the block
+# number (DATA, ACK) or the error code (ERROR)
+OPCODE = struct.Struct('!H')
+HEADER = struct.Struct('!HH')
+
 errors = {
     ERR_NOT_DEFINED :       b"",
     ERR_FILE_NOT_FOUND  :   b"File not found",
@@ -50,11 +55,79 @@ def split_opcode(datagram):
     """
 
     try:
-        return struct.unpack(b"!H", datagram[:2])[0], datagram[2:]
+        return OPCODE.unpack_from(datagram)[0], datagram[2:]
     except struct.error:
         raise WireProtocolError("Failed to extract the opcode")
 
 
+def encode_data(blocknum, payload):
+    """Return the wire representation of a DATA datagram without creating
+    a L{DATADatagram} object.
+
+    @param blocknum: block number
+    @type blocknum: C{int}
+
+    @param payload: the data, any object, that supports the buffer protocol
+    @type payload: C{bytes} or C{memoryview}
+
+    @rtype: C{bytes}
+
+    """
+    return b''.join((HEADER.pack(OP_DATA, blocknum), payload))
+
+
+def encode_ack(blocknum):
+    """Return the wire representation of an ACK datagram without creating
+    an L{ACKDatagram} object.
+
+    @rtype: C{bytes}
+
+    """
+    return HEADER.pack(OP_ACK, blocknum)
+
+
+def decode_data(datagram):
+    """Extract the block number and the data from the wire representation of
+    a DATA datagram (opcode included) without copying the data.
+
+    @param datagram: raw datagram
+    @type datagram: C{bytes} or C{memoryview}
+
+    @return: a 2-tuple of the block number and a C{memoryview} of the data
+    @rtype: (C{int}, C{memoryview})
+
+    @raise PayloadDecodeError: if this is not a DATA datagram
+
+    """
+    try:
+        opcode, blocknum = HEADER.unpack_from(datagram)
+    except struct.error:
+        raise PayloadDecodeError("Unable to extract the block number")
+    if opcode != OP_DATA:
+        raise PayloadDecodeError("Not a DATA datagram")
+    return blocknum, memoryview(datagram)[4:]
+
+
+def decode_ack(datagram):
+    """Extract the block number from the wire representation of an ACK
+    datagram (opcode included).
+
+    @param datagram: raw datagram
+    @type datagram: C{bytes} or C{memoryview}
+
+    @rtype: C{int}
+
+    @raise PayloadDecodeError: if this is not an ACK datagram
+
+    """
+    if len(datagram) != HEADER.size:
+        raise PayloadDecodeError("Unable to extract the block number")
+    opcode, blocknum = HEADER.unpack(datagram)
+    if opcode != OP_ACK:
+        raise PayloadDecodeError("Not an ACK datagram")
+    return blocknum
+
+
 def assert_options_are_byte_strings(options):
     """Assert that all names and values in C{options} are C{bytes}.
 
@@ -76,6 +149,7 @@ class TFTPDatagram(object):
 
     """
 
+    __slots__ = ()
     opcode = None
 
     @classmethod
@@ -163,7 +237,7 @@ class RQDatagram(TFTPDatagram):
                                                self.filename, self.mode)
 
     def to_wire(self):
-        opcode = struct.pack(b"!H", self.opcode)
+        opcode = OPCODE.pack(self.opcode)
         if self.options:
             options = b'\x00'.join(chain.from_iterable(self.options.items()))
             return b''.join((opcode, self.filename, b'\x00', self.mode, b'\x00',
@@ -218,7 +292,7 @@ class OACKDatagram(TFTPDatagram):
         return ("<%s(options=%s)>" % (self.__class__.__name__, self.options))
 
     def to_wire(self):
-        opcode = struct.pack(b"!H", self.opcode)
+        opcode = OPCODE.pack(self.opcode)
         if self.options:
             options = b'\x00'.join(chain.from_iterable(self.options.items()))
             return b''.join((opcode, options, b'\x00'))
@@ -235,6 +309,7 @@ class DATADatagram(TFTPDatagram):
     @type data: C{bytes}
 
     """
+    __slots__ = ('blocknum', 'data')
     opcode = OP_DATA
 
     @classmethod
@@ -251,7 +326,7 @@ class DATADatagram(TFTPDatagram):
 
         """
         try:
-            blocknum, data = struct.unpack(b'!H', payload[:2])[0], payload[2:]
+            blocknum, data = OPCODE.unpack_from(payload)[0], payload[2:]
         except struct.error:
             raise PayloadDecodeError()
         return cls(blocknum, data)
@@ -266,7 +341,7 @@ class DATADatagram(TFTPDatagram):
                                                         self.blocknum, len(self.data))
 
     def to_wire(self):
-        return b''.join((struct.pack(b'!HH', self.opcode, self.blocknum), self.data))
+        return encode_data(self.blocknum, self.data)
 
 class ACKDatagram(TFTPDatagram):
     """An ACK datagram.
@@ -275,6 +350,7 @@ class ACKDatagram(TFTPDatagram):
     @type blocknum: C{int}
 
     """
+    __slots__ = ('blocknum',)
     opcode = OP_ACK
 
     @classmethod
@@ -291,7 +367,7 @@ class ACKDatagram(TFTPDatagram):
 
         """
         try:
-            blocknum = struct.unpack(b'!H', payload)[0]
+            blocknum = OPCODE.unpack(payload)[0]
         except struct.error:
             raise PayloadDecodeError("Unable to extract the block number")
         return cls(blocknum)
@@ -303,7 +379,7 @@ class ACKDatagram(TFTPDatagram):
         return "<%s(blocknum=%s)>" % (self.__class__.__name__, self.blocknum)
 
     def to_wire(self):
-        return struct.pack(b'!HH', self.opcode, self.blocknum)
+        return encode_ack(self.blocknum)
 
 class ERRORDatagram(TFTPDatagram):
     """An ERROR datagram.
@@ -316,6 +392,7 @@ class ERRORDatagram(TFTPDatagram):
     @type errmsg: C{bytes}
 
     """
+    __slots__ = ('errorcode', 'errmsg')
     opcode = OP_ERROR
 
     @classmethod
@@ -338,7 +415,7 @@ class ERRORDatagram(TFTPDatagram):
 
         """
         try:
-            errorcode = struct.unpack(b'!H', payload[:2])[0]
+            errorcode = OPCODE.unpack_from(payload)[0]
         except struct.error:
             raise PayloadDecodeError("Unable to extract the error code")
         if not errorcode in errors:
@@ -380,7 +457,7 @@ class ERRORDatagram(TFTPDatagram):
         self.errmsg = errmsg
 
     def to_wire(self):
-        return b''.join((struct.pack(b'!HH', self.opcode, self.errorcode),
+        return b''.join((HEADER.pack(self.opcode, self.errorcode),
                         self.errmsg, b'\x00'))
 
 class _TFTPDatagramFactory(object):
@@ -84,3 +84,12 @@ class FileExists(BackendError):
 
     def __str__(self):
         return "File already exists: %s" % self.file_path
+
+
+class DiskFull(BackendError):
+    """There is not enough room for the file, either on the disk or within
+    the limits of the backend.
+
+    Corresponds to the "(3) Disk full or allocation exceeded" TFTP error code.
+
+    """
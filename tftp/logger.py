@@ -0,0 +1,164 @@
+'''
+Logging of the per-request and per-datagram events, with log levels, lazy
+formatting, sampling and per-client rate limiting.
+'''
+from twisted.internet import reactor
+from twisted.python import log
+import random
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+levels = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+
+class Logger(object):
+    """Passes the messages, that get through the filters, to
+    L{twisted.python.log}. A message is formatted only if it is actually
+    logged, so the arguments should be passed separately, e.g.
+    C{logger.info("Datagram received from %s: %s", addr, datagram, client=addr)}.
+
+    The filters, in order:
+     - messages below L{level} are dropped
+     - messages, that were logged with C{sampled=True} (the ones, that are
+       logged for every request or datagram), are only logged with the
+       probability of L{sample_rate}
+     - if L{rate_limit} is not 0, every client (as given by the C{client}
+       keyword argument) may log up to L{rate_limit} messages per second, with
+       bursts of up to L{burst} messages. The number of suppressed messages is
+       reported, when the client may log again.
+
+    Messages of level L{ERROR} and above are never sampled out.
+
+    @ivar level: the minimum level of the logged messages
+    @type level: C{int}
+
+    @ivar sample_rate: the share of sampled messages, that are logged, between
+    0 and 1
+    @type sample_rate: C{float}
+
+    @ivar rate_limit: the maximum number of messages per second per client
+    (0 - not limited)
+    @type rate_limit: C{float}
+
+    @ivar burst: the number of messages, that a client may log at once, before
+    it is limited. Defaults to L{rate_limit}, but at least 1.
+    @type burst: C{float} or C{NoneType}
+
+    @cvar max_clients: how many clients to track for rate limiting. When this
+    many are tracked, the state of all of them is reset.
+    @type max_clients: C{int}
+
+    """
+    max_clients = 10000
+
+    def __init__(self, level=INFO, sample_rate=1.0, rate_limit=0, burst=None,
+                 _clock=None, _random=None):
+        self.level = level
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.burst = burst
+        if _clock is None:
+            self._clock = reactor
+        else:
+            self._clock = _clock
+        if _random is None:
+            self._random = random.random
+        else:
+            self._random = _random
+        self._buckets = {}
+
+    def configure(self, level=None, sample_rate=None, rate_limit=None, burst=None):
+        """Change the settings of this logger. Arguments, that are C{None}, are
+        left as they are.
+
+        """
+        if level is not None:
+            self.level = level
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if rate_limit is not None:
+            self.rate_limit = rate_limit
+            self._buckets.clear()
+        if burst is not None:
+            self.burst = burst
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def msg(self, level, format, *args, **kw):
+        """Log a message
+
+        @param level: the level of the message
+        @type level: C{int}
+
+        @param format: the message or a %-format string for C{args}
+
+        @keyword client: the client, that the message is about (any hashable,
+        usually the address or the host)
+
+        @keyword sampled: whether or not the message is subject to sampling
+        @type sampled: C{bool}
+
+        """
+        if level < self.level:
+            return
+        if (kw.get('sampled') and level < ERROR and self.sample_rate < 1 and
+                self._random() >= self.sample_rate):
+            return
+        if self.rate_limit:
+            client = kw.get('client')
+            suppressed = self._takeToken(client)
+            if suppressed is None:
+                return
+            if suppressed:
+                log.msg("Suppressed %d messages about %s" % (suppressed, client))
+        if args:
+            format = format % args
+        log.msg(format)
+
+    def _takeToken(self, client):
+        """Take a token from the bucket of the client.
+
+        @return: C{None}, if the message must be suppressed, or the number of
+        messages, that were suppressed before this one
+
+        """
+        now = self._clock.seconds()
+        burst = self.burst or max(self.rate_limit, 1)
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= self.max_clients:
+                self._buckets.clear()
+            bucket = self._buckets[client] = [burst, now, 0]
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            return None
+        bucket[0] = tokens - 1
+        suppressed, bucket[2] = bucket[2], 0
+        return suppressed
+
+    def debug(self, format, *args, **kw):
+        self.msg(DEBUG, format, *args, **kw)
+
+    def info(self, format, *args, **kw):
+        self.msg(INFO, format, *args, **kw)
+
+    def warning(self, format, *args, **kw):
+        self.msg(WARNING, format, *args, **kw)
+
+    def error(self, format, *args, **kw):
+        self.msg(ERROR, format, *args, **kw)
+
+
+logger = Logger()
@@ -0,0 +1,191 @@
+'''
+Serving many transfers through a small, fixed pool of UDP sockets.
+'''
+from tftp.batch import listenBatchedUDP
+from tftp.datagram import ERRORDatagram, ERR_TID_UNKNOWN
+from tftp.session import MAX_BLOCK_SIZE
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, maybeDeferred
+from twisted.internet.protocol import DatagramProtocol
+
+
+class SessionTransport(object):
+    """A transport for a single transfer, that shares the socket of a
+    L{SessionPort} with other transfers. Provides the parts of
+    L{IUDPTransport<twisted.internet.interfaces.IUDPTransport>}, that the
+    session and bootstrap classes use.
+
+    @ivar remote: address of the remote peer
+    @type remote: C{(str, int)}
+
+    """
+
+    def __init__(self, port, remote, protocol, _reactor=None):
+        self.port = port
+        self.remote = remote
+        self.protocol = protocol
+        if _reactor is None:
+            self._reactor = reactor
+        else:
+            self._reactor = _reactor
+
+    def write(self, datagram, addr=None):
+        if addr is None:
+            addr = self.remote
+        return self.port.transport.write(datagram, addr)
+
+    def writeDatagrams(self, datagrams, addr=None):
+        if addr is None:
+            addr = self.remote
+        write_datagrams = getattr(self.port.transport, 'writeDatagrams', None)
+        if write_datagrams is not None:
+            return write_datagrams(datagrams, addr)
+        for datagram in datagrams:
+            self.port.transport.write(datagram, addr)
+
+    def connect(self, host, port):
+        """The transfer is already bound to its remote peer, this is a no-op,
+        unless the remote peer is different.
+
+        """
+        if (host, port) != self.remote:
+            self.port.detach(self.remote, self.protocol)
+            self.remote = (host, port)
+            self.port.attach(self.remote, self.protocol)
+
+    def getHost(self):
+        return self.port.transport.getHost()
+
+    def stopListening(self):
+        """Detach the transfer from the shared socket. The socket keeps
+        serving other transfers.
+
+        Like a real port, the protocol is stopped on the next iteration of
+        the reactor, so that a transfer may stop while it is still starting
+        (from within C{startProtocol}).
+
+        """
+        if self.port.detach(self.remote, self.protocol):
+            self._reactor.callLater(0, self.protocol.doStop)
+    loseConnection = stopListening
+
+
+class SessionPort(DatagramProtocol):
+    """One of the sockets of a L{SessionMultiplexer}. Routes incoming datagrams
+    to transfers by the address of the remote peer.
+
+    @ivar protocols: a mapping of remote addresses to the protocols, that
+    handle the transfers with them
+    @type protocols: C{dict}
+
+    """
+    noisy = False
+
+    def __init__(self):
+        self.protocols = {}
+
+    def attach(self, remote, protocol):
+        self.protocols[remote] = protocol
+
+    def detach(self, remote, protocol):
+        """Stop routing datagrams from C{remote} to C{protocol}
+
+        @return: whether or not C{protocol} was attached
+        @rtype: C{bool}
+
+        """
+        if self.protocols.get(remote) is protocol:
+            del self.protocols[remote]
+            return True
+        return False
+
+    def datagramReceived(self, datagram, addr):
+        protocol = self.protocols.get(addr)
+        if protocol is None:
+            # Does not belong to any transfer
+            self.transport.write(
+                ERRORDatagram.from_code(ERR_TID_UNKNOWN).to_wire(), addr)
+            return
+        protocol.datagramReceived(datagram, addr)
+
+
+class SessionMultiplexer(object):
+    """Serves transfers through a fixed pool of UDP sockets, instead of
+    listening on a new one for every transfer. A transfer is identified by the
+    address of the remote peer and the local port (TID) of the socket, that it
+    was assigned to, so a remote peer may have one transfer per socket at a time.
+
+    @param size: the number of sockets in the pool
+    @type size: C{int}
+
+    @param interface: the local address to bind the sockets to
+    @type interface: C{str}
+
+    @param batch_size: if not 0, the sockets send and receive up to this many
+    datagrams per system call (see L{BatchedPort<tftp.batch.BatchedPort>})
+    @type batch_size: C{int}
+
+    @ivar ports: the sockets of the pool, once L{start}ed
+    @type ports: C{list} of L{SessionPort}
+
+    """
+
+    def __init__(self, size=4, interface='', batch_size=0, _reactor=None):
+        self.size = size
+        self.interface = interface
+        self.batch_size = batch_size
+        self.ports = []
+        if _reactor is None:
+            self._reactor = reactor
+        else:
+            self._reactor = _reactor
+
+    def start(self):
+        """Start listening on the sockets of the pool"""
+        for i in range(self.size - len(self.ports)):
+            port = SessionPort()
+            if self.batch_size:
+                listenBatchedUDP(0, port, self.interface, MAX_BLOCK_SIZE + 4,
+                                 self.batch_size, _reactor=self._reactor)
+            else:
+                self._reactor.listenUDP(0, port, self.interface,
+                                        maxPacketSize=MAX_BLOCK_SIZE + 4)
+            self.ports.append(port)
+
+    def stop(self):
+        """Stop listening on the sockets of the pool.
+
+        @return: a L{Deferred}, that fires when all sockets are closed
+        @rtype: L{Deferred}
+
+        """
+        ports, self.ports = self.ports, []
+        # The sockets, that were already closed, have no transport
+        return DeferredList([maybeDeferred(port.transport.stopListening)
+                             for port in ports if port.transport is not None])
+
+    def attach(self, protocol, remote):
+        """Start a transfer with the remote peer on the least busy socket, that
+        does not have a transfer with that peer already. If there is no such
+        socket, the transfer gets a socket of its own.
+
+        @param protocol: the protocol, that will handle the transfer
+        @type protocol: L{DatagramProtocol}
+
+        @param remote: address of the remote peer
+        @type remote: C{(str, int)}
+
+        @return: the transport of the transfer
+
+        """
+        if not self.ports:
+            self.start()
+        candidates = [port for port in self.ports if remote not in port.protocols]
+        if not candidates:
+            return self._reactor.listenUDP(0, protocol, self.interface)
+        port = min(candidates, key=lambda p: len(p.protocols))
+        port.attach(remote, protocol)
+        transport = SessionTransport(port, remote, protocol,
+                                     _reactor=self._reactor)
+        protocol.makeConnection(transport)
+        return transport
@@ -9,7 +9,7 @@ from twisted.internet.defer import maybeDeferred, succeed
 import os
 import re
 
-__all__ = ['NetasciiSenderProxy', 'NetasciiReceiverProxy',
+__all__ = ['NetasciiSenderProxy', 'NetasciiReceiverProxy', 'NetasciiEncoder',
            'to_netascii', 'from_netascii']
 
 CR = b'\x0d'
@@ -34,12 +34,27 @@ def _convert_from_netascii(match_obj):
     elif match_obj.group(0) == CRNUL:
         return CR
 
+def _from_netascii_re(data):
+    """The reference implementation of L{from_netascii}, that calls back into
+    Python for every match.
+
+    """
+    return re_from_netascii.sub(_convert_from_netascii, data)
+
 def from_netascii(data):
     """Convert a netascii-encoded string into a string with platform-specific
     newlines.
 
     """
-    return re_from_netascii.sub(_convert_from_netascii, data)
+    # Any bytes-like object will do, just as with re.sub. Does not copy bytes.
+    data = bytes(data)
+    # CR+LF and CR+NUL never overlap. The CR+NUL sequences are taken out first,
+    # so that a newline, that ends with a CR, is not mistaken for a part of one.
+    # split/join is used instead of replace, because it only scans the data once.
+    parts = data.split(CRNUL)
+    if len(parts) == 1:
+        return NL.join(data.split(CRLF))
+    return CR.join([NL.join(part.split(CRLF)) for part in parts])
 
 # So that I can easily switch the NL around in tests. This is done with
 # replace(...) rather than interpolation because Python 3 prior to 3.5 lacks
@@ -53,9 +68,20 @@ def _convert_to_netascii(match_obj):
     elif match_obj.group(0) == CR:
         return CRNUL
 
+def _to_netascii_re(data):
+    """The reference implementation of L{to_netascii}, that calls back into
+    Python for every match.
+
+    """
+    return re_to_netascii.sub(_convert_to_netascii, data)
+
 def to_netascii(data):
     """Convert a string with platform-specific newlines into netascii."""
-    return re_to_netascii.sub(_convert_to_netascii, data)
+    data = bytes(data)
+    if CR not in NL:
+        return data.replace(CR, CRNUL).replace(NL, CRLF)
+    # A CR, that is a part of a newline, must not become CR+NUL
+    return CRLF.join(part.replace(CR, CRNUL) for part in data.split(NL))
 
 class NetasciiReceiverProxy(object):
     """Proxies an object, that provides L{IWriter}. Incoming data is transformed
@@ -86,24 +112,65 @@ class NetasciiReceiverProxy(object):
         """
         if self._carry_cr:
             data = CR + data
-        data = from_netascii(data)
-        if data.endswith(CR):
+        # Only a CR, that ends the received data, may be the first half of a
+        # sequence. The one, that ends the converted data, may come from a
+        # CR+NUL and must not be converted again.
+        if data[-1:] == CR:
             self._carry_cr = True
-            return maybeDeferred(self.writer.write, data[:-1])
+            return maybeDeferred(self.writer.write, from_netascii(data[:-1]))
         else:
             self._carry_cr = False
-            return maybeDeferred(self.writer.write, data)
+            return maybeDeferred(self.writer.write, from_netascii(data))
 
     def __getattr__(self, name):
         return getattr(self.writer, name)
 
 
+class NetasciiEncoder(object):
+    """Converts a stream of data into netascii chunk by chunk. If the newline is
+    more, than one byte long (CR+LF), a chunk may end with a part of it, so the
+    end of a chunk, that may be the beginning of a newline, is held back until
+    the next chunk.
+
+    """
+
+    def __init__(self):
+        self._pending = b''
+
+    def encode(self, data, final=False):
+        """Convert the next chunk.
+
+        @param data: the next chunk of the stream
+        @type data: C{bytes}
+
+        @param final: whether or not this is the last chunk. The data, that
+        was held back, is converted as it is then.
+        @type final: C{bool}
+
+        @return: the converted data, that is known by now
+        @rtype: C{bytes}
+
+        """
+        if self._pending:
+            data, self._pending = self._pending + data, b''
+        if not final:
+            for i in range(len(NL) - 1, 0, -1):
+                if data.endswith(NL[:i]):
+                    data, self._pending = data[:-i], data[-i:]
+                    break
+        return to_netascii(data)
+
+
 class NetasciiSenderProxy(object):
     """Proxies an object, that provides L{IReader}. The data that is read is
     transformed as follows:
         - platform-specific newlines are replaced with CR+LF
         - freestanding CR are replaced with CR+NUL
 
+    The converted data, that is left over after a read, is kept in a buffer
+    and a cursor is moved along it. The buffer is compacted only when most of
+    it has been read, so that the leftover is not copied on every read.
+
     @param reader: an L{IReader} object
     @type reader: L{IReader} provider
 
@@ -111,11 +178,27 @@ class NetasciiSenderProxy(object):
 
     def __init__(self, reader):
         self.reader = reader
-        self.buffer = b''
+        self._encoder = NetasciiEncoder()
+        self._buffer = bytearray()
+        self._offset = 0
+        self._eof = False
+
+    @property
+    def size(self):
+        """The size of the converted data is not known, until all of it has
+        been read (and the size of the reader is not it), so this is always
+        C{None}.
+
+        @see: L{IReader.size<tftp.backend.IReader.size>}
+
+        """
+        return None
 
     def read(self, size):
         """Attempt to read C{size} bytes, transforming them as described in
-        L{NetasciiSenderProxy}.
+        L{NetasciiSenderProxy}. Reads no more from the reader, than it takes
+        to fill the block (every byte of the original data is at least one byte
+        of the converted data).
 
         @param size: number of bytes to read
         @type size: C{int}
@@ -126,17 +209,34 @@ class NetasciiSenderProxy(object):
         @rtype: L{Deferred}
 
         """
-        need_bytes = size - len(self.buffer)
-        if need_bytes <= 0:
-            data, self.buffer = self.buffer[:size], self.buffer[size:]
-            return succeed(data)
+        need_bytes = size - (len(self._buffer) - self._offset)
+        if need_bytes <= 0 or self._eof:
+            return succeed(self._take(size))
         d = maybeDeferred(self.reader.read, need_bytes)
-        d.addCallback(self._gotDataFromReader, size)
+        d.addCallback(self._gotDataFromReader, need_bytes, size)
         return d
 
-    def _gotDataFromReader(self, data, size):
-        data = self.buffer + to_netascii(data)
-        data, self.buffer = data[:size], data[size:]
+    def _gotDataFromReader(self, data, need_bytes, size):
+        # A short read means, that there is no more data
+        self._eof = len(data) < need_bytes
+        self._buffer += self._encoder.encode(bytes(data), self._eof)
+        if not self._eof and len(self._buffer) - self._offset < size:
+            # The end of the data was held back by the encoder
+            return self.read(size)
+        return self._take(size)
+
+    def _take(self, size):
+        start = self._offset
+        end = min(start + size, len(self._buffer))
+        data = bytes(self._buffer[start:end])
+        if end == len(self._buffer):
+            del self._buffer[:]
+            self._offset = 0
+        elif end > len(self._buffer) // 2:
+            del self._buffer[:end]
+            self._offset = 0
+        else:
+            self._offset = end
         return data
 
     def __getattr__(self, name):
@@ -1,13 +1,16 @@
 '''
 @author: shylent
 '''
+from tftp.batch import listenBatchedUDP, SESSION_BATCH_SIZE
 from tftp.bootstrap import RemoteOriginWriteSession, RemoteOriginReadSession
 from tftp.datagram import (TFTPDatagramFactory, split_opcode, OP_WRQ,
     ERRORDatagram, ERR_NOT_DEFINED, ERR_ACCESS_VIOLATION, ERR_FILE_EXISTS,
     ERR_ILLEGAL_OP, OP_RRQ, ERR_FILE_NOT_FOUND)
 from tftp.errors import (FileExists, Unsupported, AccessViolation, BackendError,
     FileNotFound)
+from tftp.logger import logger
 from tftp.netascii import NetasciiReceiverProxy, NetasciiSenderProxy
+from tftp.util import TimerWheel
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.protocol import DatagramProtocol
@@ -23,21 +26,60 @@ class TFTP(DatagramProtocol):
     local resources
     @type backend: L{IBackend} provider
 
+    @ivar multiplexer: if not C{None}, the sessions are served through the
+    sockets of this L{SessionMultiplexer<tftp.multiplex.SessionMultiplexer>},
+    instead of a new socket per session
+    @type multiplexer: L{SessionMultiplexer<tftp.multiplex.SessionMultiplexer>}
+
+    @ivar batch_size: if not 0, the sockets of the sessions send and receive up
+    to this many datagrams per system call (see L{BatchedPort<tftp.batch.BatchedPort>}).
+    The socket of a single session uses at most
+    L{SESSION_BATCH_SIZE<tftp.batch.SESSION_BATCH_SIZE>}.
+    @type batch_size: C{int}
+
+    @ivar read_ahead: the number of blocks, that the read sessions read in
+    advance, while the current ones are in flight (see
+    L{ReadSession.read_ahead<tftp.session.ReadSession.read_ahead>})
+    @type read_ahead: C{int}
+
+    A request is remembered, while its session is starting or running. Copies
+    of it, that arrive in the meantime (a client retransmitting its RRQ/WRQ,
+    because the first OACK/DATA is slow to arrive), are dropped instead of
+    starting another session. The running session answers the client in due
+    time. Once the session has ended (completed, failed, timed out or been
+    aborted by the client), the same request starts a new one.
+
     """
-    def __init__(self, backend, _clock=None):
+
+    def __init__(self, backend, _clock=None, multiplexer=None, batch_size=0,
+                 read_ahead=0):
         self.backend = backend
+        self.multiplexer = multiplexer
+        self.batch_size = batch_size
+        self.read_ahead = read_ahead
         if _clock is None:
             self._clock = reactor
         else:
             self._clock = _clock
+        # Retransmissions and timeouts of all sessions share a single wheel
+        self._timers = TimerWheel(_clock=self._clock)
+        # (addr, opcode, filename, options) of the requests in progress
+        self._requests = set()
 
     def startProtocol(self):
         addr = self.transport.getHost()
         log.msg("TFTP Listener started at %s:%s" % (addr.host, addr.port))
+        if self.multiplexer is not None:
+            self.multiplexer.start()
+
+    def stopProtocol(self):
+        if self.multiplexer is not None:
+            self.multiplexer.stop()
 
     def datagramReceived(self, datagram, addr):
         datagram = TFTPDatagramFactory(*split_opcode(datagram))
-        log.msg("Datagram received from %s: %s" % (addr, datagram))
+        logger.info("Datagram received from %s: %s", addr, datagram,
+                    client=addr[0], sampled=True)
 
         mode = datagram.mode.lower()
         if mode not in (b'netascii', b'octet'):
@@ -47,8 +89,37 @@ class TFTP(DatagramProtocol):
             return self.transport.write(ERRORDatagram.from_code(
                 ERR_ILLEGAL_OP, errmsg.encode("ascii", "replace")).to_wire(), addr)
 
+        if not self._registerRequest(datagram, addr):
+            logger.debug("Duplicate request from %s ignored", addr,
+                         client=addr[0])
+            return
         self._clock.callLater(0, self._startSession, datagram, addr, mode)
 
+    def _requestKey(self, datagram, addr):
+        return (addr, datagram.opcode, datagram.filename,
+                frozenset(datagram.options.items()))
+
+    def _registerRequest(self, datagram, addr):
+        """Remember the request, unless it is a copy of one, that is being
+        served.
+
+        @return: C{False} if the request is a duplicate, C{True} otherwise
+        @rtype: C{bool}
+
+        """
+        key = self._requestKey(datagram, addr)
+        if key in self._requests:
+            return False
+        self._requests.add(key)
+        return True
+
+    def _forgetRequest(self, datagram, addr):
+        """Forget a request, that could not be served or whose session has
+        ended, so that its copies are served again.
+
+        """
+        self._requests.discard(self._requestKey(datagram, addr))
+
     @inlineCallbacks
     def _startSession(self, datagram, addr, mode):
         # Set up a call context so that we can pass extra arbitrary
@@ -61,12 +132,22 @@ class TFTP(DatagramProtocol):
             context["local"] = local.host, local.port
             context["remote"] = addr
         try:
-            if datagram.opcode == OP_WRQ:
-                fs_interface = yield call(
-                    context, self.backend.get_writer, datagram.filename)
-            elif datagram.opcode == OP_RRQ:
-                fs_interface = yield call(
-                    context, self.backend.get_reader, datagram.filename)
+            try:
+                if datagram.opcode == OP_WRQ:
+                    fs_interface = yield call(
+                        context, self.backend.get_writer, datagram.filename)
+                elif datagram.opcode == OP_RRQ:
+                    get_reader = self.backend.get_reader
+                    if mode == b'netascii':
+                        # Let the backend convert (and cache the converted
+                        # files), if it can
+                        get_reader = getattr(self.backend, 'get_netascii_reader',
+                                             get_reader)
+                    fs_interface = yield call(
+                        context, get_reader, datagram.filename)
+            except Exception:
+                self._forgetRequest(datagram, addr)
+                raise
         except Unsupported as e:
             self.transport.write(ERRORDatagram.from_code(ERR_ILLEGAL_OP,
                 u"{}".format(e).encode("ascii", "replace")).to_wire(), addr)
@@ -84,13 +165,28 @@ class TFTP(DatagramProtocol):
                 if mode == b'netascii':
                     fs_interface = NetasciiReceiverProxy(fs_interface)
                 session = RemoteOriginWriteSession(addr, fs_interface,
-                                                   datagram.options, _clock=self._clock)
-                reactor.listenUDP(0, session)
-                returnValue(session)
+                                                   datagram.options, _clock=self._timers)
             elif datagram.opcode == OP_RRQ:
-                if mode == b'netascii':
+                if (mode == b'netascii' and
+                        not hasattr(self.backend, 'get_netascii_reader')):
                     fs_interface = NetasciiSenderProxy(fs_interface)
                 session = RemoteOriginReadSession(addr, fs_interface,
-                                                  datagram.options, _clock=self._clock)
-                reactor.listenUDP(0, session)
-                returnValue(session)
+                                                  datagram.options, _clock=self._timers)
+                session.session.read_ahead = self.read_ahead
+            session.stopped.addCallback(
+                lambda ign: self._forgetRequest(datagram, addr))
+            try:
+                self._listen(session, addr)
+            except Exception:
+                self._forgetRequest(datagram, addr)
+                raise
+            returnValue(session)
+
+    def _listen(self, session, addr):
+        if self.multiplexer is None:
+            if self.batch_size:
+                return listenBatchedUDP(
+                    0, session,
+                    batch_size=min(self.batch_size, SESSION_BATCH_SIZE))
+            return reactor.listenUDP(0, session)
+        return self.multiplexer.attach(session, addr)
@@ -1,15 +1,19 @@
 '''
 @author: shylent
 '''
-from tftp.datagram import (ACKDatagram, ERRORDatagram, OP_DATA, OP_ERROR, ERR_ILLEGAL_OP,
-    ERR_DISK_FULL, OP_ACK, DATADatagram, ERR_NOT_DEFINED,)
-from tftp.util import SequentialCall
+from tftp.datagram import (ERRORDatagram, OP_DATA, OP_ERROR, ERR_ILLEGAL_OP,
+    ERR_DISK_FULL, OP_ACK, ERR_NOT_DEFINED, encode_ack, encode_data)
+from collections import deque
+from tftp.logger import logger
+from tftp.util import SequentialCall, RetransmissionPolicy
 from twisted.internet import reactor
-from twisted.internet.defer import maybeDeferred
+from twisted.internet.defer import Deferred, fail, maybeDeferred
 from twisted.internet.protocol import DatagramProtocol
 from twisted.python import log
+from twisted.python.failure import Failure
 
 MAX_BLOCK_SIZE = 8192
+MAX_WINDOW_SIZE = 64
 
 
 class WriteSession(DatagramProtocol):
@@ -27,25 +31,52 @@ class WriteSession(DatagramProtocol):
     When (if) the iterable is exhausted, the transfer is considered failed.
     @type timeout: any iterable
 
+    @cvar window_size: The number of consecutive DATA datagrams, that are
+    acknowledged with a single ACK. Default: 1 (every block is acknowledged, as
+    per U{RFC1350<http://tools.ietf.org/html/rfc1350>}). Larger values are
+    negotiated with the I{windowsize} option
+    (U{RFC7440<http://tools.ietf.org/html/rfc7440>}).
+    @type window_size: C{int}
+
+    @cvar client: the host of the remote peer, that the log messages of this
+    session are attributed to (for rate limiting). Set by the bootstrap
+    protocol.
+    @type client: C{str}
+
     @ivar started: whether or not this protocol has started
     @type started: C{bool}
 
+    @ivar retransmission: adapts the retransmission timeouts to the measured
+    round-trip time. L{timeout} values serve as upper bounds.
+    @type retransmission: L{RetransmissionPolicy}
+
+    @ivar bytes_received: the number of bytes, that were received so far. It is
+    compared with L{tsize}, when the transfer is complete.
+    @type bytes_received: C{int}
+
     """
 
     block_size = 512
     timeout = (1, 3, 7)
     tsize = None
+    window_size = 1
+    client = None
 
     def __init__(self, writer, _clock=None):
         self.writer = writer
         self.blocknum = 0
+        self.bytes_received = 0
         self.completed = False
         self.started = False
         self.timeout_watchdog = None
+        self._window_received = 0
+        self._gap_acked = False
+        self._finishing = False
         if _clock is None:
             self._clock = reactor
         else:
             self._clock = _clock
+        self.retransmission = RetransmissionPolicy(self._clock)
 
     def cancel(self):
         """Cancel this session, discard any data, that was collected
@@ -69,7 +100,7 @@ class WriteSession(DatagramProtocol):
         if datagram.opcode == OP_DATA:
             return self.tftp_DATA(datagram)
         elif datagram.opcode == OP_ERROR:
-            log.msg("Got error: %s" % datagram)
+            logger.warning("Got error: %s", datagram, client=self.client)
             self.cancel()
 
     def tftp_DATA(self, datagram):
@@ -77,66 +108,153 @@ class WriteSession(DatagramProtocol):
 
         @type datagram: L{DATADatagram}
 
+        @see: L{blockReceived}
+
+        """
+        return self.blockReceived(datagram.blocknum, datagram.data)
+
+    def blockReceived(self, blocknum, data):
+        """Handle a block of data, that arrived in a DATA datagram.
+
+        If a window size larger, than 1 was negotiated, a block, that arrives
+        ahead of the expected one means, that some blocks of the window were lost.
+        The last block, that was received in order, is acknowledged (once per gap),
+        so that the sender may continue from there.
+
+        @param blocknum: block number
+        @type blocknum: C{int}
+
+        @param data: contents of the block
+        @type data: C{bytes}
+
         """
+        if self._finishing:
+            # Nothing may be acknowledged, until the file is stored
+            return
         next_blocknum = self.blocknum + 1
-        if datagram.blocknum < next_blocknum:
-            self.transport.write(ACKDatagram(datagram.blocknum).to_wire())
-        elif datagram.blocknum == next_blocknum:
+        if blocknum < next_blocknum:
+            if self.window_size == 1:
+                self.transport.write(encode_ack(blocknum))
+            elif blocknum == self.blocknum:
+                # The end of a window, that we have already acknowledged, was
+                # sent again, so our ACK must have been lost
+                self.sendAck(encode_ack(self.blocknum))
+        elif blocknum == next_blocknum:
             if self.completed:
                 self.transport.write(ERRORDatagram.from_code(
                     ERR_ILLEGAL_OP, b"Transfer already finished").to_wire())
             else:
-                return self.nextBlock(datagram)
+                return self.nextBlock(blocknum, data)
+        elif self.window_size > 1:
+            if not self._gap_acked:
+                self._gap_acked = True
+                self.sendAck(encode_ack(self.blocknum))
         else:
             self.transport.write(ERRORDatagram.from_code(
                 ERR_ILLEGAL_OP, b"Block number mismatch").to_wire())
 
-    def nextBlock(self, datagram):
-        """Handle fresh data, attempt to write it to backend
+    def nextBlock(self, blocknum, data):
+        """Handle fresh data, attempt to write it to backend. If the writer
+        does not return a L{Deferred}, the write is finished right away.
 
-        @type datagram: L{DATADatagram}
+        @type blocknum: C{int}
+        @type data: C{bytes}
 
         """
         if self.timeout_watchdog is not None and self.timeout_watchdog.active():
             self.timeout_watchdog.cancel()
         self.blocknum += 1
-        d = maybeDeferred(self.writer.write, datagram.data)
-        d.addCallbacks(callback=self.blockWriteSuccess, callbackArgs=[datagram, ],
-                       errback=self.blockWriteFailure)
-        return d
-
-    def blockWriteSuccess(self, ign, datagram):
+        self.bytes_received += len(data)
+        self._window_received += 1
+        self._gap_acked = False
+        self.retransmission.acknowledged()
+        try:
+            result = self.writer.write(data)
+        except Exception:
+            return self.blockWriteFailure(Failure())
+        if isinstance(result, Deferred):
+            result.addCallbacks(callback=self.blockWriteSuccess,
+                                callbackArgs=[blocknum, data],
+                                errback=self.blockWriteFailure)
+            return result
+        if isinstance(result, Failure):
+            return self.blockWriteFailure(result)
+        # A synchronous writer, no need for a Deferred
+        return self.blockWriteSuccess(result, blocknum, data)
+
+    def blockWriteSuccess(self, ign, blocknum, data):
         """The write was successful, respond with ACK for current block number
 
-        If this is the last chunk (received data length < block size), the protocol
-        will keep running until the end of current timeout period, so we can respond
-        to any duplicates.
+        If this is the last chunk (received data length < block size), the writer
+        is finished and the ACK is sent, once it has stored the file (see
+        L{writerFinished}).
 
-        @type datagram: L{DATADatagram}
+        If the current window is not complete yet, no ACK is sent right away. It
+        is only sent if the next block does not arrive in time.
+
+        With a window, the next blocks may arrive, while the write of this one
+        is still in progress. The ACK and the timeout cycle are then left to
+        the write of the latest block.
+
+        @type blocknum: C{int}
+        @type data: C{bytes}
 
         """
-        bytes = ACKDatagram(datagram.blocknum).to_wire()
-        if len(datagram.data) < self.block_size:
-            self._clock.callLater(0, self.sendData, bytes)
-            self.timeout_watchdog = SequentialCall.run(self.timeout[:-1],
-                callable=lambda: None,
-                on_timeout=lambda: self._clock.callLater(self.timeout[-1], self.timedOut),
-                run_now=False,
-                _clock=self._clock
-            )
+        if blocknum != self.blocknum:
+            return
+        if self.timeout_watchdog is not None and self.timeout_watchdog.active():
+            self.timeout_watchdog.cancel()
+        bytes = encode_ack(blocknum)
+        if len(data) < self.block_size:
             self.completed = True
-            self.writer.finish()
-            # TODO: If self.tsize is not None, compare it with the actual
-            # count of bytes written. Log if there's a mismatch. Should it
-            # also emit an error datagram?
+            # The last ACK tells the client, that the file was stored, so it
+            # waits for the writer to flush its data
+            self._finishing = True
+            d = maybeDeferred(self.writer.finish)
+            d.addCallbacks(callback=self.writerFinished, callbackArgs=[bytes],
+                           errback=self.writerFinishFailure)
+            return d
         else:
-            self.timeout_watchdog = SequentialCall.run(self.timeout[:-1],
-                callable=self.sendData, callable_args=[bytes, ],
+            window_complete = self._window_received >= self.window_size
+            self.timeout_watchdog = SequentialCall.run(
+                self.retransmission.timeouts(self.timeout[:-1]),
+                callable=self.sendAck, callable_args=[bytes, ],
                 on_timeout=lambda: self._clock.callLater(self.timeout[-1], self.timedOut),
-                run_now=True,
+                run_now=window_complete,
                 _clock=self._clock
             )
 
+    def writerFinished(self, ign, bytes):
+        """The writer has stored the file, acknowledge the last block. The
+        protocol keeps running until the end of the current timeout period,
+        so that it can respond to any duplicates.
+
+        @param bytes: the ACK datagram for the last block
+        @type bytes: C{bytes}
+
+        """
+        self._finishing = False
+        self._clock.callLater(0, self.sendData, bytes)
+        self.timeout_watchdog = SequentialCall.run(self.timeout[:-1],
+            callable=lambda: None,
+            on_timeout=lambda: self._clock.callLater(self.timeout[-1], self.timedOut),
+            run_now=False,
+            _clock=self._clock
+        )
+        if self.tsize is not None and self.tsize != self.bytes_received:
+            logger.warning("Transfer size mismatch: %s bytes were announced, "
+                           "%s bytes were received", self.tsize,
+                           self.bytes_received, client=self.client)
+
+    def writerFinishFailure(self, failure):
+        """The writer could not store the file (e.g. the buffered data did not
+        fit on the disk). The client is told, instead of the last ACK.
+
+        """
+        self._finishing = False
+        self.completed = False
+        return self.blockWriteFailure(failure)
+
     def blockWriteFailure(self, failure):
         """Write failed"""
         log.err(failure)
@@ -149,10 +267,12 @@ class WriteSession(DatagramProtocol):
 
         """
         if not self.completed:
-            log.msg("Timed out while waiting for next block")
+            logger.warning("Timed out while waiting for next block",
+                           client=self.client)
             self.writer.cancel()
         else:
-            log.msg("Timed out after a successful transfer")
+            logger.debug("Timed out after a successful transfer",
+                         client=self.client)
         self.transport.stopListening()
 
     def sendData(self, bytes):
@@ -164,6 +284,18 @@ class WriteSession(DatagramProtocol):
         """
         self.transport.write(bytes)
 
+    def sendAck(self, bytes):
+        """Send an ACK to the remote peer. The peer starts a new window
+        after the acknowledged block, so the current window starts over too.
+
+        @param bytes: the ACK datagram to send
+        @type bytes: C{bytes}
+
+        """
+        self._window_received = 0
+        self.retransmission.transmitted()
+        self.sendData(bytes)
+
 
 class ReadSession(DatagramProtocol):
     """Represents a transfer, during which we read from a local file
@@ -181,12 +313,36 @@ class ReadSession(DatagramProtocol):
     the transfer is considered failed.
     @type timeout: any iterable
 
+    @cvar window_size: The number of DATA datagrams, that may be in flight
+    before an ACK is required. Default: 1 (lock-step, as per
+    U{RFC1350<http://tools.ietf.org/html/rfc1350>}). Larger values are
+    negotiated with the I{windowsize} option
+    (U{RFC7440<http://tools.ietf.org/html/rfc7440>}).
+    @type window_size: C{int}
+
+    @cvar read_ahead: The number of blocks, that are read from the reader in
+    advance, while the current ones are in flight. Default: 0 (every block is
+    read only when it is about to be sent).
+    @type read_ahead: C{int}
+
+    @cvar client: the host of the remote peer, that the log messages of this
+    session are attributed to (for rate limiting). Set by the bootstrap
+    protocol.
+    @type client: C{str}
+
     @ivar started: whether or not this protocol has started
     @type started: C{bool}
 
+    @ivar retransmission: adapts the retransmission timeouts to the measured
+    round-trip time. L{timeout} values serve as upper bounds.
+    @type retransmission: L{RetransmissionPolicy}
+
     """
     block_size = 512
     timeout = (3, 9, 21)
+    window_size = 1
+    read_ahead = 0
+    client = None
 
     def __init__(self, reader, _clock=None):
         self.reader = reader
@@ -194,10 +350,15 @@ class ReadSession(DatagramProtocol):
         self.started = False
         self.completed = False
         self.timeout_watchdog = None
+        self._window = []
+        self._filling = False
+        # Whether the current window has been sent again because of a gap ACK
+        self._gap_resent = False
         if _clock is None:
             self._clock = reactor
         else:
             self._clock = _clock
+        self.retransmission = RetransmissionPolicy(self._clock)
 
     def cancel(self):
         """Tell the reader to give up the resources. Stop the timeout cycle
@@ -211,6 +372,8 @@ class ReadSession(DatagramProtocol):
 
     def startProtocol(self):
         self.started = True
+        if self.read_ahead:
+            self.reader = ReadAheadProxy(self.reader, self.read_ahead)
 
     def connectionRefused(self):
         self.finish()
@@ -219,7 +382,7 @@ class ReadSession(DatagramProtocol):
         if datagram.opcode == OP_ACK:
             return self.tftp_ACK(datagram)
         elif datagram.opcode == OP_ERROR:
-            log.msg("Got error: %s" % datagram)
+            logger.warning("Got error: %s", datagram, client=self.client)
             self.cancel()
 
     def tftp_ACK(self, datagram):
@@ -227,34 +390,91 @@ class ReadSession(DatagramProtocol):
 
         @type datagram: L{ACKDatagram}
 
+        @see: L{ackReceived}
+
         """
-        if datagram.blocknum < self.blocknum:
-            log.msg("Duplicate ACK for blocknum %s" % datagram.blocknum)
-        elif datagram.blocknum == self.blocknum:
+        return self.ackReceived(datagram.blocknum)
+
+    def ackReceived(self, blocknum):
+        """Handle an acknowledgement of the block C{blocknum}.
+
+        ACKs are cumulative: an ACK for any block in the current window
+        acknowledges that block and every block before it. The blocks after it
+        are sent again, along with the fresh blocks, that fill up the window.
+
+        With a window of more than one block, an ACK for the block right
+        before the current window means, that the peer did not get the start
+        of it (U{RFC7440<http://tools.ietf.org/html/rfc7440>}), so the window
+        is sent again right away instead of after a timeout. This happens at
+        most once per window, so that duplicated windows do not keep
+        multiplying (the Sorcerer's Apprentice syndrome). In lock-step such an
+        ACK is only ever a duplicate and is ignored, as per
+        U{RFC1123<http://tools.ietf.org/html/rfc1123>}.
+
+        @type blocknum: C{int}
+
+        """
+        last_blocknum = self.blocknum
+        if self._filling:
+            # The read for the current block number is still in progress
+            last_blocknum -= 1
+        # How many blocks were queued after the one, that is being acknowledged
+        behind = (last_blocknum - blocknum) % 65536
+        if behind > 32767:
+            self.transport.write(ERRORDatagram.from_code(
+                ERR_ILLEGAL_OP, b"Block number mismatch").to_wire())
+        elif behind and behind >= len(self._window):
+            if (behind == len(self._window) and self.window_size > 1 and
+                    not self._filling and not self._gap_resent):
+                logger.debug("Gap ACK for blocknum %s, sending the window again",
+                             blocknum, client=self.client)
+                self.sendWindow()
+                self._gap_resent = True
+            else:
+                logger.debug("Duplicate ACK for blocknum %s", blocknum,
+                             client=self.client)
+        else:
             if self.timeout_watchdog is not None and self.timeout_watchdog.active():
                 self.timeout_watchdog.cancel()
+            self.retransmission.acknowledged()
+            del self._window[:len(self._window) - behind]
+            if self._filling:
+                # The window will be sent as soon as the reader catches up
+                return
             if self.completed:
-                log.msg("Final ACK received, transfer successful")
-                self.cancel()
+                if not self._window:
+                    logger.debug("Final ACK received, transfer successful",
+                                 client=self.client)
+                    self.cancel()
+                else:
+                    self.sendWindow()
             else:
                 return self.nextBlock()
-        else:
-            self.transport.write(ERRORDatagram.from_code(
-                ERR_ILLEGAL_OP, b"Block number mismatch").to_wire())
 
     def nextBlock(self):
         """ACK datagram for the previous block has been received. Attempt to read
-        the next block, that will be sent.
+        the next block, that will be sent. If the reader returns the data itself
+        instead of a L{Deferred}, it is handled right away.
 
         """
+        self._filling = True
         self.blocknum += 1
-        d = maybeDeferred(self.reader.read, self.block_size)
-        d.addCallbacks(callback=self.dataFromReader, errback=self.readFailed)
-        return d
+        try:
+            data = self.reader.read(self.block_size)
+        except Exception:
+            return self.readFailed(Failure())
+        if isinstance(data, Deferred):
+            data.addCallbacks(callback=self.dataFromReader, errback=self.readFailed)
+            return data
+        if isinstance(data, Failure):
+            return self.readFailed(data)
+        # A synchronous reader, no need for a Deferred
+        return self.dataFromReader(data)
 
     def dataFromReader(self, data):
-        """Got data from the reader. Send it to the network and start the timeout
-        cycle.
+        """Got data from the reader. Add it to the current window and either
+        read the next block or, if the window is full, send the window and start
+        the timeout cycle.
 
         """
         # reached maximum number of blocks. Rolling over
@@ -262,9 +482,23 @@ class ReadSession(DatagramProtocol):
             self.blocknum = 0
         if len(data) < self.block_size:
             self.completed = True
-        bytes = DATADatagram(self.blocknum, data).to_wire()
-        self.timeout_watchdog = SequentialCall.run(self.timeout[:-1],
-            callable=self.sendData, callable_args=[bytes, ],
+        self._window.append(encode_data(self.blocknum, data))
+        if not self.completed and len(self._window) < self.window_size:
+            return self.nextBlock()
+        self._filling = False
+        self.sendWindow()
+
+    def sendWindow(self):
+        """Send every unacknowledged block in the current window and start the
+        timeout cycle, that will send them again, if they are not acknowledged.
+
+        """
+        if self.timeout_watchdog is not None and self.timeout_watchdog.active():
+            self.timeout_watchdog.cancel()
+        self._gap_resent = False
+        self.timeout_watchdog = SequentialCall.run(
+            self.retransmission.timeouts(self.timeout[:-1]),
+            callable=self.sendDatagrams, callable_args=[list(self._window), ],
             on_timeout=lambda: self._clock.callLater(self.timeout[-1], self.timedOut),
             run_now=True,
             _clock=self._clock
@@ -278,7 +512,8 @@ class ReadSession(DatagramProtocol):
 
     def timedOut(self):
         """Timeout iterable has been exhausted. End the transfer"""
-        log.msg("Session timed out, last wait was %s seconds long" % self.timeout[-1])
+        logger.warning("Session timed out, last wait was %s seconds long",
+                       self.timeout[-1], client=self.client)
         self.cancel()
 
     def sendData(self, bytes):
@@ -289,3 +524,106 @@ class ReadSession(DatagramProtocol):
 
         """
         self.transport.write(bytes)
+
+    def sendDatagrams(self, datagrams):
+        """Send several datagrams to the remote peer, one after another
+
+        @param datagrams: wire representations of the datagrams to send
+        @type datagrams: C{list} of C{bytes}
+
+        """
+        self.retransmission.transmitted()
+        write_datagrams = getattr(self.transport, 'writeDatagrams', None)
+        if write_datagrams is not None:
+            return write_datagrams(datagrams)
+        for bytes in datagrams:
+            self.transport.write(bytes)
+
+
+class ReadAheadProxy(object):
+    """Proxies an object, that provides L{IReader<tftp.backend.IReader>}. Keeps
+    reading blocks from it in advance, so that the next blocks are already
+    available, when they are requested. Reads are issued one at a time, in
+    order, and stop after the reader returns a short (last) block.
+
+    @param reader: an L{IReader<tftp.backend.IReader>} provider
+    @type reader: L{IReader<tftp.backend.IReader>} provider
+
+    @param depth: the maximum number of blocks to keep in advance
+    @type depth: C{int}
+
+    """
+
+    def __init__(self, reader, depth):
+        self.reader = reader
+        self.depth = depth
+        self._size = None
+        self._ready = deque()
+        self._waiting = deque()
+        self._reading = self._looping = False
+        self._eof = self._finished = False
+
+    def read(self, size):
+        """Return the next block of C{size} bytes. All blocks are expected to
+        be requested with the same C{size}.
+
+        @return: data, that was read in advance or a L{Deferred}, that will be
+        fired with the data, when it is read
+        @rtype: C{bytes} or L{Deferred}
+
+        """
+        self._size = size
+        if self._ready:
+            result = self._ready.popleft()
+            self._readAhead()
+            if isinstance(result, Failure):
+                return fail(result)
+            return result
+        d = Deferred()
+        self._waiting.append(d)
+        self._readAhead()
+        return d
+
+    def _readAhead(self):
+        if self._looping:
+            return
+        self._looping = True
+        try:
+            while not (self._reading or self._eof or self._finished):
+                if len(self._ready) >= self.depth:
+                    break
+                self._reading = True
+                d = maybeDeferred(self.reader.read, self._size)
+                d.addBoth(self._gotData)
+        finally:
+            self._looping = False
+        if self._eof:
+            while self._waiting:
+                self._waiting.popleft().callback(b'')
+
+    def _gotData(self, result):
+        self._reading = False
+        if isinstance(result, Failure) or len(result) < self._size:
+            self._eof = True
+        if self._waiting:
+            d = self._waiting.popleft()
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        else:
+            self._ready.append(result)
+        self._readAhead()
+
+    def finish(self):
+        """Discard the data, that was read in advance, and finish the reader.
+
+        @see: L{IReader.finish<tftp.backend.IReader.finish>}
+
+        """
+        self._finished = True
+        self._ready.clear()
+        self.reader.finish()
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
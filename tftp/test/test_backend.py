@@ -2,11 +2,20 @@
 @author: shylent
 '''
 from tftp.backend import (FilesystemSynchronousBackend, FilesystemReader,
-    FilesystemWriter, IReader, IWriter)
-from tftp.errors import Unsupported, AccessViolation, FileNotFound, FileExists
+    FilesystemWriter, IReader, IWriter, ContentCache, CachedReader,
+    MmapFilesystemReader, FilesystemAsyncBackend, ThreadedReader, ThreadedWriter,
+    AtomicFilesystemWriter, BufferingWriter, FSYNC_DATA, FSYNC_FULL,
+    NegativeCache, SharedFiles, SharedFileReader)
+from twisted.internet.task import Clock
+from tftp.netascii import (NetasciiReceiverProxy, NetasciiSenderProxy,
+    to_netascii)
+from tftp.errors import (Unsupported, AccessViolation, FileNotFound, FileExists,
+    BackendError, DiskFull)
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (inlineCallbacks, returnValue, gatherResults,
+    maybeDeferred)
 from twisted.trial import unittest
+import os
 import shutil
 import tempfile
 
@@ -130,6 +139,564 @@ line3
         self.temp_dir.remove()
 
 
+class MmapReader(unittest.TestCase):
+    test_data = b"""line1
+line2
+line3
+"""
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.temp_dir.child(b'foo').setContent(self.test_data)
+
+    def test_file_not_found(self):
+        self.assertRaises(FileNotFound, MmapFilesystemReader, self.temp_dir.child(b'bar'))
+
+    def test_read(self):
+        r = MmapFilesystemReader(self.temp_dir.child(b'foo'))
+        self.assertEqual(r.size, len(self.test_data))
+        blocks = [r.read(4) for i in range(6)]
+        self.assertIsInstance(blocks[0], memoryview)
+        self.assertEqual(b''.join(blocks), self.test_data)
+        self.assertEqual(len(blocks[-1]), 0)
+        del blocks
+        r.finish()
+        self.assertTrue(r.map is None)
+        self.assertEqual(r.read(4), b'')
+        r.finish()
+
+    def test_finish_with_live_blocks(self):
+        r = MmapFilesystemReader(self.temp_dir.child(b'foo'))
+        block = r.read(4)
+        r.finish()
+        self.assertEqual(block.tobytes(), b'line')
+
+    def test_empty_file(self):
+        self.temp_dir.child(b'empty').setContent(b'')
+        r = MmapFilesystemReader(self.temp_dir.child(b'empty'))
+        self.assertEqual(r.size, 0)
+        self.assertEqual(len(r.read(512)), 0)
+        r.finish()
+
+    def test_truncated(self):
+        r = MmapFilesystemReader(self.temp_dir.child(b'foo'))
+        self.assertEqual(bytes(r.read(6)), b'line1\n')
+        with open(self.temp_dir.child(b'foo').path, 'r+b') as f:
+            f.truncate(8)
+        self.assertRaises(BackendError, r.read, 6)
+        r.finish()
+
+    @inlineCallbacks
+    def test_backend(self):
+        backend = FilesystemSynchronousBackend(self.temp_dir, use_mmap=True)
+        reader = yield backend.get_reader(b'foo')
+        self.assertIsInstance(reader, MmapFilesystemReader)
+        reader.finish()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
+class ContentCaching(unittest.TestCase):
+    test_data = b"""line1
+line2
+line3
+"""
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.temp_dir.child(b'foo').setContent(self.test_data)
+        self.temp_dir.child(b'bar').setContent(b'bar' * 4)
+        self.cache = ContentCache(20)
+        self.backend = FilesystemSynchronousBackend(self.temp_dir, cache=self.cache)
+
+    @inlineCallbacks
+    def test_cached_reader(self):
+        reader = yield self.backend.get_reader(b'foo')
+        self.assertIsInstance(reader, CachedReader)
+        self.assertTrue(IReader.providedBy(reader))
+        self.assertEqual(reader.size, len(self.test_data))
+        blocks = [reader.read(5) for i in range(5)]
+        self.assertIsInstance(blocks[0], memoryview)
+        self.assertEqual(b''.join(blocks), self.test_data)
+        self.assertEqual([len(b) for b in blocks], [5, 5, 5, 3, 0])
+        reader.finish()
+        self.assertEqual(reader.read(5), b'')
+        self.assertTrue(reader.size is None)
+
+    @inlineCallbacks
+    def test_hits(self):
+        yield self.backend.get_reader(b'foo')
+        yield self.backend.get_reader(b'foo')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.size, len(self.test_data))
+
+    @inlineCallbacks
+    def test_changed_file(self):
+        yield self.backend.get_reader(b'foo')
+        path = self.temp_dir.child(b'foo')
+        path.setContent(b'changed')
+        st = os.stat(path.path)
+        os.utime(path.path, (st.st_atime, st.st_mtime + 10))
+        reader = yield self.backend.get_reader(b'foo')
+        self.assertEqual(bytes(reader.read(512)), b'changed')
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.assertEqual(self.cache.size, len(b'changed'))
+
+    @inlineCallbacks
+    def test_eviction(self):
+        yield self.backend.get_reader(b'foo')
+        yield self.backend.get_reader(b'bar')
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.size, 12)
+        yield self.backend.get_reader(b'bar')
+        self.assertEqual(self.cache.hits, 1)
+
+    @inlineCallbacks
+    def test_too_large(self):
+        self.cache.max_file_size = 10
+        reader = yield self.backend.get_reader(b'foo')
+        self.assertIsInstance(reader, FilesystemReader)
+        reader.finish()
+        self.assertEqual(self.cache.size, 0)
+
+    def test_file_not_found(self):
+        return self.assertFailure(self.backend.get_reader(b'baz'), FileNotFound)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
+class NetasciiCaching(unittest.TestCase):
+    test_data = b"""line1\r
+line2
+line3
+"""
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.temp_dir.child(b'foo').setContent(self.test_data)
+        self.cache = ContentCache(100, transform=to_netascii)
+        self.backend = FilesystemSynchronousBackend(self.temp_dir,
+                                                    netascii_cache=self.cache)
+
+    @inlineCallbacks
+    def test_converted(self):
+        reader = yield self.backend.get_netascii_reader(b'foo')
+        self.assertIsInstance(reader, CachedReader)
+        converted = to_netascii(self.test_data)
+        self.assertNotEqual(len(converted), len(self.test_data))
+        self.assertEqual(reader.size, len(converted))
+        self.assertEqual(bytes(reader.read(512)), converted)
+        self.assertEqual(self.cache.size, len(converted))
+        reader.finish()
+
+    @inlineCallbacks
+    def test_hits(self):
+        yield self.backend.get_netascii_reader(b'foo')
+        yield self.backend.get_netascii_reader(b'foo')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    @inlineCallbacks
+    def test_changed_file(self):
+        yield self.backend.get_netascii_reader(b'foo')
+        path = self.temp_dir.child(b'foo')
+        path.setContent(b'changed\n')
+        st = os.stat(path.path)
+        os.utime(path.path, (st.st_atime, st.st_mtime + 10))
+        reader = yield self.backend.get_netascii_reader(b'foo')
+        self.assertEqual(bytes(reader.read(512)), to_netascii(b'changed\n'))
+
+    @inlineCallbacks
+    def test_not_cached(self):
+        self.cache.max_file_size = 10
+        reader = yield self.backend.get_netascii_reader(b'foo')
+        self.assertIsInstance(reader, NetasciiSenderProxy)
+        # The converted size is not known in advance
+        self.assertTrue(reader.size is None)
+        data = yield reader.read(512)
+        self.assertEqual(data, to_netascii(self.test_data))
+        reader.finish()
+
+    @inlineCallbacks
+    def test_plain_reads_not_cached(self):
+        reader = yield self.backend.get_reader(b'foo')
+        self.assertIsInstance(reader, FilesystemReader)
+        reader.finish()
+        self.assertEqual(self.cache.misses, 0)
+
+    def test_file_not_found(self):
+        return self.assertFailure(self.backend.get_netascii_reader(b'baz'),
+                                  FileNotFound)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
+class SharedReads(unittest.TestCase):
+    test_data = b"""line1
+line2
+line3
+"""
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.temp_dir.child(b'foo').setContent(self.test_data)
+        self.temp_dir.child(b'dir').createDirectory()
+        self.files = SharedFiles(chunk_size=8, max_chunks=3)
+        self.backend = FilesystemSynchronousBackend(self.temp_dir,
+                                                    shared_files=self.files)
+
+    def read_all(self, reader, size):
+        blocks = []
+        while True:
+            block = reader.read(size)
+            blocks.append(bytes(block))
+            if len(block) < size:
+                return blocks
+
+    @inlineCallbacks
+    def test_read(self):
+        reader = yield self.backend.get_reader(b'foo')
+        self.assertIsInstance(reader, SharedFileReader)
+        self.assertTrue(IReader.providedBy(reader))
+        self.assertEqual(reader.size, len(self.test_data))
+        # The blocks span the chunks
+        blocks = self.read_all(reader, 5)
+        self.assertEqual(blocks, [b'line1', b'\nline', b'2\nlin', b'e3\n'])
+        self.assertEqual(self.files.reads, 3)
+        reader.finish()
+        self.assertEqual(reader.read(5), b'')
+        self.assertTrue(reader.size is None)
+
+    @inlineCallbacks
+    def test_shared(self):
+        first = yield self.backend.get_reader(b'foo')
+        second = yield self.backend.get_reader(b'foo')
+        self.assertIdentical(first.shared, second.shared)
+        for i in range(3):
+            self.assertEqual(bytes(first.read(6)), bytes(second.read(6)))
+        # Read from the disk once for both
+        self.assertEqual(self.files.reads, 3)
+        first.finish()
+        self.assertEqual(second.shared.readers, 1)
+        second.finish()
+        self.assertFalse(self.files._files)
+        self.assertFalse(self.files._chunks)
+
+    @inlineCallbacks
+    def test_eviction(self):
+        self.files.max_chunks = 1
+        first = yield self.backend.get_reader(b'foo')
+        second = yield self.backend.get_reader(b'foo')
+        self.read_all(first, 8)
+        self.read_all(second, 8)
+        self.assertEqual(self.files.reads, 6)
+        self.assertEqual(len(self.files._chunks), 1)
+        first.finish()
+        second.finish()
+
+    @inlineCallbacks
+    def test_replaced_file(self):
+        reader = yield self.backend.get_reader(b'foo')
+        self.assertEqual(bytes(reader.read(5)), b'line1')
+        new = self.temp_dir.child(b'foo.new')
+        new.setContent(b'replaced')
+        os.rename(new.path, self.temp_dir.child(b'foo').path)
+        new_reader = yield self.backend.get_reader(b'foo')
+        self.assertNotIdentical(reader.shared, new_reader.shared)
+        self.assertEqual(self.read_all(new_reader, 512), [b'replaced'])
+        # The old version is still read by the old reader
+        self.assertEqual(bytes(reader.read(5)), b'\nline')
+        reader.finish()
+        new_reader.finish()
+        self.assertFalse(self.files._files)
+
+    @inlineCallbacks
+    def test_changed_file(self):
+        reader = yield self.backend.get_reader(b'foo')
+        path = self.temp_dir.child(b'foo')
+        with open(path.path, 'ab') as f:
+            f.write(b'line4\n')
+        new_reader = yield self.backend.get_reader(b'foo')
+        self.assertNotIdentical(reader.shared, new_reader.shared)
+        self.assertEqual(new_reader.size, len(self.test_data) + 6)
+        reader.finish()
+        new_reader.finish()
+
+    def test_file_not_found(self):
+        return self.assertFailure(self.backend.get_reader(b'baz'), FileNotFound)
+
+    def test_directory(self):
+        return self.assertFailure(self.backend.get_reader(b'dir'), FileNotFound)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
+class OpenFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        for name in (b'a', b'b', b'c'):
+            self.temp_dir.child(name).setContent(name * 10)
+        self.files = SharedFiles(max_chunks=0, max_open=2)
+        self.backend = FilesystemSynchronousBackend(self.temp_dir,
+                                                    shared_files=self.files)
+
+    @inlineCallbacks
+    def read(self, file_name):
+        reader = yield self.backend.get_reader(file_name)
+        data = bytes(reader.read(512))
+        reader.finish()
+        returnValue(data)
+
+    @inlineCallbacks
+    def test_kept_open(self):
+        data = yield self.read(b'a')
+        self.assertEqual(data, b'a' * 10)
+        data = yield self.read(b'a')
+        self.assertEqual(data, b'a' * 10)
+        self.assertEqual(self.files.opens, 1)
+        # No chunks, every read goes to the disk
+        self.assertEqual(self.files.reads, 2)
+        self.assertFalse(self.files._chunks)
+
+    @inlineCallbacks
+    def test_positional_reads(self):
+        first = yield self.backend.get_reader(b'a')
+        second = yield self.backend.get_reader(b'a')
+        self.assertIdentical(first.shared, second.shared)
+        self.assertEqual(bytes(first.read(4)), b'aaaa')
+        self.assertEqual(bytes(second.read(8)), b'a' * 8)
+        self.assertEqual(bytes(first.read(8)), b'a' * 6)
+        first.finish()
+        second.finish()
+
+    @inlineCallbacks
+    def test_least_recently_used_closed(self):
+        yield self.read(b'a')
+        yield self.read(b'b')
+        yield self.read(b'a')
+        yield self.read(b'c')
+        self.assertEqual(sorted(self.files._idle), [self.temp_dir.child(b'a').path,
+                                                    self.temp_dir.child(b'c').path])
+        yield self.read(b'b')
+        self.assertEqual(self.files.opens, 4)
+
+    @inlineCallbacks
+    def test_replaced(self):
+        yield self.read(b'a')
+        old = self.files._files[self.temp_dir.child(b'a').path]
+        new = self.temp_dir.child(b'a.new')
+        new.setContent(b'replaced')
+        os.rename(new.path, self.temp_dir.child(b'a').path)
+        data = yield self.read(b'a')
+        self.assertEqual(data, b'replaced')
+        self.assertEqual(self.files.opens, 2)
+        self.assertEqual(list(self.files._idle.values()),
+                         [self.files._files[self.temp_dir.child(b'a').path]])
+        self.assertNotIdentical(self.files._idle[old.path], old)
+
+    @inlineCallbacks
+    def test_replaced_while_reading(self):
+        reader = yield self.backend.get_reader(b'a')
+        self.assertEqual(bytes(reader.read(4)), b'aaaa')
+        new = self.temp_dir.child(b'a.new')
+        new.setContent(b'replaced')
+        os.rename(new.path, self.temp_dir.child(b'a').path)
+        data = yield self.read(b'a')
+        self.assertEqual(data, b'replaced')
+        self.assertEqual(bytes(reader.read(512)), b'a' * 6)
+        old = reader.shared
+        reader.finish()
+        self.assertEqual(len(self.files._idle), 1)
+        self.assertNotIdentical(self.files._idle[old.path], old)
+
+    @inlineCallbacks
+    def test_removed(self):
+        yield self.read(b'a')
+        self.temp_dir.child(b'a').remove()
+        yield self.assertFailure(self.backend.get_reader(b'a'), FileNotFound)
+        self.assertFalse(self.files._idle)
+        self.assertFalse(self.files._files)
+
+    @inlineCallbacks
+    def test_clear(self):
+        yield self.read(b'a')
+        yield self.read(b'b')
+        self.files.clear()
+        self.assertFalse(self.files._idle)
+        self.assertFalse(self.files._files)
+
+    def tearDown(self):
+        self.files.clear()
+        shutil.rmtree(self.temp_dir.path)
+
+
+class ShutdownReactor(Clock):
+    """Runs the calls from the threads, when told, and the shutdown triggers
+    like the reactor does: a trigger is no longer registered, while it runs.
+
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.from_threads = []
+        self.triggers = {}
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.from_threads.append((f, args, kwargs))
+
+    def addSystemEventTrigger(self, phase, event, f, *args, **kwargs):
+        trigger = object()
+        self.triggers[trigger] = (f, args, kwargs)
+        return trigger
+
+    def removeSystemEventTrigger(self, trigger):
+        if trigger not in self.triggers:
+            raise ValueError("list.remove(x): x not in list")
+        del self.triggers[trigger]
+
+    def shutdown(self):
+        while self.triggers:
+            trigger, (f, args, kwargs) = self.triggers.popitem()
+            f(*args, **kwargs)
+
+
+class AsyncBackend(unittest.TestCase):
+    test_data = b"""line1
+line2
+line3
+"""
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.temp_dir.child(b'foo').setContent(self.test_data)
+        self.backend = FilesystemAsyncBackend(self.temp_dir, threads=2,
+                                              read_batch=2)
+        self.addCleanup(self.backend.stop)
+
+    @inlineCallbacks
+    def read_all(self, reader, size):
+        blocks = []
+        while True:
+            block = yield reader.read(size)
+            blocks.append(bytes(block))
+            if len(block) < size:
+                break
+        returnValue(blocks)
+
+    @inlineCallbacks
+    def test_read(self):
+        reader = yield self.backend.get_reader(b'foo')
+        self.assertIsInstance(reader, ThreadedReader)
+        self.assertTrue(IReader.providedBy(reader))
+        self.assertEqual(reader.size, len(self.test_data))
+        blocks = yield self.read_all(reader, 5)
+        self.assertEqual(blocks, [b'line1', b'\nline', b'2\nlin', b'e3\n'])
+        self.assertEqual(reader.read(5), b'')
+        reader.finish()
+
+    @inlineCallbacks
+    def test_netascii_read(self):
+        reader = yield self.backend.get_netascii_reader(b'foo')
+        self.assertIsInstance(reader, NetasciiSenderProxy)
+        data = yield reader.read(512)
+        self.assertEqual(data, to_netascii(self.test_data))
+        reader.finish()
+
+    def test_shutdown_trigger(self):
+        reactor = ShutdownReactor()
+        backend = FilesystemAsyncBackend(self.temp_dir, _reactor=reactor)
+        backend.deferToThread(lambda: None)
+        self.assertEqual(len(reactor.triggers), 1)
+        reactor.shutdown()
+        self.assertFalse(backend.pool.started)
+        # Stopping it again does not touch the trigger
+        backend.stop()
+
+    @inlineCallbacks
+    def test_changing_sizes(self):
+        data = os.urandom(3000)
+        self.temp_dir.child(b'big').setContent(data)
+        reader = yield self.backend.get_reader(b'big')
+        blocks = []
+        for size in (512, 100, 512, 700, 1, 1000, 512):
+            block = yield reader.read(size)
+            blocks.append(bytes(block))
+            self.assertEqual(len(block), min(size, 3000 - sum(map(len, blocks[:-1]))))
+        self.assertEqual(b''.join(blocks), data)
+        block = yield reader.read(512)
+        self.assertEqual(block, b'')
+        reader.finish()
+
+    @inlineCallbacks
+    def test_netascii_read_multiple_blocks(self):
+        data = b'line\n' * 2000 + b'\r' * 500
+        self.temp_dir.child(b'text').setContent(data)
+        reader = yield self.backend.get_netascii_reader(b'text')
+        blocks = []
+        while True:
+            block = yield reader.read(512)
+            blocks.append(bytes(block))
+            if len(block) < 512:
+                break
+        self.assertEqual(b''.join(blocks), to_netascii(data))
+        reader.finish()
+
+    @inlineCallbacks
+    def test_read_exact_multiple(self):
+        reader = yield self.backend.get_reader(b'foo')
+        blocks = yield self.read_all(reader, 3)
+        self.assertEqual(b''.join(blocks), self.test_data)
+        self.assertEqual(blocks[-1], b'')
+        reader.finish()
+
+    @inlineCallbacks
+    def test_overlapping_reads(self):
+        reader = yield self.backend.get_reader(b'foo')
+        blocks = yield gatherResults([maybeDeferred(reader.read, 5)
+                                      for i in range(4)])
+        self.assertEqual(b''.join(bytes(b) for b in blocks), self.test_data)
+        reader.finish()
+
+    @inlineCallbacks
+    def test_write(self):
+        writer = yield self.backend.get_writer(b'dir/bar')
+        self.assertIsInstance(writer, ThreadedWriter)
+        yield writer.write(b'foo')
+        yield writer.write(b'bar')
+        yield writer.finish()
+        self.assertEqual(self.temp_dir.descendant((b'dir', b'bar')).getContent(),
+                         b'foobar')
+        self.assertEqual(self.backend.pending, 0)
+
+    @inlineCallbacks
+    def test_cancel(self):
+        writer = yield self.backend.get_writer(b'bar')
+        writer.write(b'foo')
+        yield writer.cancel()
+        self.assertFalse(self.temp_dir.child(b'bar').exists())
+
+    def test_file_not_found(self):
+        return self.assertFailure(self.backend.get_reader(b'baz'), FileNotFound)
+
+    def test_file_exists(self):
+        return self.assertFailure(self.backend.get_writer(b'foo'), FileExists)
+
+    def test_unsupported(self):
+        self.backend.can_read = False
+        return self.assertFailure(self.backend.get_reader(b'foo'), Unsupported)
+
+    def test_queue_full(self):
+        self.backend.queue_size = 0
+        return self.assertFailure(self.backend.get_reader(b'foo'), BackendError)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
 class Writer(unittest.TestCase):
     test_data = b"""line1
 line2
@@ -168,3 +735,358 @@ line3
 
     def tearDown(self):
         self.temp_dir.remove()
+
+
+class AtomicWriter(unittest.TestCase):
+    test_data = b"""line1
+line2
+line3
+"""
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.temp_dir.child(b'foo').setContent(self.test_data)
+
+    def test_write_existing_file(self):
+        self.assertRaises(FileExists, AtomicFilesystemWriter, self.temp_dir.child(b'foo'))
+
+    def test_finished_write(self):
+        target = self.temp_dir.descendant((b'dir', b'bar'))
+        w = AtomicFilesystemWriter(target)
+        w.write(self.test_data)
+        self.assertFalse(target.exists(),
+                         "The file should not appear before the transfer is complete")
+        w.finish()
+        self.assertEqual(target.getContent(), self.test_data)
+        self.assertEqual(target.parent().listdir(), [b'bar'])
+        self.assertTrue(target.getPermissions().user.read)
+        w.finish()
+
+    def test_cancelled_write(self):
+        w = AtomicFilesystemWriter(self.temp_dir.child(b'bar'))
+        w.write(self.test_data)
+        w.cancel()
+        self.assertEqual(self.temp_dir.listdir(), [b'foo'])
+        w.cancel()
+
+    def test_concurrent_writes(self):
+        # Two uploads of the same new file: the first one to finish wins, the
+        # second one does not replace it
+        target = self.temp_dir.child(b'bar')
+        first = AtomicFilesystemWriter(target)
+        second = AtomicFilesystemWriter(target)
+        first.write(b'first')
+        second.write(b'second')
+        first.finish()
+        self.assertRaises(FileExists, second.finish)
+        self.assertEqual(target.getContent(), b'first')
+        self.assertEqual(sorted(self.temp_dir.listdir()), [b'bar', b'foo'])
+        second.cancel()
+
+    def test_umask(self):
+        # The temporary file is created with the umask, that is in effect
+        # at that time
+        old = os.umask(0o077)
+        try:
+            w = AtomicFilesystemWriter(self.temp_dir.child(b'bar'))
+        finally:
+            os.umask(old)
+        w.finish()
+        self.assertEqual(self.temp_dir.child(b'bar').getPermissions().shorthand(),
+                         'rw-------')
+        old = os.umask(0o022)
+        try:
+            w = AtomicFilesystemWriter(self.temp_dir.child(b'baz'))
+        finally:
+            os.umask(old)
+        w.finish()
+        self.assertEqual(self.temp_dir.child(b'baz').getPermissions().shorthand(),
+                         'rw-r--r--')
+
+    @inlineCallbacks
+    def test_backend(self):
+        backend = FilesystemSynchronousBackend(self.temp_dir, atomic_writes=True)
+        writer = yield backend.get_writer(b'bar')
+        self.assertIsInstance(writer, AtomicFilesystemWriter)
+        writer.cancel()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
+class RecordingWriter(object):
+
+    def __init__(self):
+        self.writes = []
+        self.state = 'active'
+        self.fsync = None
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    def syncOnFinish(self, policy):
+        self.fsync = policy
+
+    def finish(self):
+        self.state = 'finished'
+
+    def cancel(self):
+        self.state = 'cancelled'
+
+
+class VectorWriter(RecordingWriter):
+
+    def writev(self, buffers):
+        self.writes.append([bytes(b) for b in buffers])
+
+
+class FailingWriter(RecordingWriter):
+
+    def write(self, data):
+        raise IOError("No space left on device")
+
+
+class Buffering(unittest.TestCase):
+
+    def test_coalescing(self):
+        writer = RecordingWriter()
+        w = BufferingWriter(writer, flush_size=8)
+        for block in (b'abc', b'def', b'ghi', b'jkl'):
+            self.assertTrue(w.write(block) is None)
+        # Only the multiple of flush_size is written, the rest waits
+        self.assertEqual(writer.writes, [b'abcdefgh'])
+        w.finish()
+        self.assertEqual(writer.writes, [b'abcdefgh', b'ijkl'])
+        self.assertEqual(writer.state, 'finished')
+        self.assertTrue(writer.fsync is None)
+
+    def test_writev(self):
+        writer = VectorWriter()
+        w = BufferingWriter(writer, flush_size=4)
+        w.write(b'abc')
+        w.write(b'def')
+        w.write(b'g')
+        self.assertEqual(writer.writes, [[b'abc', b'd']])
+        w.finish()
+        self.assertEqual(writer.writes, [[b'abc', b'd'], [b'ef', b'g']])
+
+    def test_write_through(self):
+        writer = VectorWriter()
+        w = BufferingWriter(writer, flush_size=0)
+        w.write(b'abc')
+        self.assertEqual(writer.writes, [[b'abc']])
+
+    def test_netascii(self):
+        writer = VectorWriter()
+        w = BufferingWriter(NetasciiReceiverProxy(writer), flush_size=4)
+        w.write(b'a\r\nb\r')
+        w.write(b'\x00c')
+        w.finish()
+        # writev of the proxied writer must not be used past the proxy
+        self.assertEqual(writer.writes, [b'a\nb', b'\rc'])
+
+    def test_fsync(self):
+        writer = RecordingWriter()
+        w = BufferingWriter(writer, fsync=FSYNC_DATA)
+        w.finish()
+        self.assertEqual(writer.fsync, FSYNC_DATA)
+
+    def test_cancel(self):
+        writer = RecordingWriter()
+        w = BufferingWriter(writer)
+        w.write(b'abc')
+        w.cancel()
+        self.assertEqual(writer.writes, [])
+        self.assertEqual(writer.state, 'cancelled')
+
+    def test_failed_finish(self):
+        writer = FailingWriter()
+        w = BufferingWriter(writer)
+        w.write(b'abc')
+        d = w.finish()
+        self.assertEqual(writer.state, 'cancelled')
+        # The caller learns, that the file was not stored
+        return self.assertFailure(d, IOError)
+
+    def test_quota_on_finish(self):
+        # The upload limit is only checked, when the buffer is flushed
+        temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.addCleanup(temp_dir.remove)
+        target = temp_dir.child(b'foo')
+        w = BufferingWriter(FilesystemWriter(target, max_size=5))
+        w.write(b'abcdefghij')
+        d = self.assertFailure(w.finish(), DiskFull)
+        d.addCallback(lambda ign: self.assertFalse(target.exists()))
+        return d
+
+
+class VectorWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+
+    def test_filesystem_writer(self):
+        target = self.temp_dir.child(b'foo')
+        w = FilesystemWriter(target)
+        w.write(b'abc')
+        w.writev([b'def', memoryview(b'ghi'), b''])
+        w.write(b'jkl')
+        w.syncOnFinish(FSYNC_DATA)
+        w.finish()
+        self.assertEqual(target.getContent(), b'abcdefghijkl')
+
+    def test_atomic_writer(self):
+        target = self.temp_dir.child(b'foo')
+        w = AtomicFilesystemWriter(target)
+        w.writev([b'abc'] * 3000)
+        w.syncOnFinish(FSYNC_FULL)
+        w.finish()
+        self.assertEqual(target.getContent(), b'abc' * 3000)
+
+    @inlineCallbacks
+    def test_backend(self):
+        backend = FilesystemSynchronousBackend(self.temp_dir, write_buffer=4,
+                                               atomic_writes=True)
+        writer = yield backend.get_writer(b'foo')
+        self.assertIsInstance(writer, BufferingWriter)
+        self.assertIsInstance(writer.writer, AtomicFilesystemWriter)
+        writer.write(b'abc')
+        writer.write(b'def')
+        yield writer.finish()
+        self.assertEqual(self.temp_dir.child(b'foo').getContent(), b'abcdef')
+
+    @inlineCallbacks
+    def test_async_backend(self):
+        backend = FilesystemAsyncBackend(self.temp_dir, write_buffer=4,
+                                         fsync=FSYNC_DATA)
+        self.addCleanup(backend.stop)
+        writer = yield backend.get_writer(b'foo')
+        self.assertIsInstance(writer, BufferingWriter)
+        self.assertIsInstance(writer.writer, ThreadedWriter)
+        yield writer.write(b'abc')
+        yield writer.write(b'def')
+        yield writer.finish()
+        self.assertEqual(writer.writer.writer.fsync, FSYNC_DATA)
+        self.assertEqual(self.temp_dir.child(b'foo').getContent(), b'abcdef')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
+class Allocation(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.target = self.temp_dir.child(b'foo')
+
+    def test_allocate(self):
+        for writer_class in (FilesystemWriter, AtomicFilesystemWriter):
+            w = writer_class(self.target)
+            w.allocate(1000)
+            w.write(b'abc')
+            w.finish()
+            self.assertEqual(self.target.getContent(), b'abc')
+            self.target.remove()
+
+    def test_preallocated(self):
+        if not hasattr(os, 'posix_fallocate'):
+            raise unittest.SkipTest("posix_fallocate is not available")
+        w = AtomicFilesystemWriter(self.target)
+        w.allocate(1000)
+        self.assertEqual(os.fstat(w.temp_destination.fileno()).st_size, 1000)
+        w.cancel()
+
+    def test_max_size(self):
+        w = FilesystemWriter(self.target, max_size=5)
+        self.assertRaises(DiskFull, w.allocate, 6)
+        w.write(b'abc')
+        self.assertRaises(DiskFull, w.writev, [b'abc'])
+        w.cancel()
+
+    def test_free_space(self):
+        if not hasattr(os, 'statvfs'):
+            raise unittest.SkipTest("statvfs is not available")
+        w = AtomicFilesystemWriter(self.target)
+        self.assertRaises(DiskFull, w.allocate, 2 ** 62)
+        w.cancel()
+
+    @inlineCallbacks
+    def test_backend(self):
+        backend = FilesystemSynchronousBackend(self.temp_dir, write_buffer=4,
+                                               max_upload_size=5)
+        writer = yield backend.get_writer(b'foo')
+        self.assertRaises(DiskFull, writer.allocate, 6)
+        writer.allocate(5)
+        writer.cancel()
+
+    @inlineCallbacks
+    def test_async_backend(self):
+        backend = FilesystemAsyncBackend(self.temp_dir, max_upload_size=5)
+        self.addCleanup(backend.stop)
+        writer = yield backend.get_writer(b'foo')
+        yield self.assertFailure(writer.allocate(6), DiskFull)
+        yield writer.cancel()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
+
+
+class NegativeCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.temp_dir.child(b'dir').makedirs()
+        self.cache = NegativeCache(ttl=10, max_entries=2, _clock=self.clock)
+        self.backend = FilesystemSynchronousBackend(self.temp_dir,
+                                                    negative_cache=self.cache)
+
+    @inlineCallbacks
+    def test_miss_remembered(self):
+        yield self.assertFailure(self.backend.get_reader(b'dir/foo'), FileNotFound)
+        yield self.assertFailure(self.backend.get_reader(b'dir/foo'), FileNotFound)
+        self.assertEqual(self.cache.hits, 1)
+
+    @inlineCallbacks
+    def test_expiry(self):
+        yield self.assertFailure(self.backend.get_reader(b'dir/foo'), FileNotFound)
+        self.clock.advance(10)
+        yield self.assertFailure(self.backend.get_reader(b'dir/foo'), FileNotFound)
+        self.assertEqual(self.cache.hits, 0)
+
+    @inlineCallbacks
+    def test_directory_changed(self):
+        yield self.assertFailure(self.backend.get_reader(b'dir/foo'), FileNotFound)
+        path = self.temp_dir.descendant((b'dir', b'foo'))
+        path.setContent(b'foo')
+        # Make sure, that the change is visible with a coarse timer
+        st = os.stat(path.dirname())
+        os.utime(path.dirname(), (st.st_atime, st.st_mtime + 10))
+        reader = yield self.backend.get_reader(b'dir/foo')
+        self.assertEqual(reader.read(512), b'foo')
+        reader.finish()
+
+    @inlineCallbacks
+    def test_missing_directory(self):
+        yield self.assertFailure(self.backend.get_reader(b'bar/foo'), FileNotFound)
+        yield self.assertFailure(self.backend.get_reader(b'bar/foo'), FileNotFound)
+        self.assertEqual(self.cache.hits, 1)
+
+    @inlineCallbacks
+    def test_write_clears(self):
+        yield self.assertFailure(self.backend.get_reader(b'dir/foo'), FileNotFound)
+        writer = yield self.backend.get_writer(b'dir/foo')
+        writer.write(b'foo')
+        writer.finish()
+        reader = yield self.backend.get_reader(b'dir/foo')
+        self.assertEqual(reader.read(512), b'foo')
+        reader.finish()
+
+    def test_bounded(self):
+        for name in (b'a', b'b', b'c'):
+            self.cache.add(self.temp_dir.child(name))
+        self.assertFalse(self.cache.isMissing(self.temp_dir.child(b'a')))
+        self.assertTrue(self.cache.isMissing(self.temp_dir.child(b'c')))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir.path)
@@ -0,0 +1,147 @@
+'''
+@author: shylent
+'''
+from tftp import batch
+from tftp.batch import listenBatchedUDP, encode_address, decode_address
+from tftp.multiplex import SessionMultiplexer
+from tftp.protocol import TFTP
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.internet.protocol import DatagramProtocol
+from twisted.trial import unittest
+import socket
+
+
+class Collector(DatagramProtocol):
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = []
+        self.done = Deferred()
+
+    def datagramReceived(self, datagram, addr):
+        self.received.append((datagram, addr))
+        if len(self.received) == self.expected:
+            self.done.callback(self.received)
+
+
+class Echo(DatagramProtocol):
+
+    def datagramReceived(self, datagram, addr):
+        self.transport.write(datagram, addr)
+
+
+class Addresses(unittest.TestCase):
+
+    def test_ipv4(self):
+        sockaddr = encode_address(socket.AF_INET, ('127.0.0.1', 1069))
+        self.assertEqual(len(sockaddr), 16)
+        self.assertEqual(decode_address(sockaddr), ('127.0.0.1', 1069))
+
+    def test_ipv6(self):
+        sockaddr = encode_address(socket.AF_INET6, ('::1', 1069))
+        self.assertEqual(len(sockaddr), 28)
+        self.assertEqual(decode_address(sockaddr), ('::1', 1069))
+
+
+class BatchedIO(unittest.TestCase):
+
+    if not batch.supported:
+        skip = "recvmmsg/sendmmsg are not supported on this platform"
+
+    def listen(self, protocol, batch_size=4):
+        port = listenBatchedUDP(0, protocol, '127.0.0.1', batch_size=batch_size)
+        self.addCleanup(port.stopListening)
+        return port
+
+    def test_write_datagrams(self):
+        collector = Collector(10)
+        receiver = self.listen(collector)
+        sender = self.listen(DatagramProtocol())
+        addr = ('127.0.0.1', receiver.getHost().port)
+        datagrams = [b'datagram %d' % i for i in range(10)]
+        sender.writeDatagrams(datagrams, addr)
+        def cb(received):
+            self.assertEqual([d for d, a in received], datagrams)
+            self.assertEqual(received[0][1], ('127.0.0.1', sender.getHost().port))
+        return collector.done.addCallback(cb)
+
+    def test_connected(self):
+        collector = Collector(3)
+        receiver = self.listen(collector)
+        sender = self.listen(DatagramProtocol())
+        sender.connect('127.0.0.1', receiver.getHost().port)
+        sender.writeDatagrams([b'foo', b'bar', b'baz'])
+        def cb(received):
+            self.assertEqual([d for d, a in received], [b'foo', b'bar', b'baz'])
+        return collector.done.addCallback(cb)
+
+    def test_replies_flushed(self):
+        echo = self.listen(Echo())
+        collector = Collector(10)
+        client = self.listen(collector)
+        sent = []
+        original = echo._sendBatches
+        def record(pairs):
+            sent.append(len(pairs))
+            return original(pairs)
+        echo._sendBatches = record
+        client.writeDatagrams([b'%d' % i for i in range(10)],
+                              ('127.0.0.1', echo.getHost().port))
+        def cb(received):
+            self.assertEqual(sorted(int(d) for d, a in received), list(range(10)))
+            # The replies were sent in batches, not one by one
+            self.assertTrue(len(sent) < 10)
+        return collector.done.addCallback(cb)
+
+    def test_write_outside_of_read(self):
+        collector = Collector(1)
+        receiver = self.listen(collector)
+        sender = self.listen(DatagramProtocol())
+        sender.write(b'foo', ('127.0.0.1', receiver.getHost().port))
+        def cb(received):
+            self.assertEqual(received[0][0], b'foo')
+        return collector.done.addCallback(cb)
+
+    def test_shared_buffers(self):
+        # Ports do not hold receive buffers of their own, one set serves them
+        # all and is large enough for the largest batch
+        small_collector, large_collector = Collector(3), Collector(3)
+        small = self.listen(small_collector, batch_size=2)
+        large = self.listen(large_collector, batch_size=8)
+        sender = self.listen(DatagramProtocol())
+        sender.writeDatagrams([b'foo', b'bar', b'baz'],
+                              ('127.0.0.1', small.getHost().port))
+        sender.writeDatagrams([b'spam', b'ham', b'eggs'],
+                              ('127.0.0.1', large.getHost().port))
+        def cb(results):
+            self.assertEqual([[d for d, a in received] for received in results],
+                             [[b'foo', b'bar', b'baz'], [b'spam', b'ham', b'eggs']])
+            buffers = batch._receive_buffers[small.maxPacketSize]
+            self.assertTrue(buffers.size >= 8)
+            self.assertNotIn('_buffers', vars(small))
+            self.assertNotIn('_buffers', vars(large))
+        return gatherResults(
+            [small_collector.done, large_collector.done]).addCallback(cb)
+
+    def test_session_batch_size(self):
+        # The socket of a single transfer reads small batches, whatever the
+        # batch size of the server
+        tftp = TFTP(None, batch_size=batch.BATCH_SIZE)
+        port = tftp._listen(DatagramProtocol(), ('127.0.0.1', 65465))
+        self.addCleanup(port.stopListening)
+        self.assertIsInstance(port, batch.BatchedPort)
+        self.assertEqual(port.batch_size, batch.SESSION_BATCH_SIZE)
+
+    def test_multiplexer(self):
+        multiplexer = SessionMultiplexer(1, '127.0.0.1', batch_size=4)
+        multiplexer.start()
+        self.addCleanup(multiplexer.stop)
+        collector = Collector(2)
+        client = self.listen(collector)
+        session = DatagramProtocol()
+        multiplexer.attach(session, ('127.0.0.1', client.getHost().port))
+        self.assertIsInstance(multiplexer.ports[0].transport, batch.BatchedPort)
+        session.transport.writeDatagrams([b'foo', b'bar'])
+        def cb(received):
+            self.assertEqual([d for d, a in received], [b'foo', b'bar'])
+        return collector.done.addCallback(cb)
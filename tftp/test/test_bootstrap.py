@@ -3,8 +3,13 @@
 '''
 from tftp.bootstrap import (LocalOriginWriteSession, LocalOriginReadSession,
     RemoteOriginReadSession, RemoteOriginWriteSession, TFTPBootstrap)
+from tftp import bootstrap
 from tftp.datagram import (ACKDatagram, TFTPDatagramFactory, split_opcode,
-    ERR_TID_UNKNOWN, DATADatagram, OACKDatagram, OP_ACK)
+    ERR_TID_UNKNOWN, DATADatagram, OACKDatagram, ERRORDatagram, ERR_DISK_FULL)
+from tftp.backend import FilesystemWriter
+from tftp.errors import PayloadDecodeError
+from tftp.logger import logger
+from tftp.netascii import NetasciiSenderProxy, to_netascii
 from tftp.test.test_sessions import DelayedWriter, FakeTransport, DelayedReader
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
@@ -15,7 +20,8 @@ from twisted.python.util import OrderedDict
 from twisted.trial import unittest
 import shutil
 import tempfile
-from tftp.session import MAX_BLOCK_SIZE, WriteSession, ReadSession
+from tftp.session import (MAX_BLOCK_SIZE, MAX_WINDOW_SIZE, WriteSession,
+    ReadSession)
 
 ReadSession.timeout = (2, 2, 2)
 WriteSession.timeout = (2, 2, 2)
@@ -49,6 +55,7 @@ class MockSession(object):
     block_size = 512
     timeout = (1, 3, 5)
     tsize = None
+    window_size = 1
 
 # Testing implementation here, but if I don't, I'll have a TON of duplicate code
 class TestOptionProcessing(unittest.TestCase):
@@ -146,6 +153,26 @@ class TestOptionProcessing(unittest.TestCase):
         self.assertTrue(self.s.tsize is None)
         self.assertEqual(opts, OrderedDict({}))
 
+    def test_windowsize(self):
+        self.s = MockSession()
+        opts = self.proto.processOptions(OrderedDict({b'windowsize':b'8'}))
+        self.proto.applyOptions(self.s, opts)
+        self.assertEqual(self.s.window_size, 8)
+        self.assertEqual(opts, OrderedDict({b'windowsize':b'8'}))
+
+        self.s = MockSession()
+        opts = self.proto.processOptions(OrderedDict({b'windowsize':b'65535'}))
+        self.proto.applyOptions(self.s, opts)
+        self.assertEqual(self.s.window_size, MAX_WINDOW_SIZE)
+        self.assertEqual(opts, OrderedDict({b'windowsize':intToBytes(MAX_WINDOW_SIZE)}))
+
+        for val in (b'0', b'65536', b'foo'):
+            self.s = MockSession()
+            opts = self.proto.processOptions(OrderedDict({b'windowsize':val}))
+            self.proto.applyOptions(self.s, opts)
+            self.assertEqual(self.s.window_size, 1)
+            self.assertEqual(opts, OrderedDict())
+
     def test_multiple_options(self):
         got_options = OrderedDict()
         got_options[b'timeout'] = b'123'
@@ -279,6 +306,23 @@ class LocalOriginWriteOptionNegotiation(unittest.TestCase):
         self.assertEqual(self.ws.session.block_size, 9)
         self.assertEqual(self.transport.value(), ACKDatagram(0).to_wire())
 
+    def test_option_windowsize(self):
+        self.ws.startProtocol()
+        self.ws.datagramReceived(OACKDatagram({b'blksize':b'9', b'windowsize':b'2'}).to_wire(),
+                                 ('127.0.0.1', 65465))
+        self.clock.advance(0.1)
+        self.assertEqual(self.transport.value(), ACKDatagram(0).to_wire())
+
+        self.transport.clear()
+        self.ws.datagramReceived(DATADatagram(1, b'foobarbaz').to_wire(), ('127.0.0.1', 65465))
+        self.clock.advance(2.1)
+        self.assertEqual(self.ws.session.window_size, 2)
+        self.assertFalse(self.transport.value())
+        self.ws.datagramReceived(DATADatagram(2, b'asdfghjkl').to_wire(), ('127.0.0.1', 65465))
+        self.clock.advance(2.1)
+        self.assertEqual(self.transport.value(), ACKDatagram(2).to_wire())
+        self.addCleanup(self.ws.cancel)
+
     def test_option_timeout(self):
         self.ws.startProtocol()
         self.clock.advance(5)
@@ -330,6 +374,48 @@ class BootstrapRemoteOriginWrite(unittest.TestCase):
         self.clock.advance(3)
         return d
 
+    def test_fast_path(self):
+        self.ws.session.block_size = 6
+        self.clock.advance(0.1)
+        self.ws.datagramReceived(DATADatagram(1, b'foobar').to_wire(), ('127.0.0.1', 65465))
+        self.clock.advance(3)
+        self.transport.clear()
+        def factory(*args):
+            self.fail("The datagram factory must not be used")
+        self.patch(bootstrap, 'TFTPDatagramFactory', factory)
+        d = self.ws.datagramReceived(DATADatagram(2, b'baz').to_wire(), ('127.0.0.1', 65465))
+        def cb(res):
+            self.clock.advance(0.1)
+            self.assertEqual(self.transport.value(), ACKDatagram(2).to_wire())
+            self.assertEqual(self.target.open('r').read(), b'foobarbaz')
+            self.addCleanup(self.ws.cancel)
+        d.addCallback(cb)
+        self.clock.advance(3)
+        return d
+
+    def test_fast_path_bytes(self):
+        # IWriter.write takes bytes, the blocks are not handed over as views
+        # of the received datagrams
+        written = []
+        target = self.temp_dir.child(b'bar')
+        writer = FilesystemWriter(target)
+        def write(data):
+            written.append(data)
+            return FilesystemWriter.write(writer, data)
+        writer.write = write
+        ws = RemoteOriginWriteSession(('127.0.0.1', 65465), writer,
+                                      _clock=self.clock)
+        ws.transport = FakeTransport(hostAddress=('127.0.0.1', self.port))
+        ws.startProtocol()
+        ws.session.block_size = 3
+        self.clock.advance(0.1)
+        # The first block starts the session, the next ones take the fast path
+        ws.datagramReceived(DATADatagram(1, b'foo').to_wire(), ('127.0.0.1', 65465))
+        ws.datagramReceived(DATADatagram(2, b'ba').to_wire(), ('127.0.0.1', 65465))
+        self.assertEqual(written, [b'foo', b'ba'])
+        self.assertIs(type(written[1]), bytes)
+        self.addCleanup(ws.cancel)
+
     def tearDown(self):
         self.temp_dir.remove()
 
@@ -394,6 +480,37 @@ class RemoteOriginWriteOptionNegotiation(unittest.TestCase):
         self.assertEqual(self.transport.value(), oack_datagram * 3)
         self.assertTrue(self.transport.disconnecting)
 
+    def test_option_windowsize(self):
+        self.options[b'windowsize'] = b'2'
+        self.ws.startProtocol()
+        self.clock.advance(0.1)
+        self.transport.clear()
+        self.ws.datagramReceived(DATADatagram(1, b'foobarbaz').to_wire(), ('127.0.0.1', 65465))
+        self.clock.advance(2.1)
+        self.assertEqual(self.ws.session.window_size, 2)
+        self.assertFalse(self.transport.value())
+        self.ws.datagramReceived(DATADatagram(2, b'smthngels').to_wire(), ('127.0.0.1', 65465))
+        self.clock.advance(2.1)
+        self.assertEqual(self.transport.value(), ACKDatagram(2).to_wire())
+        self.addCleanup(self.ws.cancel)
+
+    def test_option_tsize_allocated(self):
+        self.ws.startProtocol()
+        self.assertEqual(self.writer.allocated, 45)
+        self.clock.advance(0.1)
+        self.assertEqual(self.transport.value(), OACKDatagram(self.options).to_wire())
+        self.addCleanup(self.ws.cancel)
+
+    def test_option_tsize_disk_full(self):
+        self.writer.max_size = 40
+        self.ws.startProtocol()
+        error = TFTPDatagramFactory(*split_opcode(self.transport.value()))
+        self.assertEqual(error.errorcode, ERR_DISK_FULL)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertFalse(self.target.exists())
+        self.clock.advance(10)
+        self.assertEqual(self.transport.value(), error.to_wire())
+
     def test_option_tsize(self):
         # A tsize option sent as part of a write session is recorded.
         self.ws.startProtocol()
@@ -410,6 +527,19 @@ class RemoteOriginWriteOptionNegotiation(unittest.TestCase):
         # The tsize option has been applied to the WriteSession.
         self.assertEqual(45, self.ws.session.tsize)
 
+    def test_no_options_accepted(self):
+        # None of the options are acceptable, so the transfer is acknowledged
+        # with ACK 0 instead of an empty OACK.
+        ws = RemoteOriginWriteSession(
+            ('127.0.0.1', 65465), self.writer,
+            options=OrderedDict([(b'blksize', b'foo')]), _clock=self.clock)
+        ws.transport = self.transport
+        ws.startProtocol()
+        self.clock.advance(0.1)
+        self.assertEqual(ws.resultant_options, {})
+        self.assertEqual(self.transport.value(), ACKDatagram(0).to_wire())
+        self.addCleanup(ws.cancel)
+
     def tearDown(self):
         self.temp_dir.remove()
 
@@ -554,14 +684,38 @@ anotherline"""
         self.assertFalse(self.transport.disconnecting)
         self.addCleanup(self.rs.cancel)
 
+    def test_fast_path(self):
+        self.rs.session.block_size = 5
+        self.rs.startProtocol()
+        self.clock.pump((1,)*3)
+        self.transport.clear()
+        def factory(*args):
+            self.fail("The datagram factory must not be used")
+        self.patch(bootstrap, 'TFTPDatagramFactory', factory)
+        self.rs.datagramReceived(ACKDatagram(1).to_wire(), ('127.0.0.1', 65465))
+        self.clock.pump((1,)*3)
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(2, self.test_data[5:10]).to_wire())
+        self.addCleanup(self.rs.cancel)
+
+    def test_fast_path_fallback(self):
+        self.rs.session.block_size = 5
+        self.rs.startProtocol()
+        self.clock.pump((1,)*3)
+        # Malformed ACK is still rejected by the datagram factory
+        self.assertRaises(PayloadDecodeError, self.rs.datagramReceived,
+                          ACKDatagram(1).to_wire() + b'\x00', ('127.0.0.1', 65465))
+        # Other datagrams still go the usual way
+        self.rs.datagramReceived(ERRORDatagram.from_code(ERR_TID_UNKNOWN).to_wire(),
+                                 ('127.0.0.1', 65465))
+        self.assertTrue(self.transport.disconnecting)
+
     def test_remote_origin_read_session_not_started_rollover(self):
         # if a rollover is done, we reach blocknum 0 again. But this time
         # session is already started.
         # Here we test the case where rollover has not happened yet
 
-        data_datagram = DATADatagram(1, self.test_data[:5])
-        data_datagram.opcode = OP_ACK
-        data_datagram.blocknum = 0
+        data_datagram = ACKDatagram(0)
         self.rs.session.block_size = 5
         self.clock.pump((1,)*3)
 
@@ -578,9 +732,7 @@ anotherline"""
         # if a rollover is done, we reach blocknum 0 again. But this time
         # session is already started.
         # Here we test the case where rollover has already happened
-        data_datagram = DATADatagram(1, self.test_data[:5])
-        data_datagram.opcode = OP_ACK
-        data_datagram.blocknum = 0
+        data_datagram = ACKDatagram(0)
         self.rs.session.block_size = 5
         self.rs.startProtocol()
         self.clock.pump((1,)*3)
@@ -649,6 +801,44 @@ anotherline"""
         self.assertEqual(self.transport.value(), oack_datagram * 3)
         self.assertTrue(self.transport.disconnecting)
 
+    def test_option_windowsize(self):
+        self.options[b'windowsize'] = b'2'
+        self.rs.startProtocol()
+        self.clock.advance(0.1)
+        self.transport.clear()
+        self.rs.datagramReceived(ACKDatagram(0).to_wire(), ('127.0.0.1', 65465))
+        self.clock.pump((1,)*4)
+        self.assertEqual(self.rs.session.window_size, 2)
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(1, self.test_data[:9]).to_wire() +
+                         DATADatagram(2, self.test_data[9:18]).to_wire())
+        self.addCleanup(self.rs.cancel)
+
+    def test_session_client(self):
+        # The log messages of the session are attributed to the peer's host
+        messages = []
+        self.patch(logger, 'msg',
+                   lambda level, format, *args, **kw: messages.append(kw))
+        self.rs.startProtocol()
+        self.clock.advance(0.1)
+        self.rs.datagramReceived(ACKDatagram(0).to_wire(), ('127.0.0.1', 65465))
+        # The transfer times out, as the session never gets another ACK
+        self.clock.pump((1,)*20)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.rs.session.client, '127.0.0.1')
+        self.assertTrue(messages)
+        self.assertEqual(set(kw.get('client') for kw in messages),
+                         set(['127.0.0.1']))
+
+    def test_handshake_rtt(self):
+        # The OACK/ACK exchange provides the first round-trip time sample
+        self.rs.startProtocol()
+        self.clock.advance(0)
+        self.clock.advance(0.1)
+        self.rs.datagramReceived(ACKDatagram(0).to_wire(), ('127.0.0.1', 65465))
+        self.assertAlmostEqual(self.rs.session.retransmission.srtt, 0.1)
+        self.addCleanup(self.rs.cancel)
+
     def test_option_tsize(self):
         # A tsize option of 0 sent as part of a read session prompts a tsize
         # response with the actual size of the file.
@@ -662,5 +852,21 @@ anotherline"""
         oack_datagram = OACKDatagram(self.options).to_wire()
         self.assertEqual(self.transport.value(), oack_datagram)
 
+    def test_no_options_accepted(self):
+        # The size of a netascii transfer is not known in advance, so a lone
+        # tsize option is dropped. Instead of an empty OACK, the server goes
+        # straight to the first DATA datagram.
+        options = OrderedDict([(b'tsize', b'0')])
+        rs = RemoteOriginReadSession(('127.0.0.1', 65465),
+                                     NetasciiSenderProxy(self.reader),
+                                     options=options, _clock=self.clock)
+        rs.transport = self.transport
+        rs.startProtocol()
+        self.clock.pump((1,)*3)
+        self.assertEqual(rs.resultant_options, {})
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(1, to_netascii(self.test_data)).to_wire())
+        self.addCleanup(rs.cancel)
+
     def tearDown(self):
         self.temp_dir.remove()
@@ -0,0 +1,90 @@
+'''
+@author: shylent
+'''
+from tftp.logger import Logger, DEBUG, INFO, WARNING, ERROR
+from twisted.internet.task import Clock
+from twisted.python import log
+from twisted.trial import unittest
+
+
+class Unprintable(object):
+
+    def __str__(self):
+        raise AssertionError("Formatted a message, that was not logged")
+
+
+class Logging(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.random_values = []
+        self.logger = Logger(_clock=self.clock, _random=self.random_values.pop)
+        self.messages = []
+        log.addObserver(self._observe)
+        self.addCleanup(log.removeObserver, self._observe)
+
+    def _observe(self, event):
+        self.messages.append(log.textFromEventDict(event))
+
+    def test_levels(self):
+        self.logger.debug("hidden %s", Unprintable())
+        self.logger.info("info %s", 1)
+        self.logger.warning("warning")
+        self.logger.error("error %s %s", 1, 2)
+        self.assertEqual(self.messages, ["info 1", "warning", "error 1 2"])
+        self.logger.configure(level=DEBUG)
+        self.logger.debug("debug %s", 'foo')
+        self.assertEqual(self.messages[-1], "debug foo")
+        self.assertTrue(self.logger.isEnabledFor(DEBUG))
+
+    def test_no_args(self):
+        self.logger.info("100% literal")
+        self.assertEqual(self.messages, ["100% literal"])
+
+    def test_sampling(self):
+        self.logger.configure(sample_rate=0.25)
+        self.random_values.extend([0.5, 0.1])
+        self.logger.info("first", sampled=True)
+        self.logger.info("second %s", Unprintable(), sampled=True)
+        # Not sampled messages are always logged
+        self.logger.info("third")
+        self.assertEqual(self.messages, ["first", "third"])
+        self.assertFalse(self.random_values)
+
+    def test_sampling_errors(self):
+        self.logger.configure(sample_rate=0)
+        self.logger.error("error", sampled=True)
+        self.assertEqual(self.messages, ["error"])
+
+    def test_rate_limit(self):
+        self.logger.configure(rate_limit=2)
+        for i in range(4):
+            self.logger.info("a %s", i, client='a')
+        self.logger.info("b", client='b')
+        self.assertEqual(self.messages, ["a 0", "a 1", "b"])
+        self.clock.advance(0.5)
+        self.logger.info("a %s", 4, client='a')
+        self.assertEqual(self.messages[3:],
+                         ["Suppressed 2 messages about a", "a 4"])
+        self.logger.info("a %s", Unprintable(), client='a')
+        self.assertEqual(len(self.messages), 5)
+
+    def test_burst(self):
+        self.logger.configure(rate_limit=1, burst=3)
+        for i in range(4):
+            self.logger.warning("%s", i, client='a')
+        self.assertEqual(self.messages, ["0", "1", "2"])
+
+    def test_max_clients(self):
+        self.logger.max_clients = 2
+        self.logger.configure(rate_limit=1)
+        self.logger.info("a", client='a')
+        self.logger.info("b", client='b')
+        self.logger.info("c", client='c')
+        self.assertEqual(len(self.logger._buckets), 1)
+        # Forgotten, so can log again
+        self.logger.info("a", client='a')
+        self.assertEqual(self.messages, ["a", "b", "c", "a"])
+
+    def test_level_values(self):
+        self.assertTrue(DEBUG < INFO < WARNING < ERROR)
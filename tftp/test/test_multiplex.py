@@ -0,0 +1,200 @@
+'''
+@author: shylent
+'''
+from tftp.backend import FilesystemSynchronousBackend
+from tftp.bootstrap import RemoteOriginReadSession
+from tftp.datagram import (TFTPDatagramFactory, split_opcode, ERR_TID_UNKNOWN,
+    ACKDatagram, RRQDatagram, DATADatagram)
+from tftp.multiplex import SessionMultiplexer, SessionPort, SessionTransport
+from tftp.protocol import TFTP
+from twisted.internet.address import IPv4Address
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+import tempfile
+
+
+class FakePort(object):
+
+    def __init__(self, port, protocol):
+        self.port = port
+        self.protocol = protocol
+        self.written = []
+        self.listening = True
+
+    def write(self, datagram, addr):
+        self.written.append((datagram, addr))
+
+    def getHost(self):
+        return IPv4Address('UDP', '127.0.0.1', self.port)
+
+    def stopListening(self):
+        self.listening = False
+        self.protocol.doStop()
+
+
+class FakeReactor(object):
+
+    def __init__(self):
+        self.ports = []
+        self.clock = Clock()
+        self.callLater = self.clock.callLater
+
+    def listenUDP(self, port, protocol, interface='', maxPacketSize=8192):
+        port = FakePort(10000 + len(self.ports), protocol)
+        self.ports.append(port)
+        protocol.makeConnection(port)
+        return port
+
+
+class RecordingProtocol(DatagramProtocol):
+
+    def __init__(self):
+        self.received = []
+        self.stopped = False
+
+    def datagramReceived(self, datagram, addr):
+        self.received.append((datagram, addr))
+
+    def stopProtocol(self):
+        self.stopped = True
+
+
+class StoppingProtocol(RecordingProtocol):
+
+    def startProtocol(self):
+        self.transport.stopListening()
+
+
+class Multiplexer(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.multiplexer = SessionMultiplexer(2, _reactor=self.reactor)
+        self.multiplexer.start()
+
+    def test_start(self):
+        self.assertEqual(len(self.reactor.ports), 2)
+        self.multiplexer.start()
+        self.assertEqual(len(self.reactor.ports), 2)
+        for port in self.multiplexer.ports:
+            self.assertTrue(isinstance(port, SessionPort))
+
+    def test_spread(self):
+        first, second = RecordingProtocol(), RecordingProtocol()
+        self.multiplexer.attach(first, ('127.0.0.1', 1111))
+        self.multiplexer.attach(second, ('127.0.0.1', 2222))
+        self.assertNotEqual(first.transport.getHost().port,
+                            second.transport.getHost().port)
+        self.assertEqual(len(self.reactor.ports), 2)
+
+    def test_routing(self):
+        first, second = RecordingProtocol(), RecordingProtocol()
+        self.multiplexer.attach(first, ('127.0.0.1', 1111))
+        self.multiplexer.attach(second, ('127.0.0.1', 2222))
+        self.multiplexer.attach(RecordingProtocol(), ('127.0.0.1', 3333))
+        port = self.multiplexer.ports[0]
+        port.datagramReceived(b'foo', ('127.0.0.1', 1111))
+        port.datagramReceived(b'bar', ('127.0.0.1', 3333))
+        self.assertEqual(first.received, [(b'foo', ('127.0.0.1', 1111))])
+        self.assertEqual(second.received, [])
+
+    def test_unknown_tid(self):
+        port = self.multiplexer.ports[0]
+        port.datagramReceived(ACKDatagram(1).to_wire(), ('127.0.0.1', 1111))
+        datagram, addr = self.reactor.ports[0].written[0]
+        self.assertEqual(addr, ('127.0.0.1', 1111))
+        err_dgram = TFTPDatagramFactory(*split_opcode(datagram))
+        self.assertEqual(err_dgram.errorcode, ERR_TID_UNKNOWN)
+
+    def test_write(self):
+        protocol = RecordingProtocol()
+        self.multiplexer.attach(protocol, ('127.0.0.1', 1111))
+        protocol.transport.connect('127.0.0.1', 1111)
+        protocol.transport.write(b'foo')
+        self.assertEqual(self.reactor.ports[0].written,
+                         [(b'foo', ('127.0.0.1', 1111))])
+
+    def test_same_remote(self):
+        protocols = [RecordingProtocol() for i in range(3)]
+        for protocol in protocols:
+            self.multiplexer.attach(protocol, ('127.0.0.1', 1111))
+        ports = set(p.transport.getHost().port for p in protocols)
+        self.assertEqual(len(ports), 3)
+        # The pool is exhausted for this peer, the last one got its own socket
+        self.assertEqual(len(self.reactor.ports), 3)
+        self.assertTrue(protocols[2].transport is self.reactor.ports[2])
+
+    def test_session_stop(self):
+        first, second = RecordingProtocol(), RecordingProtocol()
+        self.multiplexer.attach(first, ('127.0.0.1', 1111))
+        self.multiplexer.attach(second, ('127.0.0.1', 1111))
+        first.transport.stopListening()
+        # Detached right away, stopped on the next iteration of the reactor
+        self.assertFalse(self.multiplexer.ports[0].protocols)
+        self.assertFalse(first.stopped)
+        self.reactor.clock.advance(0)
+        self.assertTrue(first.stopped)
+        self.assertTrue(first.transport is None)
+        self.assertTrue(self.reactor.ports[0].listening)
+        self.assertTrue(second.transport is not None)
+
+    def test_session_stop_while_starting(self):
+        # The transfer fails right away, before it has even finished starting
+        protocol = StoppingProtocol()
+        self.multiplexer.attach(protocol, ('127.0.0.1', 1111))
+        self.assertFalse(self.multiplexer.ports[0].protocols)
+        self.reactor.clock.advance(0)
+        self.assertTrue(protocol.stopped)
+        self.assertTrue(protocol.transport is None)
+
+    def test_stop(self):
+        d = self.multiplexer.stop()
+        self.assertFalse(self.multiplexer.ports)
+        for port in self.reactor.ports:
+            self.assertFalse(port.listening)
+        return d
+
+    def test_stop_closed_port(self):
+        # One of the sockets is already closed
+        self.reactor.ports[0].stopListening()
+        d = self.multiplexer.stop()
+        self.assertFalse(self.multiplexer.ports)
+        self.assertFalse(self.reactor.ports[1].listening)
+        return d
+
+
+class MultiplexedDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.reactor = FakeReactor()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        with self.temp_dir.child(b'nonempty').open('w') as fd:
+            fd.write(b'Something uninteresting')
+        self.backend = FilesystemSynchronousBackend(self.temp_dir)
+        self.multiplexer = SessionMultiplexer(1, _reactor=self.reactor)
+        self.tftp = TFTP(self.backend, _clock=self.clock,
+                         multiplexer=self.multiplexer)
+
+    def test_RRQ(self):
+        d = self.tftp._startSession(RRQDatagram(b'nonempty', b'octet', {}),
+                                    ('127.0.0.1', 1111), b'octet')
+        self.clock.advance(0)
+        session = d.result
+        self.assertIsInstance(session, RemoteOriginReadSession)
+        self.assertIsInstance(session.transport, SessionTransport)
+        self.assertEqual(len(self.reactor.ports), 1)
+        datagram, addr = self.reactor.ports[0].written[0]
+        self.assertEqual(addr, ('127.0.0.1', 1111))
+        self.assertEqual(DATADatagram.from_wire(datagram[2:]).data,
+                         b'Something uninteresting')
+        session.cancel()
+        self.assertFalse(self.multiplexer.ports[0].protocols)
+
+    def test_stop(self):
+        self.tftp.multiplexer.start()
+        self.tftp.stopProtocol()
+        self.assertFalse(self.multiplexer.ports)
+        self.assertFalse(self.reactor.ports[0].listening)
@@ -3,9 +3,10 @@
 '''
 from io import BytesIO
 from tftp.netascii import (from_netascii, to_netascii, NetasciiReceiverProxy,
-    NetasciiSenderProxy)
+    NetasciiSenderProxy, NetasciiEncoder, _from_netascii_re, _to_netascii_re)
 from twisted.internet.defer import inlineCallbacks
 from twisted.trial import unittest
+import random
 import re
 import tftp
 
@@ -80,6 +81,73 @@ class ToNetascii(unittest.TestCase):
         tftp.netascii.re_to_netascii = self._orig_nl_regex
 
 
+class Equivalence(unittest.TestCase):
+    """The conversions must give the same results, as the regular expression
+    based ones, whatever the newline is.
+
+    """
+
+    def setUp(self):
+        self._orig_nl = tftp.netascii.NL
+        self._orig_nl_regex = tftp.netascii.re_to_netascii
+        self.random = random.Random(1234)
+
+    def tearDown(self):
+        tftp.netascii.NL = self._orig_nl
+        tftp.netascii.re_to_netascii = self._orig_nl_regex
+
+    def _setNewline(self, nl):
+        tftp.netascii.NL = nl
+        tftp.netascii.re_to_netascii = re.compile(
+            tftp.netascii._re_to_netascii.replace(b"NL", nl))
+
+    def _samples(self):
+        alphabet = [b'\x0d', b'\x0a', b'\x00', b'a']
+        for i in range(500):
+            length = self.random.randint(0, 12)
+            yield b''.join(self.random.choice(alphabet) for j in range(length))
+
+    def _check(self, nl):
+        self._setNewline(nl)
+        for sample in self._samples():
+            self.assertEqual(to_netascii(sample), _to_netascii_re(sample))
+            self.assertEqual(from_netascii(sample), _from_netascii_re(sample))
+
+    def test_lf_newline(self):
+        self._check(b'\x0a')
+
+    def test_cr_newline(self):
+        self._check(b'\x0d')
+
+    def test_crlf_newline(self):
+        self._check(b'\x0d\x0a')
+
+    @inlineCallbacks
+    def test_receiver_block_boundaries(self):
+        self._setNewline(b'\x0a')
+        for sample in self._samples():
+            sink = BytesIO()
+            p = NetasciiReceiverProxy(sink)
+            source = BytesIO(sample)
+            chunk = source.read(self.random.randint(1, 4))
+            while chunk:
+                yield p.write(chunk)
+                chunk = source.read(self.random.randint(1, 4))
+            # A trailing CR is held back until the next write
+            if sample.endswith(b'\x0d'):
+                sample = sample[:-1]
+            expected = _from_netascii_re(sample)
+            self.assertEqual(sink.getvalue(), expected)
+
+    @inlineCallbacks
+    def test_receiver_converted_cr_at_boundary(self):
+        sink = BytesIO()
+        p = NetasciiReceiverProxy(sink)
+        yield p.write(b'a\x0d\x00')
+        yield p.write(b'\x00b')
+        self.assertEqual(sink.getvalue(), b'a\x0d\x00b')
+
+
 class ReceiverProxy(unittest.TestCase):
 
     test_data = b"""line1
@@ -131,6 +199,12 @@ line3
         self.source = BytesIO(self.test_data)
         self.sink = BytesIO()
 
+    def test_size(self):
+        # The size of the source is not the size of the converted data
+        self.source.size = len(self.test_data)
+        p = NetasciiSenderProxy(self.source)
+        self.assertTrue(p.size is None)
+
     @inlineCallbacks
     def test_conversion_normal(self):
         p = NetasciiSenderProxy(self.source)
@@ -193,3 +267,62 @@ line3
             self.sink.write(chunk)
         self.sink.seek(0)
         self.assertEqual(self.sink.read(), to_netascii(self.test_data))
+
+    @inlineCallbacks
+    def test_no_over_reading(self):
+        p = NetasciiSenderProxy(self.source)
+        chunk = yield p.read(7)
+        self.assertEqual(chunk, b'line1\x0d\x0a')
+        self.assertEqual(self.source.tell(), 7)
+        # One byte of the original data became two, the extra one is buffered
+        chunk = yield p.read(3)
+        self.assertEqual(chunk, b'lin')
+        self.assertEqual(self.source.tell(), 9)
+
+    @inlineCallbacks
+    def test_dense(self):
+        data = b'\x0a\x0d' * 100
+        p = NetasciiSenderProxy(BytesIO(data))
+        chunks = []
+        chunk = yield p.read(3)
+        while chunk:
+            self.assertTrue(len(p._buffer) <= 6)
+            chunks.append(chunk)
+            chunk = yield p.read(3)
+        self.assertEqual(b''.join(chunks), to_netascii(data))
+        self.assertEqual(set(len(c) for c in chunks[:-1]), set([3]))
+
+
+class Encoder(unittest.TestCase):
+
+    def setUp(self):
+        self._orig_nl = tftp.netascii.NL
+        self.addCleanup(setattr, tftp.netascii, 'NL', self._orig_nl)
+
+    def test_crlf_newline_split(self):
+        tftp.netascii.NL = b'\x0d\x0a'
+        encoder = NetasciiEncoder()
+        self.assertEqual(encoder.encode(b'a\x0d'), b'a')
+        self.assertEqual(encoder.encode(b'\x0ab\x0d'), b'\x0d\x0ab')
+        self.assertEqual(encoder.encode(b'c'), b'\x0d\x00c')
+        self.assertEqual(encoder.encode(b'\x0d', final=True), b'\x0d\x00')
+
+    def test_lf_newline(self):
+        tftp.netascii.NL = b'\x0a'
+        encoder = NetasciiEncoder()
+        self.assertEqual(encoder.encode(b'a\x0d'), b'a\x0d\x00')
+        self.assertEqual(encoder.encode(b'\x0a'), b'\x0d\x0a')
+
+    @inlineCallbacks
+    def test_proxy_crlf_newline(self):
+        tftp.netascii.NL = b'\x0d\x0a'
+        data = b'line1\x0d\x0aline2\x0d\x0d\x0a\x0d'
+        for size in range(1, 8):
+            p = NetasciiSenderProxy(BytesIO(data))
+            chunks = []
+            chunk = yield p.read(size)
+            while len(chunk) == size:
+                chunks.append(chunk)
+                chunk = yield p.read(size)
+            chunks.append(chunk)
+            self.assertEqual(b''.join(chunks), to_netascii(data))
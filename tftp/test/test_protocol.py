@@ -1,15 +1,18 @@
 '''
 @author: shylent
 '''
-from tftp.backend import FilesystemSynchronousBackend, IReader, IWriter
+from tftp.backend import (FilesystemSynchronousBackend, IReader, IWriter,
+    ContentCache, CachedReader)
 from tftp.bootstrap import RemoteOriginWriteSession, RemoteOriginReadSession
 from tftp.datagram import (WRQDatagram, TFTPDatagramFactory, split_opcode,
     ERR_ILLEGAL_OP, RRQDatagram, ERR_ACCESS_VIOLATION, ERR_FILE_EXISTS,
-    ERR_FILE_NOT_FOUND, ERR_NOT_DEFINED)
+    ERR_FILE_NOT_FOUND, ERR_NOT_DEFINED, ERR_TERM_OPTION, ERRORDatagram, OP_OACK)
 from tftp.errors import (Unsupported, AccessViolation, FileExists, FileNotFound,
     BackendError)
-from tftp.netascii import NetasciiReceiverProxy, NetasciiSenderProxy
+from tftp.netascii import (NetasciiReceiverProxy, NetasciiSenderProxy,
+    to_netascii)
 from tftp.protocol import TFTP
+from tftp.util import TimerWheel
 from twisted.internet import reactor
 from twisted.internet.address import IPv4Address
 from twisted.internet.defer import Deferred, inlineCallbacks
@@ -19,6 +22,7 @@ from twisted.python import context
 from twisted.python.filepath import FilePath
 from twisted.test.proto_helpers import StringTransport
 from twisted.trial import unittest
+from collections import OrderedDict
 import tempfile
 
 
@@ -136,6 +140,204 @@ class DispatchErrors(unittest.TestCase):
         error_datagram = TFTPDatagramFactory(*split_opcode(self.transport.value()))
         self.assertEqual(error_datagram.errorcode, ERR_NOT_DEFINED)
 
+
+class CountingBackend(FilesystemSynchronousBackend):
+
+    def __init__(self, base_path):
+        super(CountingBackend, self).__init__(base_path, can_read=True)
+        self.readers = 0
+
+    def get_reader(self, file_name):
+        self.readers += 1
+        return super(CountingBackend, self).get_reader(file_name)
+
+
+class SessionTransport(FakeTransport):
+    """Stops the session, when it stops listening, after the current call, like
+    a real port does
+
+    """
+
+    def __init__(self, session, clock):
+        FakeTransport.__init__(self)
+        self.session = session
+        self.clock = clock
+
+    def stopListening(self):
+        self.clock.callLater(0, self.session.doStop)
+
+
+class DuplicateRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        with self.temp_dir.child(b'nonempty').open('w') as fd:
+            fd.write(b'Something uninteresting')
+        self.backend = CountingBackend(self.temp_dir)
+        self.tftp = TFTP(self.backend, _clock=self.clock)
+        self.tftp.transport = FakeTransport(
+            hostAddress=IPv4Address('UDP', '127.0.0.1', 1069))
+        self.sessions = []
+        self.tftp._listen = self._listen
+
+    def _listen(self, session, addr):
+        session.makeConnection(SessionTransport(session, self.clock))
+        self.sessions.append(session)
+
+    def send(self, datagram, addr=('127.0.0.1', 1111)):
+        self.tftp.datagramReceived(datagram.to_wire(), addr)
+        self.clock.advance(0)
+
+    def test_duplicate_dropped(self):
+        rrq = RRQDatagram(b'nonempty', b'octet', {b'blksize': b'1024'})
+        self.send(rrq)
+        self.send(rrq)
+        self.assertEqual(self.backend.readers, 1)
+        self.assertEqual(len(self.sessions), 1)
+
+    def test_distinct_requests(self):
+        self.send(RRQDatagram(b'nonempty', b'octet', {}))
+        self.send(RRQDatagram(b'nonempty', b'octet', {}), ('127.0.0.1', 2222))
+        self.send(RRQDatagram(b'nonempty', b'octet', {b'blksize': b'1024'}))
+        self.send(RRQDatagram(b'missing', b'octet', {}))
+        self.assertEqual(self.backend.readers, 4)
+        self.assertEqual(len(self.sessions), 3)
+
+    def test_session_ended(self):
+        rrq = RRQDatagram(b'nonempty', b'octet', {})
+        self.send(rrq)
+        self.sessions[0].cancel()
+        self.clock.advance(0)
+        self.send(rrq)
+        self.assertEqual(self.backend.readers, 2)
+        self.assertEqual(len(self.sessions), 2)
+
+    def test_probe_abort_rerequest(self):
+        # A PXE client asks for the size, aborts and asks for the file with
+        # the same request from the same port
+        rrq = RRQDatagram(b'nonempty', b'octet',
+                          OrderedDict([(b'tsize', b'0'), (b'blksize', b'1024')]))
+        self.send(rrq)
+        session = self.sessions[0]
+        self.clock.advance(0.1)
+        oack = TFTPDatagramFactory(*split_opcode(session.transport.value()))
+        self.assertEqual(oack.opcode, OP_OACK)
+        session.datagramReceived(
+            ERRORDatagram.from_code(ERR_TERM_OPTION).to_wire(), ('127.0.0.1', 1111))
+        self.clock.advance(0)
+        self.assertTrue(session.stopped.called)
+        self.send(rrq)
+        self.assertEqual(len(self.sessions), 2)
+        self.clock.advance(0.1)
+        oack = TFTPDatagramFactory(*split_opcode(self.sessions[1].transport.value()))
+        self.assertEqual(oack.opcode, OP_OACK)
+        self.sessions[1].cancel()
+
+    def test_allocation_failed(self):
+        self.tftp.backend = FilesystemSynchronousBackend(
+            self.temp_dir, can_write=True, max_upload_size=4)
+        wrq = WRQDatagram(b'upload', b'octet', {b'tsize': b'1000'})
+        self.send(wrq)
+        self.assertTrue(self.sessions[0].stopped.called)
+        self.send(wrq)
+        self.assertEqual(len(self.sessions), 2)
+
+    def test_timed_out(self):
+        rrq = RRQDatagram(b'nonempty', b'octet', {b'tsize': b'0'})
+        self.send(rrq)
+        self.clock.pump([1] * 20)
+        self.assertTrue(self.sessions[0].stopped.called)
+        self.send(rrq)
+        self.assertEqual(len(self.sessions), 2)
+        self.sessions[1].cancel()
+
+    def test_backend_error_forgotten(self):
+        rrq = RRQDatagram(b'missing', b'octet', {})
+        self.send(rrq)
+        self.tftp.transport.clear()
+        self.send(rrq)
+        self.assertEqual(self.backend.readers, 2)
+        error_datagram = TFTPDatagramFactory(*split_opcode(self.tftp.transport.value()))
+        self.assertEqual(error_datagram.errorcode, ERR_FILE_NOT_FOUND)
+
+
+class NetasciiReads(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        with self.temp_dir.child(b'nonempty').open('w') as fd:
+            fd.write(b'Something\nuninteresting')
+        self.sessions = []
+
+    def startSession(self, backend):
+        tftp = TFTP(backend, _clock=self.clock)
+        tftp.transport = FakeTransport(
+            hostAddress=IPv4Address('UDP', '127.0.0.1', 1069))
+        tftp._listen = lambda session, addr: self.sessions.append(session)
+        tftp.datagramReceived(
+            RRQDatagram(b'nonempty', b'netascii', {}).to_wire(), ('127.0.0.1', 1111))
+        self.clock.advance(0)
+        return self.sessions[-1]
+
+    def test_backend_converts(self):
+        cache = ContentCache(1024, transform=to_netascii)
+        backend = FilesystemSynchronousBackend(self.temp_dir, netascii_cache=cache)
+        session = self.startSession(backend)
+        self.assertIsInstance(session.backend, CachedReader)
+        self.assertEqual(session.backend.size,
+                         len(to_netascii(b'Something\nuninteresting')))
+        session.backend.finish()
+
+    def test_proxy(self):
+        session = self.startSession(DummyReadBackend(self.temp_dir))
+        self.assertIsInstance(session.backend, NetasciiSenderProxy)
+        session.backend.finish()
+
+
+class ReadAhead(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.addCleanup(self.temp_dir.remove)
+        with self.temp_dir.child(b'nonempty').open('w') as fd:
+            fd.write(b'Something uninteresting')
+        self.sessions = []
+
+    def startSession(self, datagram, **kwargs):
+        tftp = TFTP(FilesystemSynchronousBackend(self.temp_dir),
+                    _clock=self.clock, **kwargs)
+        tftp.transport = FakeTransport(
+            hostAddress=IPv4Address('UDP', '127.0.0.1', 1069))
+        tftp._listen = lambda session, addr: self.sessions.append(session)
+        tftp.datagramReceived(datagram.to_wire(), ('127.0.0.1', 1111))
+        self.clock.advance(0)
+        return self.sessions[-1]
+
+    def test_read_ahead(self):
+        session = self.startSession(RRQDatagram(b'nonempty', b'octet', {}),
+                                    read_ahead=4)
+        self.assertEqual(session.session.read_ahead, 4)
+        session.backend.finish()
+
+    def test_default(self):
+        session = self.startSession(RRQDatagram(b'nonempty', b'octet', {}))
+        self.assertEqual(session.session.read_ahead, 0)
+        session.backend.finish()
+
+
+class DummyReadBackend(object):
+    """A backend without C{get_netascii_reader}"""
+
+    def __init__(self, base_path):
+        self.backend = FilesystemSynchronousBackend(base_path)
+
+    def get_reader(self, file_name):
+        return self.backend.get_reader(file_name)
+
+
 class DummyClient(DatagramProtocol):
 
     def __init__(self, *args, **kwargs):
@@ -251,6 +453,14 @@ class SuccessfulAsyncDispatch(unittest.TestCase):
         self.assertTrue(d.called)
         self.assertTrue(IWriter.providedBy(d.result.backend))
 
+    def test_sessions_share_timers(self):
+        rrq_datagram = RRQDatagram(b'nonempty', b'NetASCiI', {})
+        d = self.tftp._startSession(rrq_datagram, ('127.0.0.1', 1069), b"octet")
+        self.clock.advance(1)
+        self.assertIsInstance(d.result._clock, TimerWheel)
+        self.assertIs(d.result._clock._clock, self.clock)
+        d.result.cancel()
+
 
 class CapturedContext(Exception):
     """A donkey, to carry the call context back up the stack."""
@@ -3,11 +3,15 @@
 '''
 from tftp.backend import FilesystemWriter, FilesystemReader, IReader, IWriter
 from tftp.datagram import (ACKDatagram, ERRORDatagram,
-    ERR_NOT_DEFINED, DATADatagram, TFTPDatagramFactory, split_opcode)
-from tftp.session import WriteSession, ReadSession
+    ERR_NOT_DEFINED, ERR_DISK_FULL, DATADatagram, TFTPDatagramFactory,
+    split_opcode)
+from tftp.errors import DiskFull
+from tftp.session import WriteSession, ReadSession, ReadAheadProxy
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.defer import (Deferred, fail, inlineCallbacks,
+    maybeDeferred, succeed)
 from twisted.internet.task import Clock
+from twisted.python import log
 from twisted.python.filepath import FilePath
 from twisted.test.proto_helpers import StringTransport
 from twisted.trial import unittest
@@ -192,6 +196,55 @@ class WriteSessions(unittest.TestCase):
         self.clock.advance(2)
         return d
 
+    def test_DATA_finished_slowly(self):
+        # The last block is acknowledged only after the writer stored the file
+        finished = Deferred()
+        self.writer.finish = lambda: finished.addCallback(
+            lambda ign: FilesystemWriter.finish(self.writer))
+        self.ws.block_size = 6
+        self.ws.datagramReceived(DATADatagram(1, b'foo'))
+        self.clock.advance(2.5)
+        self.assertFalse(self.transport.value())
+        # A duplicate of the last block is not acknowledged either
+        self.ws.datagramReceived(DATADatagram(1, b'foo'))
+        self.assertFalse(self.transport.value())
+        finished.callback(None)
+        self.clock.advance(0.1)
+        self.assertEqual(self.transport.value(), ACKDatagram(1).to_wire())
+        self.assertEqual(self.target.getContent(), b'foo')
+        self.addCleanup(self.ws.cancel)
+
+    def test_DATA_finish_failed(self):
+        # The file could not be stored, the client is told so instead of
+        # getting the last ACK
+        self.writer.finish = lambda: fail(DiskFull("No room for it"))
+        self.ws.block_size = 6
+        self.ws.datagramReceived(DATADatagram(1, b'foo'))
+        self.clock.advance(2.5)
+        err_dgram = TFTPDatagramFactory(*split_opcode(self.transport.value()))
+        self.assertIsInstance(err_dgram, ERRORDatagram)
+        self.assertEqual(err_dgram.errorcode, ERR_DISK_FULL)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertFalse(self.target.exists())
+        self.assertEqual(len(self.flushLoggedErrors(DiskFull)), 1)
+
+    def test_tsize_mismatch(self):
+        self.ws.block_size = 6
+        self.ws.tsize = 10
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+        d = self.ws.datagramReceived(DATADatagram(1, b'foo'))
+        self.clock.advance(2)
+        def cb(ign):
+            self.assertEqual(self.ws.bytes_received, 3)
+            self.assertIn("Transfer size mismatch: 10 bytes were announced, "
+                          "3 bytes were received",
+                          [log.textFromEventDict(m) for m in messages])
+            self.ws.cancel()
+        d.addCallback(cb)
+        return d
+
     def test_DATA_backoff(self):
         self.ws.block_size = 5
 
@@ -247,6 +300,105 @@ class WriteSessions(unittest.TestCase):
         self.temp_dir.remove()
 
 
+class WindowedWriteSessions(unittest.TestCase):
+
+    port = 65466
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.target = self.temp_dir.child(b'foo')
+        self.writer = FilesystemWriter(self.target)
+        self.transport = FakeTransport(hostAddress=('127.0.0.1', self.port))
+        self.ws = WriteSession(self.writer, _clock=self.clock)
+        self.ws.block_size = 3
+        self.ws.window_size = 3
+        self.ws.transport = self.transport
+        self.ws.startProtocol()
+
+    def receive(self, *blocknums):
+        for n in blocknums:
+            self.ws.datagramReceived(DATADatagram(n, b'%03d' % n))
+        self.clock.advance(0.1)
+
+    def test_ACK_per_window(self):
+        self.receive(1, 2)
+        self.assertFalse(self.transport.value())
+        self.receive(3)
+        self.assertEqual(self.transport.value(), ACKDatagram(3).to_wire())
+        self.transport.clear()
+        self.receive(4, 5, 6)
+        self.assertEqual(self.transport.value(), ACKDatagram(6).to_wire())
+        self.addCleanup(self.ws.cancel)
+
+    def test_last_block_ACKed(self):
+        self.receive(1)
+        self.ws.datagramReceived(DATADatagram(2, b'x'))
+        self.clock.advance(0.1)
+        self.assertEqual(self.transport.value(), ACKDatagram(2).to_wire())
+        self.assertTrue(self.ws.completed)
+        self.assertEqual(self.target.getContent(), b'001x')
+
+    def test_gap(self):
+        self.receive(1, 3, 4)
+        # The gap is reported once, naming the last block received in order
+        self.assertEqual(self.transport.value(), ACKDatagram(1).to_wire())
+        self.assertFalse(self.transport.disconnecting)
+        self.transport.clear()
+        # The sender starts the next window after the acknowledged block
+        self.receive(2, 3, 4)
+        self.assertEqual(self.transport.value(), ACKDatagram(4).to_wire())
+        self.addCleanup(self.ws.cancel)
+
+    def test_window_timeout(self):
+        self.receive(1, 2)
+        self.assertFalse(self.transport.value())
+        self.clock.advance(2)
+        # The rest of the window did not arrive, acknowledge what we have
+        self.assertEqual(self.transport.value(), ACKDatagram(2).to_wire())
+        self.transport.clear()
+        self.receive(3, 4)
+        self.assertFalse(self.transport.value())
+        self.receive(5)
+        self.assertEqual(self.transport.value(), ACKDatagram(5).to_wire())
+        self.addCleanup(self.ws.cancel)
+
+    def test_lost_ACK(self):
+        self.receive(1, 2, 3)
+        self.transport.clear()
+        # The whole window is sent again, only the end of it is acknowledged
+        self.receive(1, 2, 3)
+        self.assertEqual(self.transport.value(), ACKDatagram(3).to_wire())
+        self.addCleanup(self.ws.cancel)
+
+    def test_pending_writes(self):
+        # The writer is slower, than the sender, so the writes of a whole
+        # window are in progress at the same time
+        self.ws.writer = DelayedWriter(self.temp_dir.child(b'bar'),
+                                       _clock=self.clock, delay=1)
+        self.ws.window_size = 4
+        for n in range(1, 5):
+            self.ws.datagramReceived(DATADatagram(n, b'%03d' % n))
+        self.clock.advance(1)
+        self.assertEqual(self.transport.value(), ACKDatagram(4).to_wire())
+        self.transport.clear()
+        for n in range(5, 9):
+            self.ws.datagramReceived(DATADatagram(n, b'%03d' % n))
+        self.clock.advance(1)
+        self.assertEqual(self.transport.value(), ACKDatagram(8).to_wire())
+        self.transport.clear()
+        # Only the timer of the last block is running, none of the earlier
+        # blocks are acknowledged again
+        self.clock.pump((1,)*3)
+        sent = self.transport.value()
+        self.assertTrue(sent)
+        self.assertEqual(sent.replace(ACKDatagram(8).to_wire(), b''), b'')
+        self.addCleanup(self.ws.cancel)
+
+    def tearDown(self):
+        self.temp_dir.remove()
+
+
 class ReadSessions(unittest.TestCase):
     test_data = b"""line1
 line2
@@ -379,3 +531,300 @@ anotherline"""
 
     def tearDown(self):
         self.temp_dir.remove()
+
+
+class WindowedReadSessions(unittest.TestCase):
+    test_data = b"""line1
+line2
+anotherline"""
+    port = 65466
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.target = self.temp_dir.child(b'foo')
+        with self.target.open('wb') as temp_fd:
+            temp_fd.write(self.test_data)
+        self.reader = DelayedReader(self.target, _clock=self.clock, delay=1)
+        self.transport = FakeTransport(hostAddress=('127.0.0.1', self.port))
+        self.rs = ReadSession(self.reader, _clock=self.clock)
+        self.rs.block_size = 5
+        self.rs.window_size = 3
+        self.rs.transport = self.transport
+        self.rs.startProtocol()
+
+    def blocks(self, *blocknums):
+        return b''.join(
+            DATADatagram(n, self.test_data[(n - 1) * 5:n * 5]).to_wire()
+            for n in blocknums)
+
+    def test_window(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.assertEqual(self.transport.value(), self.blocks(1, 2, 3))
+        self.addCleanup(self.rs.cancel)
+
+    def test_batched_window(self):
+        batches = []
+        self.transport.writeDatagrams = batches.append
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.assertEqual(b''.join(batches[0]), self.blocks(1, 2, 3))
+        self.assertEqual(len(batches[0]), 3)
+        self.assertFalse(self.transport.value())
+        self.addCleanup(self.rs.cancel)
+
+    def test_cumulative_ACK(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.transport.clear()
+        self.clock.advance(0.5)
+        self.rs.datagramReceived(ACKDatagram(3))
+        self.clock.pump((1,)*3)
+        self.assertEqual(self.transport.value(), self.blocks(4, 5))
+        self.assertTrue(self.rs.completed)
+
+        self.transport.clear()
+        self.rs.datagramReceived(ACKDatagram(5))
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_partial_ACK(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.transport.clear()
+        # Block 3 was lost, the window is sent again starting after block 2
+        self.rs.datagramReceived(ACKDatagram(2))
+        self.clock.pump((1,)*2)
+        self.assertEqual(self.transport.value(), self.blocks(3, 4, 5))
+        self.addCleanup(self.rs.cancel)
+
+    def test_gap_ACK(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.transport.clear()
+        # Block 1 was lost, the peer acknowledges the block before the window.
+        # The window is sent again without waiting for the timeout.
+        self.rs.datagramReceived(ACKDatagram(0))
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), self.blocks(1, 2, 3))
+        self.assertFalse(self.transport.disconnecting)
+        self.addCleanup(self.rs.cancel)
+
+    def test_duplicate_ACK(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.rs.datagramReceived(ACKDatagram(3))
+        self.clock.pump((1,)*3)
+        self.transport.clear()
+        # The window is sent again once, the copies of the ACK are ignored
+        self.rs.datagramReceived(ACKDatagram(3))
+        self.rs.datagramReceived(ACKDatagram(3))
+        self.clock.advance(0.1)
+        self.assertEqual(self.transport.value(), self.blocks(4, 5))
+        self.assertFalse(self.transport.disconnecting)
+        self.addCleanup(self.rs.cancel)
+
+    def test_gap_ACK_new_window(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.rs.datagramReceived(ACKDatagram(0))
+        self.rs.datagramReceived(ACKDatagram(2))
+        self.clock.pump((1,)*2)
+        self.transport.clear()
+        # Every window may be sent again once
+        self.rs.datagramReceived(ACKDatagram(2))
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), self.blocks(3, 4, 5))
+        self.addCleanup(self.rs.cancel)
+
+    def test_ACK_while_reading(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.rs.datagramReceived(ACKDatagram(1))
+        self.clock.advance(0.5)
+        # Block 4 is still being read, when blocks 2 and 3 are acknowledged
+        self.rs.datagramReceived(ACKDatagram(3))
+        self.transport.clear()
+        self.clock.pump((1,)*2)
+        self.assertEqual(self.transport.value(), self.blocks(4, 5))
+        self.addCleanup(self.rs.cancel)
+
+    def test_window_backoff(self):
+        self.rs.nextBlock()
+        self.clock.pump((1,)*3)
+        self.transport.clear()
+        self.clock.pump((1,)*2)
+        self.assertEqual(self.transport.value(), self.blocks(1, 2, 3))
+        self.clock.pump((1,)*2)
+        self.assertEqual(self.transport.value(), self.blocks(1, 2, 3) * 2)
+        self.clock.pump((1,)*2)
+        self.assertTrue(self.transport.disconnecting)
+
+    def tearDown(self):
+        self.temp_dir.remove()
+
+
+class AdaptiveRetransmission(unittest.TestCase):
+    test_data = b"""line1
+line2
+anotherline"""
+    port = 65466
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.target = self.temp_dir.child(b'foo')
+        with self.target.open('wb') as temp_fd:
+            temp_fd.write(self.test_data)
+        self.reader = FilesystemReader(self.target)
+        self.transport = FakeTransport(hostAddress=('127.0.0.1', self.port))
+        self.rs = ReadSession(self.reader, _clock=self.clock)
+        self.rs.block_size = 5
+        self.rs.transport = self.transport
+        self.rs.startProtocol()
+
+    def test_retransmit_after_rtt(self):
+        self.rs.nextBlock()
+        self.clock.advance(0)
+        self.clock.advance(0.1)
+        self.rs.datagramReceived(ACKDatagram(1))
+        self.clock.advance(0)
+        self.transport.clear()
+        # Round-trip time was 0.1s, so we don't wait for the full 2 seconds
+        self.clock.advance(0.5)
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(2, self.test_data[5:10]).to_wire())
+        self.addCleanup(self.rs.cancel)
+
+    def test_karn(self):
+        self.rs.nextBlock()
+        self.clock.advance(0)
+        self.clock.advance(2)
+        # Block 1 was retransmitted, the ACK is not used as a sample
+        self.rs.datagramReceived(ACKDatagram(1))
+        self.assertTrue(self.rs.retransmission.srtt is None)
+        self.addCleanup(self.rs.cancel)
+
+    def tearDown(self):
+        self.temp_dir.remove()
+
+
+class ReadAhead(unittest.TestCase):
+    test_data = b"""line1
+line2
+anotherline"""
+    port = 65466
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.target = self.temp_dir.child(b'foo')
+        with self.target.open('wb') as temp_fd:
+            temp_fd.write(self.test_data)
+        self.reader = DelayedReader(self.target, _clock=self.clock, delay=1)
+        self.transport = FakeTransport(hostAddress=('127.0.0.1', self.port))
+
+    def test_blocks_in_order(self):
+        proxy = ReadAheadProxy(self.reader, 2)
+        results = []
+        for i in range(5):
+            maybeDeferred(proxy.read, 5).addCallback(results.append)
+            self.clock.advance(1)
+        self.assertEqual(b''.join(results), self.test_data)
+        self.assertEqual(len(results[-1]), 3)
+        proxy.finish()
+
+    def test_read_ahead(self):
+        proxy = ReadAheadProxy(self.reader, 2)
+        proxy.read(5)
+        self.clock.pump((1,)*3)
+        # Two more blocks were read while the first one was in use
+        self.assertEqual(proxy.read(5), self.test_data[5:10])
+        self.assertEqual(proxy.read(5), self.test_data[10:15])
+        proxy.finish()
+
+    def test_failed_read(self):
+        proxy = ReadAheadProxy(FailingReader(), 2)
+        return self.assertFailure(proxy.read(5), IOError)
+
+    def test_session(self):
+        rs = ReadSession(self.reader, _clock=self.clock)
+        rs.block_size = 5
+        rs.read_ahead = 2
+        rs.transport = self.transport
+        rs.startProtocol()
+        rs.nextBlock()
+        self.clock.pump((1,)*2)
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(1, self.test_data[:5]).to_wire())
+        self.transport.clear()
+        rs.datagramReceived(ACKDatagram(1))
+        self.clock.advance(0)
+        # The next block does not have to be read first
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(2, self.test_data[5:10]).to_wire())
+        rs.cancel()
+        self.assertTrue(self.reader.file_obj.closed)
+
+    def tearDown(self):
+        self.temp_dir.remove()
+
+
+class SynchronousBackends(unittest.TestCase):
+    test_data = b"""line1
+line2
+anotherline"""
+    port = 65466
+
+    def setUp(self):
+        self.clock = Clock()
+        self.temp_dir = FilePath(tempfile.mkdtemp()).asBytesMode()
+        self.source = self.temp_dir.child(b'foo')
+        with self.source.open('wb') as temp_fd:
+            temp_fd.write(self.test_data)
+        self.transport = FakeTransport(hostAddress=('127.0.0.1', self.port))
+
+    def test_reader(self):
+        rs = ReadSession(FilesystemReader(self.source), _clock=self.clock)
+        rs.block_size = 5
+        rs.transport = self.transport
+        rs.startProtocol()
+        self.assertFalse(isinstance(rs.nextBlock(), Deferred))
+        self.assertFalse(rs._filling)
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(1, self.test_data[:5]).to_wire())
+        rs.cancel()
+
+    def test_reader_returns_deferred(self):
+        reader = FilesystemReader(self.source)
+        read = reader.read
+        reader.read = lambda size: succeed(read(size))
+        rs = ReadSession(reader, _clock=self.clock)
+        rs.block_size = 5
+        rs.transport = self.transport
+        rs.startProtocol()
+        self.assertTrue(isinstance(rs.nextBlock(), Deferred))
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(),
+                         DATADatagram(1, self.test_data[:5]).to_wire())
+        rs.cancel()
+
+    def test_writer(self):
+        target = self.temp_dir.child(b'bar')
+        ws = WriteSession(FilesystemWriter(target), _clock=self.clock)
+        ws.block_size = 3
+        ws.transport = self.transport
+        ws.startProtocol()
+        self.assertFalse(isinstance(ws.datagramReceived(DATADatagram(1, b'foo')),
+                                    Deferred))
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), ACKDatagram(1).to_wire())
+        ws.datagramReceived(DATADatagram(2, b'x'))
+        self.clock.advance(0)
+        self.assertTrue(ws.completed)
+        self.assertEqual(target.getContent(), b'foox')
+        ws.cancel()
+
+    def tearDown(self):
+        self.temp_dir.remove()
@@ -1,7 +1,9 @@
 '''
 @author: shylent
 '''
-from tftp.util import SequentialCall, Spent, Cancelled
+from tftp.util import (SequentialCall, Spent, Cancelled, RetransmissionPolicy,
+    TimerWheel)
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
 from twisted.internet.task import Clock
 from twisted.trial import unittest
 
@@ -66,3 +68,144 @@ class SequentialCalling(unittest.TestCase):
         self.assertRaises(Cancelled, c.cancel)
         self.assertEqual(self.t.call_num, 0)
         self.assertRaises(Cancelled, c.reschedule)
+
+
+class Retransmission(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.policy = RetransmissionPolicy(self.clock)
+
+    def test_no_samples(self):
+        self.assertEqual(self.policy.timeouts((1, 3, 7)), (1, 3, 7))
+
+    def test_sample(self):
+        self.policy.transmitted()
+        self.clock.advance(0.1)
+        self.policy.acknowledged()
+        self.assertAlmostEqual(self.policy.srtt, 0.1)
+        self.assertAlmostEqual(self.policy.rttvar, 0.05)
+        timeouts = self.policy.timeouts((1, 3, 7))
+        self.assertAlmostEqual(timeouts[0], 0.3)
+        self.assertAlmostEqual(timeouts[1], 0.6)
+        self.assertAlmostEqual(timeouts[2], 1.2)
+
+    def test_bounds(self):
+        self.policy.sample(5)
+        self.assertEqual(self.policy.timeouts((1, 3, 7)), (1, 3, 7))
+
+    def test_min_timeout(self):
+        self.policy.sample(0)
+        self.assertEqual(self.policy.timeouts((1,)), (self.policy.min_timeout,))
+
+    def test_karn(self):
+        self.policy.transmitted()
+        self.clock.advance(0.1)
+        self.policy.transmitted()
+        self.clock.advance(0.1)
+        self.policy.acknowledged()
+        self.assertTrue(self.policy.srtt is None)
+
+    def test_backoff(self):
+        self.policy.sample(0.1)
+        first = self.policy.timeouts((10,))[0]
+        self.policy.transmitted()
+        self.policy.transmitted()
+        self.assertAlmostEqual(self.policy.timeouts((10,))[0], first * 2)
+        self.policy.acknowledged()
+        # The backoff is kept until there is a new sample
+        self.assertAlmostEqual(self.policy.timeouts((10,))[0], first * 2)
+        self.policy.sample(0.1)
+        self.assertEqual(self.policy.backoff, 0)
+
+
+class TimerWheels(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(resolution=0.1, slots=8, _clock=self.clock)
+        self.f = CallCounter()
+
+    def test_call(self):
+        call = self.wheel.callLater(1, self.f)
+        self.clock.advance(0.95)
+        self.assertEqual(self.f.call_num, 0)
+        self.assertTrue(call.active())
+        self.clock.advance(0.05)
+        self.assertEqual(self.f.call_num, 1)
+        self.assertFalse(call.active())
+        self.assertRaises(AlreadyCalled, call.cancel)
+
+    def test_coarse(self):
+        self.wheel.callLater(0.42, self.f)
+        self.clock.advance(0.45)
+        self.assertEqual(self.f.call_num, 0)
+        self.clock.advance(0.05)
+        self.assertEqual(self.f.call_num, 1)
+
+    def test_zero_delay(self):
+        self.wheel.callLater(0, self.f)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        self.assertEqual(self.f.call_num, 1)
+
+    def test_single_ticker(self):
+        for i in range(10):
+            self.wheel.callLater(1 + i, self.f)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_cancel(self):
+        call = self.wheel.callLater(1, self.f)
+        call.cancel()
+        self.assertRaises(AlreadyCancelled, call.cancel)
+        self.clock.pump((0.1,) * 20)
+        self.assertEqual(self.f.call_num, 0)
+        # Stops ticking, when there is nothing to run
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_reset(self):
+        call = self.wheel.callLater(1, self.f)
+        self.clock.advance(0.5)
+        call.reset(1)
+        self.clock.advance(0.9)
+        self.assertEqual(self.f.call_num, 0)
+        self.clock.advance(0.1)
+        self.assertEqual(self.f.call_num, 1)
+
+    def test_past_revolution(self):
+        # 8 slots of 0.1s - the wheel turns every 0.8 seconds
+        call = self.wheel.callLater(2, self.f)
+        self.clock.pump((0.1,) * 19)
+        self.assertEqual(self.f.call_num, 0)
+        self.assertTrue(call.active())
+        self.clock.advance(0.1)
+        self.assertEqual(self.f.call_num, 1)
+
+    def test_late_ticks(self):
+        self.wheel.callLater(1, self.f)
+        self.wheel.callLater(3, self.f)
+        self.clock.advance(10)
+        self.assertEqual(self.f.call_num, 2)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_order(self):
+        calls = []
+        self.wheel.callLater(0.35, calls.append, 2)
+        self.wheel.callLater(0.32, calls.append, 1)
+        self.clock.advance(0.4)
+        self.assertEqual(calls, [1, 2])
+
+    def test_schedule_from_call(self):
+        def f():
+            self.f()
+            if self.f.call_num < 3:
+                self.wheel.callLater(0.5, f)
+        self.wheel.callLater(0.5, f)
+        self.clock.pump((0.1,) * 15)
+        self.assertEqual(self.f.call_num, 3)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 0)
+
+    def test_sequential_call(self):
+        SequentialCall.run((1, 1), self.f, on_timeout=self.f, _clock=self.wheel)
+        self.clock.pump((0.1,) * 20)
+        self.assertEqual(self.f.call_num, 3)
@@ -4,8 +4,8 @@
 import struct
 from tftp.datagram import (split_opcode, WireProtocolError, TFTPDatagramFactory,
     RQDatagram, DATADatagram, ACKDatagram, ERRORDatagram, errors, OP_RRQ, OP_WRQ,
-    OACKDatagram)
-from tftp.errors import OptionsDecodeError
+    OACKDatagram, encode_data, encode_ack, decode_data, decode_ack)
+from tftp.errors import OptionsDecodeError, PayloadDecodeError
 from twisted.trial import unittest
 
 
@@ -149,3 +149,39 @@ class ConcreteDatagrams(unittest.TestCase):
             data = struct.pack(b"!H", errorcode) + b"message\x00"
             dgram = ERRORDatagram.from_wire(data)
             self.assertEqual(dgram.errorcode, errorcode)
+
+
+class Codec(unittest.TestCase):
+
+    def test_encode_data(self):
+        self.assertEqual(encode_data(3, b'foobar'),
+                         DATADatagram(3, b'foobar').to_wire())
+        self.assertEqual(encode_data(3, memoryview(b'xfoobar')[1:]),
+                         b'\x00\x03\x00\x03foobar')
+
+    def test_encode_ack(self):
+        self.assertEqual(encode_ack(65535), ACKDatagram(65535).to_wire())
+
+    def test_decode_data(self):
+        blocknum, data = decode_data(b'\x00\x03\x00\x07foobar')
+        self.assertEqual(blocknum, 7)
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(data.tobytes(), b'foobar')
+        blocknum, data = decode_data(memoryview(b'\x00\x03\x00\x01'))
+        self.assertEqual((blocknum, data.tobytes()), (1, b''))
+
+    def test_decode_data_errors(self):
+        self.assertRaises(PayloadDecodeError, decode_data, b'\x00\x03\x00')
+        self.assertRaises(PayloadDecodeError, decode_data, ACKDatagram(1).to_wire())
+
+    def test_decode_ack(self):
+        self.assertEqual(decode_ack(b'\x00\x04\x01\x02'), 258)
+        self.assertEqual(decode_ack(memoryview(b'\x00\x04\x00\x01')), 1)
+        self.assertRaises(PayloadDecodeError, decode_ack, b'\x00\x04\x00')
+        self.assertRaises(PayloadDecodeError, decode_ack, b'\x00\x04\x00\x01\x00')
+        self.assertRaises(PayloadDecodeError, decode_ack, b'\x00\x03\x00\x01')
+
+    def test_slots(self):
+        for datagram in (DATADatagram(1, b'foo'), ACKDatagram(1),
+                         ERRORDatagram.from_code(1)):
+            self.assertFalse(hasattr(datagram, '__dict__'))
@@ -0,0 +1,97 @@
+'''
+@author: shylent
+'''
+from tftp.workers import listenReusePort, ReusePortUDPServer, WorkerPool
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+import socket
+import sys
+
+
+class FakeProcessTransport(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class FakeProcessReactor(Clock):
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, protocol, executable, args, env=None):
+        self.processes.append((protocol, executable, args))
+        transport = FakeProcessTransport(len(self.processes))
+        protocol.makeConnection(transport)
+        return transport
+
+
+class ReusePort(unittest.TestCase):
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        skip = "SO_REUSEPORT is not supported on this platform"
+
+    def test_shared_port(self):
+        first = listenReusePort(0, DatagramProtocol(), '127.0.0.1')
+        self.addCleanup(first.stopListening)
+        port_num = first.getHost().port
+        second = listenReusePort(port_num, DatagramProtocol(), '127.0.0.1')
+        self.addCleanup(second.stopListening)
+        self.assertEqual(second.getHost().port, port_num)
+
+    def test_service(self):
+        protocol = DatagramProtocol()
+        server = ReusePortUDPServer(0, protocol, '127.0.0.1')
+        server.startService()
+        self.assertTrue(protocol.transport is not None)
+        d = server.stopService()
+        def cb(ign):
+            self.assertTrue(protocol.transport is None)
+        d.addCallback(cb)
+        return d
+
+
+class Workers(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.pool = WorkerPool(3, ['tftp', '--reuse-port'], _reactor=self.reactor)
+        self.pool.startService()
+
+    def test_start(self):
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertEqual(len(self.pool.workers), 3)
+        protocol, executable, args = self.reactor.processes[0]
+        self.assertEqual(executable, sys.executable)
+        self.assertEqual(args, [sys.executable, '-m', 'twisted',
+                                '--log-format=text', 'tftp', '--reuse-port'])
+        self.assertEqual(protocol.pid, 1)
+
+    def test_restart(self):
+        worker = self.pool.workers[0]
+        worker.processEnded(Failure(ProcessTerminated(1)))
+        self.assertEqual(len(self.pool.workers), 2)
+        self.reactor.advance(self.pool.restart_delay)
+        self.assertEqual(len(self.reactor.processes), 4)
+        self.assertEqual(len(self.pool.workers), 3)
+
+    def test_stop(self):
+        workers = list(self.pool.workers)
+        d = self.pool.stopService()
+        for worker in workers:
+            self.assertEqual(worker.transport.signals, ['TERM'])
+        self.assertFalse(d.called)
+        for worker in workers:
+            worker.processEnded(Failure(ProcessDone(0)))
+        self.assertTrue(d.called)
+        self.reactor.advance(self.pool.restart_delay)
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertFalse(self.pool.workers)
@@ -4,9 +4,13 @@
 from functools import wraps
 from twisted.internet import reactor
 from twisted.internet.defer import maybeDeferred
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.python import log
+import math
 
 
-__all__ = ['SequentialCall', 'Spent', 'Cancelled', 'deferred']
+__all__ = ['SequentialCall', 'Spent', 'Cancelled', 'RetransmissionPolicy',
+           'TimerWheel', 'deferred']
 
 
 class Spent(Exception):
@@ -124,6 +128,256 @@ class SequentialCall(object):
         return not (self._spent or self._cancelled)
 
 
+class RetransmissionPolicy(object):
+    """Estimates the round-trip time of a transfer and derives retransmission
+    timeouts from it, as described in U{RFC6298<http://tools.ietf.org/html/rfc6298>}.
+
+    The session calls L{transmitted} every time it sends a datagram, that expects
+    a response, and L{acknowledged} when the response arrives. Round-trip times
+    are only sampled for datagrams, that were not retransmitted (Karn's rule).
+    Every retransmission doubles the following timeouts until a new sample is
+    taken.
+
+    Until the first sample is taken, the timeouts are not changed at all. After
+    that, the timeouts, that the session would use otherwise, serve as upper
+    bounds.
+
+    @cvar min_timeout: the lower bound for any timeout value, in seconds
+    @type min_timeout: C{float}
+
+    @cvar granularity: clock granularity, in seconds
+    @type granularity: C{float}
+
+    @cvar max_backoff: the timeouts are doubled at most this many times
+    @type max_backoff: C{int}
+
+    @ivar srtt: smoothed round-trip time or C{None}, if there were no samples yet
+    @type srtt: C{float} or C{NoneType}
+
+    @ivar rttvar: round-trip time variation or C{None}, if there were no
+    samples yet
+    @type rttvar: C{float} or C{NoneType}
+
+    @ivar backoff: how many times the timeouts have been doubled
+    @type backoff: C{int}
+
+    """
+    min_timeout = 0.2
+    granularity = 0.01
+    max_backoff = 8
+
+    def __init__(self, _clock=None):
+        self.srtt = self.rttvar = None
+        self.backoff = 0
+        self._sent_at = None
+        self._retransmitted = False
+        if _clock is None:
+            self._clock = reactor
+        else:
+            self._clock = _clock
+
+    @property
+    def rto(self):
+        """The current retransmission timeout or C{None}, if it is not known yet"""
+        if self.srtt is None:
+            return None
+        return self.srtt + max(self.granularity, 4 * self.rttvar)
+
+    def timeouts(self, bounds):
+        """Return the timeout values for the next datagram.
+
+        @param bounds: the timeout values, that would be used without an
+        estimate. Every returned value is no more, than the corresponding bound.
+        @type bounds: any iterable
+
+        @rtype: C{tuple}
+
+        """
+        bounds = tuple(bounds)
+        rto = self.rto
+        if rto is None:
+            return bounds
+        return tuple(min(bound, max(self.min_timeout, rto * 2 ** (self.backoff + i)))
+                     for i, bound in enumerate(bounds))
+
+    def transmitted(self):
+        """A datagram has been sent (or sent again)"""
+        if self._sent_at is None:
+            self._sent_at = self._clock.seconds()
+        else:
+            self._retransmitted = True
+            self.backoff = min(self.backoff + 1, self.max_backoff)
+
+    def acknowledged(self):
+        """A response to the last datagram has arrived"""
+        if self._sent_at is not None and not self._retransmitted:
+            self.sample(self._clock.seconds() - self._sent_at)
+        self._sent_at = None
+        self._retransmitted = False
+
+    def sample(self, rtt):
+        """Update the estimate with a measured round-trip time
+
+        @param rtt: round-trip time, in seconds
+        @type rtt: C{float}
+
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.backoff = 0
+
+
+class WheelCall(object):
+    """A call, scheduled with a L{TimerWheel}. Can be cancelled and
+    rescheduled, like a L{DelayedCall<twisted.internet.base.DelayedCall>}.
+
+    """
+
+    def __init__(self, wheel, time, func, args, kw):
+        self.wheel = wheel
+        self.time = time
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.tick = None
+        self.cancelled = self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self.cancelled = True
+        self.wheel._disarm(self)
+
+    def reset(self, secondsFromNow):
+        """Reschedule this call to C{secondsFromNow} seconds from now"""
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self.wheel._disarm(self)
+        self.time = self.wheel.seconds() + secondsFromNow
+        self.wheel._arm(self)
+
+
+class TimerWheel(object):
+    """A coarse-grained scheduler for retransmission and timeout calls. Provides
+    C{callLater} and C{seconds} of L{IReactorTime<twisted.internet.interfaces.IReactorTime>},
+    so it can be passed as C{_clock} to the sessions.
+
+    Calls are kept in L{slots} buckets by the tick, that they are due at, so
+    that scheduling, cancelling and rescheduling a call take constant time,
+    and the underlying clock only has a single pending call - for the next
+    tick, when there is anything to run at all. Calls are run at the first tick
+    after they are due, i.e. up to L{resolution} seconds late. Calls, that are
+    due in zero seconds, are passed to the underlying clock as is.
+
+    This is a hashed wheel: the calls, that are due more, than a revolution of
+    the wheel, later, share the buckets with the nearer ones and are skipped,
+    until their tick comes.
+
+    @param resolution: the length of a tick, in seconds
+    @type resolution: C{float}
+
+    @param slots: the number of buckets
+    @type slots: C{int}
+
+    """
+
+    def __init__(self, resolution=0.05, slots=1024, _clock=None):
+        self.resolution = resolution
+        self.slots = slots
+        if _clock is None:
+            self._clock = reactor
+        else:
+            self._clock = _clock
+        self._buckets = [{} for i in range(slots)]
+        self._base = self._clock.seconds()
+        self._tick = 0
+        self._pending = 0
+        self._ticker = None
+
+    def seconds(self):
+        return self._clock.seconds()
+
+    def callLater(self, delay, f, *args, **kw):
+        if delay <= 0:
+            return self._clock.callLater(delay, f, *args, **kw)
+        call = WheelCall(self, self.seconds() + delay, f, args, kw)
+        self._arm(call)
+        return call
+
+    def _tickAt(self, when):
+        return (when - self._base) / self.resolution
+
+    def _arm(self, call):
+        if not self._pending:
+            # Nothing could have been missed, while the wheel was idle
+            self._tick = int(math.floor(self._tickAt(self.seconds()) + 1e-9))
+        # The epsilons guard against the float error in the divisions
+        call.tick = max(int(math.ceil(self._tickAt(call.time) - 1e-9)),
+                        self._tick + 1)
+        self._buckets[call.tick % self.slots][call] = None
+        self._pending += 1
+        if self._ticker is None:
+            self._schedule()
+
+    def _disarm(self, call):
+        bucket = self._buckets[call.tick % self.slots]
+        if call in bucket:
+            del bucket[call]
+            self._pending -= 1
+            if not self._pending and self._ticker is not None:
+                self._ticker.cancel()
+                self._ticker = None
+
+    def _schedule(self):
+        delay = self._base + (self._tick + 1) * self.resolution - self.seconds()
+        self._ticker = self._clock.callLater(max(delay - 1e-9, 0), self._advance)
+
+    def _advance(self):
+        self._ticker = None
+        now_tick = int(math.floor(self._tickAt(self.seconds()) + 1e-9))
+        if now_tick - self._tick > self.slots:
+            # Fell behind by more than a revolution, just look at every bucket
+            self._run(self._buckets, now_tick)
+            self._tick = now_tick
+        while self._tick < now_tick:
+            self._tick += 1
+            self._run([self._buckets[self._tick % self.slots]], self._tick)
+        if self._pending and self._ticker is None:
+            self._schedule()
+
+    def _run(self, buckets, tick):
+        due = []
+        for bucket in buckets:
+            for call in list(bucket):
+                if call.tick <= tick:
+                    del bucket[call]
+                    self._pending -= 1
+                    due.append(call)
+        due.sort(key=lambda c: c.time)
+        for call in due:
+            if call.cancelled:
+                continue
+            call.called = True
+            try:
+                call.func(*call.args, **call.kw)
+            except Exception:
+                log.err()
+
+
 def deferred(func):
     """Decorates a function to ensure that it always returns a `Deferred`.
 
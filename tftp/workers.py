@@ -0,0 +1,156 @@
+'''
+Serving from several processes, that share the listening port.
+'''
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.internet.abstract import isIPv6Address
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+import os
+import socket
+import sys
+
+
+def listenReusePort(port, protocol, interface='', maxPacketSize=8192,
+                    _reactor=None):
+    """Like L{listenUDP<twisted.internet.interfaces.IReactorUDP.listenUDP>},
+    but binds the socket with C{SO_REUSEPORT}, so that several processes may
+    listen on the same port and the kernel spreads the incoming datagrams
+    between them.
+
+    @raise NotImplementedError: if the platform does not support C{SO_REUSEPORT}
+
+    @return: the listening port
+    @rtype: L{IListeningPort<twisted.internet.interfaces.IListeningPort>}
+
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise NotImplementedError("SO_REUSEPORT is not supported on this platform")
+    if _reactor is None:
+        _reactor = reactor
+    if isIPv6Address(interface):
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.setblocking(False)
+        return _reactor.adoptDatagramPort(sock.fileno(), family, protocol,
+                                          maxPacketSize)
+    finally:
+        # The reactor has its own copy of the descriptor by now
+        sock.close()
+
+
+class ReusePortUDPServer(service.Service):
+    """A service, that listens on a UDP port, shared with other processes
+    with C{SO_REUSEPORT}. See L{listenReusePort}.
+
+    """
+
+    def __init__(self, port, protocol, interface='', _reactor=None):
+        self.port = port
+        self.protocol = protocol
+        self.interface = interface
+        self._reactor = _reactor
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._port = listenReusePort(self.port, self.protocol, self.interface,
+                                     _reactor=self._reactor)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port is not None:
+            port, self._port = self._port, None
+            return port.stopListening()
+
+
+class WorkerProtocol(ProcessProtocol):
+    """Relays the output of a worker process to the log and tells the
+    L{WorkerPool}, when the process ends.
+
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.pid = None
+        self.ended = Deferred()
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+
+    def childDataReceived(self, fd, data):
+        for line in data.splitlines():
+            log.msg("Worker %s: %s" % (self.pid, line.decode('utf-8', 'replace')))
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerPool(service.Service):
+    """Runs and supervises a number of worker processes. A worker, that exits,
+    while the pool is running, is started again after L{restart_delay} seconds.
+
+    @param count: the number of worker processes
+    @type count: C{int}
+
+    @param args: the arguments of the worker processes, that are passed to
+    C{python -m twisted}, i.e. the name of the plugin and its options
+    @type args: C{list} of C{str}
+
+    @cvar restart_delay: how long to wait, before starting a worker, that has
+    exited, again, in seconds
+    @type restart_delay: C{int}
+
+    @ivar workers: the protocols of the running worker processes
+    @type workers: C{list} of L{WorkerProtocol}
+
+    """
+    restart_delay = 1
+
+    def __init__(self, count, args, _reactor=None):
+        self.count = count
+        self.args = args
+        self.workers = []
+        if _reactor is None:
+            self._reactor = reactor
+        else:
+            self._reactor = _reactor
+
+    def startService(self):
+        service.Service.startService(self)
+        for i in range(self.count):
+            self.spawnWorker()
+
+    def spawnWorker(self):
+        if not self.running:
+            return
+        worker = WorkerProtocol(self)
+        args = [sys.executable, '-m', 'twisted', '--log-format=text'] + self.args
+        self._reactor.spawnProcess(worker, sys.executable, args, env=os.environ)
+        self.workers.append(worker)
+        log.msg("Started worker %s" % (worker.pid,))
+
+    def workerEnded(self, worker, reason):
+        self.workers.remove(worker)
+        if self.running:
+            log.msg("Worker %s has exited: %s, restarting it" %
+                    (worker.pid, reason.getErrorMessage()))
+            self._reactor.callLater(self.restart_delay, self.spawnWorker)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ended = [worker.ended for worker in self.workers]
+        for worker in self.workers:
+            try:
+                worker.transport.signalProcess('TERM')
+            except ProcessExitedAlready:
+                pass
+        return DeferredList(ended)
@@ -1,14 +1,21 @@
 '''
 @author: shylent
 '''
-from tftp.backend import FilesystemSynchronousBackend
+from tftp import batch, logger
+from tftp.backend import (FilesystemSynchronousBackend, FilesystemAsyncBackend,
+    ContentCache, NegativeCache, SharedFiles, FSYNC_NONE, FSYNC_DATA, FSYNC_FULL)
+from tftp.multiplex import SessionMultiplexer
+from tftp.netascii import to_netascii
 from tftp.protocol import TFTP
+from tftp.workers import ReusePortUDPServer, WorkerPool
 from twisted.application import internet
 from twisted.application.service import IServiceMaker
 from twisted.plugin import IPlugin
 from twisted.python import usage
 from twisted.python.filepath import FilePath
 from zope.interface import implementer
+import os
+import socket
 
 
 def to_path(str_path):
@@ -18,16 +25,143 @@ class TFTPOptions(usage.Options):
     optFlags = [
         ['enable-reading', 'r', 'Lets the clients read from this server.'],
         ['enable-writing', 'w', 'Lets the clients write to this server.'],
-        ['verbose', 'v', 'Make this server noisy.']
+        ['verbose', 'v', 'Make this server noisy (same as --log-level=debug).'],
+        ['reuse-port', None, 'Bind the port with SO_REUSEPORT, so that it can '
+         'be shared with other processes.'],
+        ['mmap', None, 'Serve the files from memory maps, instead of reading '
+         'them block by block. The served files must only be replaced '
+         '(renamed over), never overwritten in place: a file, that is '
+         'truncated, while it is served, may crash the server with SIGBUS.'],
+        ['atomic-writes', None, 'Write the uploads to temporary files next to '
+         'the targets and link them in place, when the upload is complete.'],
+        ['shared-reads', None, 'Share the open files and the data, that was '
+         'read from them, between the transfers of the same file.']
     ]
     optParameters = [
         ['port', 'p', 1069, 'Port number to listen on.', int],
-        ['root-directory', 'd', None, 'Root directory for this server.', to_path]
+        ['root-directory', 'd', None, 'Root directory for this server.', to_path],
+        ['session-sockets', None, 0, 'Serve transfers through a pool of this '
+         'many UDP sockets, instead of a new socket per transfer '
+         '(0 - disabled).', int],
+        ['workers', None, 0, 'Serve from this many worker processes, that share '
+         'the port with SO_REUSEPORT (0 - serve from this process).', int],
+        ['batch-size', None, 0, 'Send and receive up to this many datagrams per '
+         'system call on the sockets of the transfers, with recvmmsg/sendmmsg '
+         '(Linux only, 0 - disabled).', int],
+        ['cache-size', None, 0, 'Keep up to this many megabytes of the recently '
+         'read files in memory (0 - disabled).', int],
+        ['netascii-cache-size', None, 0, 'Keep up to this many megabytes of '
+         'the recently read files in memory, converted to netascii '
+         '(0 - disabled).', int],
+        ['threads', None, 0, 'Access the files from a pool of this many '
+         'threads (0 - access them from the main thread).', int],
+        ['thread-queue', None, 64, 'Refuse new transfers, while this many '
+         'file operations are waiting for the threads.', int],
+        ['read-ahead', None, 0, 'Read up to this many blocks of a download in '
+         'advance, while the current ones are in flight (0 - read every '
+         'block, when it is about to be sent).', int],
+        ['write-buffer', None, 0, 'Write the uploads in chunks of this many '
+         'bytes (0 - write every block, as it arrives).', int],
+        ['fsync', None, 'none', 'Flush the uploaded files to disk, when the '
+         'upload is complete: none, data (fdatasync) or full (fsync).'],
+        ['negative-ttl', None, 0, 'Remember the files, that were not found, for '
+         'this many seconds (0 - disabled).', float],
+        ['open-files', None, 0, 'Keep up to this many files open, after their '
+         'transfers are done, for the next transfers of them (0 - close '
+         'them).', int],
+        ['max-upload-size', None, 0, 'Refuse the uploads, that are larger, '
+         'than this many megabytes (0 - not limited).', int],
+        ['log-level', None, 'info', 'Log the messages of this level and above '
+         '(debug, info, warning or error).'],
+        ['log-sample', None, 1.0, 'Log only this share of the per-request '
+         'messages, between 0 and 1.', float],
+        ['log-rate', None, 0, 'Log up to this many messages per second about '
+         'each client (0 - not limited).', float]
     ]
 
     def postOptions(self):
         if self['root-directory'] is None:
             raise usage.UsageError("You must provide a root directory for the server")
+        if self['session-sockets'] < 0:
+            raise usage.UsageError("The number of session sockets must not be negative")
+        if self['workers'] < 0:
+            raise usage.UsageError("The number of workers must not be negative")
+        if ((self['workers'] or self['reuse-port']) and
+                not hasattr(socket, 'SO_REUSEPORT')):
+            raise usage.UsageError("SO_REUSEPORT is not supported on this platform")
+        if self['batch-size'] < 0:
+            raise usage.UsageError("The batch size must not be negative")
+        if self['batch-size'] and not batch.supported:
+            raise usage.UsageError("recvmmsg/sendmmsg are not supported on this platform")
+        if self['cache-size'] < 0:
+            raise usage.UsageError("The cache size must not be negative")
+        if self['netascii-cache-size'] < 0:
+            raise usage.UsageError("The netascii cache size must not be negative")
+        if self['threads'] < 0:
+            raise usage.UsageError("The number of threads must not be negative")
+        if self['thread-queue'] < 1:
+            raise usage.UsageError("The thread queue size must be positive")
+        if self['open-files'] < 0:
+            raise usage.UsageError("The number of open files must not be negative")
+        if self['threads'] and (self['cache-size'] or self['mmap'] or
+                                self['netascii-cache-size'] or
+                                self['shared-reads'] or self['open-files']):
+            raise usage.UsageError("--threads can not be combined with "
+                                   "--cache-size, --netascii-cache-size, "
+                                   "--mmap, --shared-reads or --open-files")
+        if ((self['shared-reads'] or self['open-files']) and
+                not hasattr(os, 'pread')):
+            raise usage.UsageError("pread is not supported on this platform")
+        if self['read-ahead'] < 0:
+            raise usage.UsageError("The read-ahead depth must not be negative")
+        if self['write-buffer'] < 0:
+            raise usage.UsageError("The write buffer size must not be negative")
+        if self['negative-ttl'] < 0:
+            raise usage.UsageError("The negative lookup TTL must not be negative")
+        if self['threads'] and self['negative-ttl']:
+            raise usage.UsageError("--threads can not be combined with "
+                                   "--negative-ttl")
+        if self['max-upload-size'] < 0:
+            raise usage.UsageError("The maximum upload size must not be negative")
+        if self['fsync'] not in (FSYNC_NONE, FSYNC_DATA, FSYNC_FULL):
+            raise usage.UsageError("Unknown fsync policy: %s" % (self['fsync'],))
+        if self['log-level'] not in logger.levels:
+            raise usage.UsageError("Unknown log level: %s" % (self['log-level'],))
+        if self['verbose']:
+            self['log-level'] = 'debug'
+        if not 0 <= self['log-sample'] <= 1:
+            raise usage.UsageError("The log sample rate must be between 0 and 1")
+        if self['log-rate'] < 0:
+            raise usage.UsageError("The log rate must not be negative")
+
+    def workerArguments(self):
+        """The arguments of this plugin for a worker process, that serves
+        on the shared port by itself.
+
+        """
+        args = ['tftp', '--port', str(self['port']),
+                '--root-directory', self['root-directory'].path,
+                '--session-sockets', str(self['session-sockets']),
+                '--batch-size', str(self['batch-size']),
+                '--cache-size', str(self['cache-size']),
+                '--netascii-cache-size', str(self['netascii-cache-size']),
+                '--threads', str(self['threads']),
+                '--thread-queue', str(self['thread-queue']),
+                '--read-ahead', str(self['read-ahead']),
+                '--write-buffer', str(self['write-buffer']),
+                '--fsync', self['fsync'],
+                '--max-upload-size', str(self['max-upload-size']),
+                '--negative-ttl', str(self['negative-ttl']),
+                '--open-files', str(self['open-files']),
+                '--log-level', self['log-level'],
+                '--log-sample', str(self['log-sample']),
+                '--log-rate', str(self['log-rate']),
+                '--reuse-port']
+        for flag in ('enable-reading', 'enable-writing', 'verbose', 'mmap',
+                     'atomic-writes', 'shared-reads'):
+            if self[flag]:
+                args.append('--' + flag)
+        return args
 
 
 @implementer(IServiceMaker, IPlugin)
@@ -37,9 +171,61 @@ class TFTPServiceCreator(object):
     options = TFTPOptions
 
     def makeService(self, options):
-        backend = FilesystemSynchronousBackend(options["root-directory"],
-                                               can_read=options['enable-reading'],
-                                               can_write=options['enable-writing'])
-        return internet.UDPServer(options['port'], TFTP(backend))
+        if options['workers']:
+            return WorkerPool(options['workers'], options.workerArguments())
+        max_upload_size = None
+        if options['max-upload-size']:
+            max_upload_size = options['max-upload-size'] * 1024 * 1024
+        logger.logger.configure(level=logger.levels[options['log-level']],
+                                sample_rate=options['log-sample'],
+                                rate_limit=options['log-rate'])
+        if options['threads']:
+            backend = FilesystemAsyncBackend(options["root-directory"],
+                                             can_read=options['enable-reading'],
+                                             can_write=options['enable-writing'],
+                                             threads=options['threads'],
+                                             queue_size=options['thread-queue'],
+                                             atomic_writes=options['atomic-writes'],
+                                             write_buffer=options['write-buffer'],
+                                             fsync=options['fsync'],
+                                             max_upload_size=max_upload_size)
+        else:
+            cache = negative_cache = netascii_cache = shared_files = None
+            if options['cache-size']:
+                cache = ContentCache(options['cache-size'] * 1024 * 1024)
+            if options['netascii-cache-size']:
+                netascii_cache = ContentCache(
+                    options['netascii-cache-size'] * 1024 * 1024,
+                    transform=to_netascii)
+            if options['shared-reads']:
+                shared_files = SharedFiles(max_open=options['open-files'])
+            elif options['open-files']:
+                # Only share the descriptors, not the data
+                shared_files = SharedFiles(max_chunks=0,
+                                           max_open=options['open-files'])
+            if options['negative-ttl']:
+                negative_cache = NegativeCache(options['negative-ttl'])
+            backend = FilesystemSynchronousBackend(options["root-directory"],
+                                                   can_read=options['enable-reading'],
+                                                   can_write=options['enable-writing'],
+                                                   cache=cache,
+                                                   use_mmap=options['mmap'],
+                                                   atomic_writes=options['atomic-writes'],
+                                                   write_buffer=options['write-buffer'],
+                                                   fsync=options['fsync'],
+                                                   max_upload_size=max_upload_size,
+                                                   negative_cache=negative_cache,
+                                                   netascii_cache=netascii_cache,
+                                                   shared_files=shared_files)
+        multiplexer = None
+        if options['session-sockets']:
+            multiplexer = SessionMultiplexer(options['session-sockets'],
+                                             batch_size=options['batch-size'])
+        tftp = TFTP(backend, multiplexer=multiplexer,
+                    batch_size=options['batch-size'],
+                    read_ahead=options['read-ahead'])
+        if options['reuse-port']:
+            return ReusePortUDPServer(options['port'], tftp)
+        return internet.UDPServer(options['port'], tftp)
 
 serviceMaker = TFTPServiceCreator()